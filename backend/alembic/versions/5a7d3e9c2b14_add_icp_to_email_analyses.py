@@ -0,0 +1,40 @@
+"""add icp to email analyses
+
+Revision ID: 5a7d3e9c2b14
+Revises: 8c2f4e1a9b73
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5a7d3e9c2b14'
+down_revision: Union[str, None] = '8c2f4e1a9b73'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Analyses are written with the ICP they were run against and their result as JSON
+    op.add_column('email_analyses', sa.Column('icp_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('email_analyses_icp_id_fkey', 'email_analyses', 'icps', ['icp_id'], ['id'], ondelete='CASCADE')
+    op.create_index(op.f('ix_email_analyses_icp_id'), 'email_analyses', ['icp_id'], unique=False)
+    op.alter_column('email_analyses', 'analysis_result',
+               existing_type=sa.Text(),
+               type_=sa.JSON(),
+               existing_nullable=True,
+               postgresql_using='analysis_result::json')
+
+
+def downgrade() -> None:
+    op.alter_column('email_analyses', 'analysis_result',
+               existing_type=sa.JSON(),
+               type_=sa.Text(),
+               existing_nullable=True)
+    op.drop_index(op.f('ix_email_analyses_icp_id'), table_name='email_analyses')
+    op.drop_constraint('email_analyses_icp_id_fkey', 'email_analyses', type_='foreignkey')
+    op.drop_column('email_analyses', 'icp_id')
@@ -0,0 +1,43 @@
+"""add usage records
+
+Revision ID: 8c2f4e1a9b73
+Revises: 1d0bf2439660
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c2f4e1a9b73'
+down_revision: Union[str, None] = '1d0bf2439660'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Monthly usage per user and resource, flushed from the Redis counters
+    op.create_table(
+        'usage_records',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('period', sa.String(), nullable=False),
+        sa.Column('resource', sa.String(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('counted_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.text('now()')),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()')),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'period', 'resource', name='uq_usage_user_period_resource')
+    )
+    op.create_index(op.f('ix_usage_records_id'), 'usage_records', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_usage_records_id'), table_name='usage_records')
+    op.drop_table('usage_records')
@@ -4,14 +4,19 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from pydantic import ValidationError
 from sqlalchemy.orm import Session
-from redis import Redis
+from redis.asyncio import Redis
 from app.core import security
 from app.core.config import settings
 from app.db.session import SessionLocal
+from app.db.redis import get_redis_client
 from app.models.user import User
 from app.schemas.token import TokenPayload
 from app.core.rate_limit import RateLimiter
 from app.core.cache import CacheService
+from app.core.monitoring import MonitoringService
+from app.core.usage import UsageMeter
+from app.core.warmup import load_entitlement
+from app.schemas.subscription import Entitlement
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/auth/login")
 
@@ -23,27 +28,24 @@ def get_db() -> Generator:
     finally:
         db.close()
 
-def get_redis() -> Generator:
-    try:
-        redis_client = Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-            password=settings.REDIS_PASSWORD,
-            decode_responses=True
-        )
-        yield redis_client
-    finally:
-        redis_client.close()
+def get_redis() -> Redis:
+    """Get a Redis client backed by the process-wide connection pool."""
+    return get_redis_client()
 
 def get_rate_limiter(redis_client: Redis = Depends(get_redis)) -> RateLimiter:
     return RateLimiter(redis_client)
 
 def get_cache_service(redis_client: Redis = Depends(get_redis)) -> CacheService:
-    return CacheService(redis_client)
+    return CacheService(redis_client, get_redis_client(decode_responses=False))
+
+def get_monitoring_service(redis_client: Redis = Depends(get_redis)) -> MonitoringService:
+    return MonitoringService(redis_client)
 
-def get_request() -> Request:
-    return Request
+def get_usage_meter(redis_client: Redis = Depends(get_redis)) -> UsageMeter:
+    return UsageMeter(redis_client)
+
+def get_request(request: Request) -> Request:
+    return request
 
 async def get_current_user(
     db: Session = Depends(get_db),
@@ -82,4 +84,17 @@ def get_current_active_superuser(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="The user doesn't have enough privileges",
         )
-    return current_user 
\ No newline at end of file
+    return current_user 
+
+async def get_entitlement(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+    cache_service: CacheService = Depends(get_cache_service),
+) -> Entitlement:
+    """Get the current user's subscription entitlement, cached briefly."""
+    cached = await cache_service.get_entitlement(current_user.id)
+    if cached is not None:
+        return Entitlement(**cached)
+    entitlement = load_entitlement(db, current_user.id)
+    await cache_service.set_entitlement(current_user.id, entitlement.model_dump())
+    return entitlement
\ No newline at end of file
@@ -1,7 +1,8 @@
 from fastapi import APIRouter
-from app.api.v1.endpoints import auth, icp
+from app.api.v1.endpoints import auth, email_analysis, icp
 
 api_router = APIRouter()
 
 api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
-api_router.include_router(icp.router, prefix="/icp", tags=["icp"]) 
\ No newline at end of file
+api_router.include_router(icp.router, prefix="/icp", tags=["icp"])
+api_router.include_router(email_analysis.router, prefix="/email-analysis", tags=["email-analysis"]) 
\ No newline at end of file
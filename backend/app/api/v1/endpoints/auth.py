@@ -1,12 +1,13 @@
 from datetime import timedelta
 from typing import Any
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 
 from app.api import deps
 from app.core import security
 from app.core.config import settings
+from app.core.warmup import warm_user_cache
 from app.models.user import User
 from app.schemas.auth import (
     Token,
@@ -20,6 +21,7 @@ router = APIRouter()
 
 @router.post("/login", response_model=Token)
 def login(
+    background_tasks: BackgroundTasks,
     db: Session = Depends(deps.get_db),
     form_data: OAuth2PasswordRequestForm = Depends()
 ) -> Any:
@@ -36,6 +38,9 @@ def login(
             detail="Inactive user",
         )
     
+    # Prefetch the dashboard's data after the response is sent
+    background_tasks.add_task(warm_user_cache, user.id)
+
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     return {
         "access_token": security.create_access_token(
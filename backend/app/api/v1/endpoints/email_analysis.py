@@ -1,32 +1,93 @@
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import Any, List, Optional, Union
+import asyncio
+import json
+from celery.result import AsyncResult
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+from redis.asyncio import Redis
 from sqlalchemy.orm import Session
 from app.api import deps
-from app.core.rate_limit import rate_limit
+from app.core.config import settings
+from app.core.celery_app import celery_app
+from app.db.session import SessionLocal
+from app.core.rate_limit import Cost, RouteRateLimit, rate_limit
 from app.core.audit import audit_log
+from app.core.cache import CacheService
+from app.core.etag import compute_etag, etag_matches, not_modified, set_etag
+from app.core.usage import ANALYSIS_USAGE, UsageMeter
+from app.core.warmup import load_recent_analyses
 from app.models.email_analysis import EmailAnalysis
 from app.models.icp import ICP
+from app.schemas.subscription import Entitlement
 from app.schemas.email_analysis import (
     EmailAnalysisCreate,
+    EmailAnalysisBatchCreate,
     EmailAnalysisResponse,
     EmailAnalysisList,
+    EmailAnalysisJob,
 )
-from app.core.openai import analyze_email
-from app.core.exceptions import RateLimitExceeded, ResourceNotFound
+from app.core.openai import (
+    analysis_cache_key,
+    analyze_email_cached,
+    fit_email_to_budget,
+    parse_analysis,
+    stream_email_analysis,
+)
+from app.core.exceptions import QuotaExceeded, RateLimitExceeded, ResourceNotFound
+from app.worker import analyze_email_task
 
 router = APIRouter()
 
-@router.post("/analyze", response_model=EmailAnalysisResponse)
-@rate_limit(max_requests=50, window_seconds=3600)  # 50 requests per hour
+def analysis_rate_limit(cost: Cost) -> RouteRateLimit:
+    """Spend `cost` units of the analysis budget the analyzing routes below share."""
+    return rate_limit(
+        max_requests=settings.ANALYSIS_RATE_LIMIT,
+        window_seconds=settings.ANALYSIS_RATE_LIMIT_WINDOW,
+        cost=cost,
+        scope="email_analysis",
+    )
+
+def analysis_read_rate_limit() -> RouteRateLimit:
+    """Count a request against the budget the reading routes below share."""
+    return rate_limit(
+        max_requests=settings.ANALYSIS_READ_RATE_LIMIT,
+        window_seconds=settings.ANALYSIS_READ_RATE_LIMIT_WINDOW,
+        scope="email_analysis_read",
+    )
+
+async def _batch_cost(request: Request) -> int:
+    """Charge a batch for every email in it, at a rate that lets a full batch fit the budget."""
+    try:
+        email_contents = (await request.json()).get("email_contents") or []
+    except (ValueError, AttributeError):
+        # Malformed bodies are rejected by validation; charge them as one analysis
+        email_contents = []
+    return settings.ANALYSIS_BATCH_EMAIL_COST * max(len(email_contents), 1)
+
+def _sse_event(event: str, data: Any) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/analyze", response_model=Union[EmailAnalysisResponse, EmailAnalysisJob])
+@analysis_rate_limit(cost=settings.ANALYSIS_RATE_LIMIT_COST)
 @audit_log(action="create", resource_type="email_analysis")
 async def create_email_analysis(
     *,
     db: Session = Depends(deps.get_db),
     current_user = Depends(deps.get_current_user),
+    entitlement: Entitlement = Depends(deps.get_entitlement),
+    cache_service: CacheService = Depends(deps.get_cache_service),
+    usage_meter: UsageMeter = Depends(deps.get_usage_meter),
+    redis_client: Redis = Depends(deps.get_redis),
+    response: Response,
     analysis: EmailAnalysisCreate,
-) -> EmailAnalysisResponse:
+    run_async: bool = False,
+) -> Union[EmailAnalysisResponse, EmailAnalysisJob]:
     """
     Create a new email analysis.
+
+    With `run_async=true` the analysis is queued as a background job and
+    its id is returned immediately; poll `/jobs/{job_id}` for the result.
     """
     # Verify ICP exists and belongs to user
     icp = db.query(ICP).filter(
@@ -38,17 +99,44 @@ async def create_email_analysis(
         raise ResourceNotFound("ICP not found")
 
     # Check subscription limits
-    if not current_user.subscription.is_active:
+    if not entitlement.is_active:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Subscription required for email analysis"
         )
 
-    # Analyze email using OpenAI
-    analysis_result = await analyze_email(
-        email_content=analysis.email_content,
-        icp=icp
-    )
+    # Count the analysis against the plan's monthly quota
+    usage = await usage_meter.consume(db, current_user.id, entitlement.quota_plan, ANALYSIS_USAGE)
+    if not usage:
+        raise QuotaExceeded(usage.resource, usage.quota, usage.reset_time.isoformat())
+
+    if run_async:
+        try:
+            job = analyze_email_task.delay(
+                current_user.id,
+                analysis.icp_id,
+                analysis.email_content,
+                entitlement.plan_name
+            )
+        except Exception:
+            await usage_meter.refund(current_user.id, ANALYSIS_USAGE)
+            raise
+        # Remember the owner so only they can poll the job
+        await redis_client.setex(f"analysis_job:{job.id}", settings.CELERY_RESULT_EXPIRES, current_user.id)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return EmailAnalysisJob(job_id=job.id, status=job.status)
+
+    # Analyze email using OpenAI, reusing cached results for identical requests
+    try:
+        analysis_result = await analyze_email_cached(
+            email_content=analysis.email_content,
+            icp=icp,
+            cache_service=cache_service,
+            plan=entitlement.plan_name
+        )
+    except Exception:
+        await usage_meter.refund(current_user.id, ANALYSIS_USAGE)
+        raise
 
     # Create analysis record
     db_analysis = EmailAnalysis(
@@ -62,45 +150,287 @@ async def create_email_analysis(
     db.add(db_analysis)
     db.commit()
     db.refresh(db_analysis)
+    await cache_service.invalidate_recent_analyses(current_user.id)
+    await cache_service.clear_missing("email_analysis", current_user.id, db_analysis.id)
 
     return EmailAnalysisResponse.from_orm(db_analysis)
 
+@router.post("/analyze/stream")
+@analysis_rate_limit(cost=settings.ANALYSIS_RATE_LIMIT_COST)
+@audit_log(action="create", resource_type="email_analysis")
+async def create_email_analysis_stream(
+    *,
+    db: Session = Depends(deps.get_db),
+    current_user = Depends(deps.get_current_user),
+    entitlement: Entitlement = Depends(deps.get_entitlement),
+    cache_service: CacheService = Depends(deps.get_cache_service),
+    usage_meter: UsageMeter = Depends(deps.get_usage_meter),
+    analysis: EmailAnalysisCreate,
+) -> StreamingResponse:
+    """
+    Create a new email analysis, streaming the model output as server-sent events.
+
+    Emits `token` events as text arrives, then a final `result` event with the
+    persisted analysis, or an `error` event if the analysis fails.
+    """
+    # Verify ICP exists and belongs to user
+    icp = db.query(ICP).filter(
+        ICP.id == analysis.icp_id,
+        ICP.user_id == current_user.id
+    ).first()
+
+    if not icp:
+        raise ResourceNotFound("ICP not found")
+
+    # Check subscription limits
+    if not entitlement.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Subscription required for email analysis"
+        )
+
+    # Count the analysis against the plan's monthly quota
+    usage = await usage_meter.consume(db, current_user.id, entitlement.quota_plan, ANALYSIS_USAGE)
+    if not usage:
+        raise QuotaExceeded(usage.resource, usage.quota, usage.reset_time.isoformat())
+
+    email_content = fit_email_to_budget(analysis.email_content, icp, entitlement.plan_name)
+    cache_key = analysis_cache_key(email_content, icp)
+    cached_result = await cache_service.get_analysis(cache_key)
+    user_id = current_user.id
+
+    async def event_stream():
+        analysis_result = cached_result
+        saved = False
+        try:
+            if analysis_result is None:
+                chunks = []
+                async for token in stream_email_analysis(email_content, icp):
+                    chunks.append(token)
+                    yield _sse_event("token", {"content": token})
+                analysis_result = parse_analysis("".join(chunks) if chunks else None)
+                await cache_service.set_analysis(cache_key, analysis_result)
+            else:
+                yield _sse_event("token", {"content": json.dumps(analysis_result)})
+
+            # The request's session is closed once streaming starts, so use our own
+            stream_db = SessionLocal()
+            try:
+                db_analysis = EmailAnalysis(
+                    user_id=user_id,
+                    icp_id=analysis.icp_id,
+                    email_content=analysis.email_content,
+                    analysis_result=analysis_result,
+                    sentiment_score=analysis_result.get("sentiment_score"),
+                )
+                stream_db.add(db_analysis)
+                stream_db.commit()
+                saved = True
+                stream_db.refresh(db_analysis)
+                result = EmailAnalysisResponse.from_orm(db_analysis)
+            finally:
+                stream_db.close()
+            await cache_service.invalidate_recent_analyses(user_id)
+            await cache_service.clear_missing("email_analysis", user_id, result.id)
+
+            yield _sse_event("result", result.model_dump(mode="json"))
+        except Exception as e:
+            yield _sse_event("error", {"detail": getattr(e, "detail", str(e))})
+        finally:
+            # Also covers clients that disconnect mid-stream, which cancel the generator
+            if not saved:
+                await usage_meter.refund(user_id, ANALYSIS_USAGE)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Keep GZipMiddleware and proxies from buffering the event stream
+            "Content-Encoding": "identity",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+@router.post("/analyze/batch", response_model=List[EmailAnalysisResponse])
+@analysis_rate_limit(cost=_batch_cost)
+@audit_log(action="create", resource_type="email_analysis")
+async def create_email_analysis_batch(
+    *,
+    db: Session = Depends(deps.get_db),
+    current_user = Depends(deps.get_current_user),
+    entitlement: Entitlement = Depends(deps.get_entitlement),
+    cache_service: CacheService = Depends(deps.get_cache_service),
+    usage_meter: UsageMeter = Depends(deps.get_usage_meter),
+    batch: EmailAnalysisBatchCreate,
+) -> List[EmailAnalysisResponse]:
+    """
+    Analyze a batch of email variants against one ICP.
+    """
+    # Verify ICP exists and belongs to user
+    icp = db.query(ICP).filter(
+        ICP.id == batch.icp_id,
+        ICP.user_id == current_user.id
+    ).first()
+
+    if not icp:
+        raise ResourceNotFound("ICP not found")
+
+    # Check subscription limits
+    if not entitlement.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Subscription required for email analysis"
+        )
+
+    # Count every email against the plan's monthly quota
+    usage = await usage_meter.consume(db, current_user.id, entitlement.quota_plan, ANALYSIS_USAGE, len(batch.email_contents))
+    if not usage:
+        raise QuotaExceeded(usage.resource, usage.quota, usage.reset_time.isoformat())
+
+    # Fan out to OpenAI with bounded concurrency
+    semaphore = asyncio.Semaphore(settings.ANALYSIS_BATCH_CONCURRENCY)
+    plan = entitlement.plan_name
+
+    async def analyze(email_content: str) -> dict:
+        async with semaphore:
+            return await analyze_email_cached(
+                email_content=email_content,
+                icp=icp,
+                cache_service=cache_service,
+                plan=plan
+            )
+
+    tasks = [asyncio.create_task(analyze(email_content)) for email_content in batch.email_contents]
+    try:
+        analysis_results = await asyncio.gather(*tasks)
+    except BaseException:
+        # One failure fails the batch, so stop the calls still running instead of paying for them
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await usage_meter.refund(current_user.id, ANALYSIS_USAGE, len(batch.email_contents))
+        raise
+
+    # Insert all analysis records in one transaction
+    db_analyses = [
+        EmailAnalysis(
+            user_id=current_user.id,
+            icp_id=batch.icp_id,
+            email_content=email_content,
+            analysis_result=analysis_result,
+            sentiment_score=analysis_result.get("sentiment_score"),
+        )
+        for email_content, analysis_result in zip(batch.email_contents, analysis_results)
+    ]
+
+    db.add_all(db_analyses)
+    db.flush()
+    analysis_ids = [db_analysis.id for db_analysis in db_analyses]
+    db.commit()
+    await cache_service.invalidate_recent_analyses(current_user.id)
+    await cache_service.clear_missing("email_analysis", current_user.id, *analysis_ids)
+
+    # Reload the committed rows with a single query instead of one refresh per row
+    analyses = db.query(EmailAnalysis).filter(
+        EmailAnalysis.id.in_(analysis_ids)
+    ).order_by(EmailAnalysis.id).all()
+
+    return [EmailAnalysisResponse.from_orm(db_analysis) for db_analysis in analyses]
+
+@router.get("/jobs/{job_id}", response_model=EmailAnalysisJob)
+@analysis_read_rate_limit()
+async def get_email_analysis_job(
+    *,
+    db: Session = Depends(deps.get_db),
+    current_user = Depends(deps.get_current_user),
+    redis_client: Redis = Depends(deps.get_redis),
+    job_id: str,
+) -> EmailAnalysisJob:
+    """
+    Get the status of a background email analysis job, with its result once done.
+    """
+    owner_id = await redis_client.get(f"analysis_job:{job_id}")
+    if owner_id is None or int(owner_id) != current_user.id:
+        raise ResourceNotFound("Analysis job not found")
+
+    result = AsyncResult(job_id, app=celery_app)
+    job = EmailAnalysisJob(job_id=job_id, status=result.status)
+
+    if result.successful():
+        db_analysis = db.query(EmailAnalysis).filter(
+            EmailAnalysis.id == result.result["analysis_id"],
+            EmailAnalysis.user_id == current_user.id
+        ).first()
+        if db_analysis:
+            job.analysis = EmailAnalysisResponse.from_orm(db_analysis)
+    elif result.failed():
+        job.error = str(result.result)
+
+    return job
+
 @router.get("/analyses", response_model=List[EmailAnalysisList])
+@analysis_read_rate_limit()
 @audit_log(action="read", resource_type="email_analysis")
 async def list_email_analyses(
     *,
     db: Session = Depends(deps.get_db),
     current_user = Depends(deps.get_current_user),
+    cache_service: CacheService = Depends(deps.get_cache_service),
     skip: int = 0,
     limit: int = 10,
 ) -> List[EmailAnalysisList]:
     """
-    List user's email analyses with pagination.
+    List user's email analyses with pagination, most recent first.
     """
+    # The first page is what the dashboard shows, so it is cached (and warmed on login)
+    recent = skip == 0 and limit <= settings.RECENT_ANALYSES_LIMIT
+    if recent:
+        cached_analyses = await cache_service.get_recent_analyses(current_user.id)
+        if cached_analyses is not None:
+            return cached_analyses[:limit]
+        analyses = load_recent_analyses(db, current_user.id)
+        await cache_service.set_recent_analyses(current_user.id, analyses)
+        return analyses[:limit]
+
     analyses = db.query(EmailAnalysis).filter(
         EmailAnalysis.user_id == current_user.id
-    ).offset(skip).limit(limit).all()
+    ).order_by(EmailAnalysis.created_at.desc()).offset(skip).limit(limit).all()
     
     return [EmailAnalysisList.from_orm(analysis) for analysis in analyses]
 
 @router.get("/analyses/{analysis_id}", response_model=EmailAnalysisResponse)
+@analysis_read_rate_limit()
 @audit_log(action="read", resource_type="email_analysis")
 async def get_email_analysis(
     *,
     db: Session = Depends(deps.get_db),
     current_user = Depends(deps.get_current_user),
+    cache_service: CacheService = Depends(deps.get_cache_service),
     analysis_id: int,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
 ) -> EmailAnalysisResponse:
     """
     Get a specific email analysis by ID.
     """
+    if await cache_service.is_missing("email_analysis", current_user.id, analysis_id):
+        raise ResourceNotFound("Email analysis not found")
+
     analysis = db.query(EmailAnalysis).filter(
         EmailAnalysis.id == analysis_id,
         EmailAnalysis.user_id == current_user.id
     ).first()
     
     if not analysis:
+        await cache_service.mark_missing("email_analysis", current_user.id, analysis_id)
         raise ResourceNotFound("Email analysis not found")
+
+    # Answer unchanged analyses before serializing the (large) result
+    etag = compute_etag("email_analysis", [analysis])
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
     
     return EmailAnalysisResponse.from_orm(analysis)
 
@@ -110,20 +440,27 @@ async def delete_email_analysis(
     *,
     db: Session = Depends(deps.get_db),
     current_user = Depends(deps.get_current_user),
+    cache_service: CacheService = Depends(deps.get_cache_service),
     analysis_id: int,
 ) -> dict:
     """
     Delete a specific email analysis.
     """
+    if await cache_service.is_missing("email_analysis", current_user.id, analysis_id):
+        raise ResourceNotFound("Email analysis not found")
+
     analysis = db.query(EmailAnalysis).filter(
         EmailAnalysis.id == analysis_id,
         EmailAnalysis.user_id == current_user.id
     ).first()
     
     if not analysis:
+        await cache_service.mark_missing("email_analysis", current_user.id, analysis_id)
         raise ResourceNotFound("Email analysis not found")
     
     db.delete(analysis)
     db.commit()
+    await cache_service.invalidate_recent_analyses(current_user.id)
+    await cache_service.mark_missing("email_analysis", current_user.id, analysis_id)
     
     return {"message": "Email analysis deleted successfully"} 
\ No newline at end of file
@@ -1,5 +1,5 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
 from sqlalchemy.orm import Session
 from app.api import deps
 from app.models.user import User
@@ -7,13 +7,15 @@ from app.models.icp import ICP, ICPResponse
 from app.schemas.icp import ICPCreate, ICPUpdate, ICP as ICPSchema
 from app.schemas.icp_response import ICPResponseCreate, ICPResponse as ICPResponseSchema
 from app.schemas.questionnaire import Questionnaire
-from app.core.rate_limit import RateLimiter
 from app.core.cache import CacheService
+from app.core.etag import compute_etag, etag_matches, not_modified, set_etag
+from app.core.usage import ICP_USAGE, UsageMeter
+from app.schemas.subscription import Entitlement
 from app.core.exceptions import (
     ICPNotFound,
     ICPAccessDenied,
     ICPValidationError,
-    RateLimitExceeded,
+    QuotaExceeded,
     DatabaseError
 )
 import uuid
@@ -22,30 +24,40 @@ router = APIRouter()
 
 @router.get("/icps", response_model=List[ICPSchema])
 async def list_icps(
+    *,
     db: Session = Depends(deps.get_db),
     current_user: User = Depends(deps.get_current_user),
     skip: int = 0,
     limit: int = 100,
-    rate_limiter: RateLimiter = Depends(deps.get_rate_limiter),
     cache_service: CacheService = Depends(deps.get_cache_service),
-    request: Request = Depends(deps.get_request)
+    response: Response,
+    if_none_match: Optional[str] = Header(None)
 ):
     """List all ICPs for the current user."""
-    # Check rate limit
-    if not await rate_limiter.check_rate_limit(request, current_user.id):
-        reset_time = rate_limiter.get_reset_time(request, current_user.id)
-        raise RateLimitExceeded(reset_time.isoformat())
+    try:
+        # The id list is cached once per user; every page is a slice of it
+        icp_ids = await cache_service.get_user_icp_ids(current_user.id)
+        if icp_ids is None:
+            icp_ids = [
+                icp_id for (icp_id,) in
+                db.query(ICP.id).filter(ICP.user_id == current_user.id).order_by(ICP.id).all()
+            ]
+            await cache_service.set_user_icp_ids(current_user.id, icp_ids)
 
-    # Try to get from cache first
-    cached_icps = await cache_service.get_user_icps(current_user.id, skip, limit)
-    if cached_icps:
-        return cached_icps
+        page_ids = icp_ids[skip:skip + limit]
+        icps = await cache_service.get_icps(page_ids)
+        missing_ids = [icp_id for icp_id in page_ids if icp_id not in icps]
+        if missing_ids:
+            fetched = db.query(ICP).filter(ICP.id.in_(missing_ids), ICP.user_id == current_user.id).all()
+            await cache_service.set_icps(fetched)
+            icps.update((icp.id, icp) for icp in fetched)
 
-    try:
-        icps = db.query(ICP).filter(ICP.user_id == current_user.id).offset(skip).limit(limit).all()
-        # Cache the results
-        await cache_service.set_user_icps(current_user.id, icps, skip, limit)
-        return icps
+        page = [icps[icp_id] for icp_id in page_ids if icp_id in icps]
+        etag = compute_etag("icps", page)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        set_etag(response, etag)
+        return page
     except Exception as e:
         raise DatabaseError(str(e))
 
@@ -55,28 +67,36 @@ async def get_icp(
     db: Session = Depends(deps.get_db),
     current_user: User = Depends(deps.get_current_user),
     icp_id: int,
-    rate_limiter: RateLimiter = Depends(deps.get_rate_limiter),
     cache_service: CacheService = Depends(deps.get_cache_service),
-    request: Request = Depends(deps.get_request)
+    response: Response,
+    if_none_match: Optional[str] = Header(None)
 ):
     """Get a specific ICP by ID."""
-    # Check rate limit
-    if not await rate_limiter.check_rate_limit(request, current_user.id):
-        reset_time = rate_limiter.get_reset_time(request, current_user.id)
-        raise RateLimitExceeded(reset_time.isoformat())
-
-    # Try to get from cache first
+    # Try to get from cache first; a matching ETag is answered without touching the DB
     cached_icp = await cache_service.get_icp(icp_id)
-    if cached_icp:
+    if cached_icp is not None and cached_icp["user_id"] == current_user.id:
+        etag = compute_etag("icp", [cached_icp])
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        set_etag(response, etag)
         return cached_icp
 
+    # Ids recently found missing are answered from their tombstone
+    if await cache_service.is_missing("icp", current_user.id, icp_id):
+        raise ICPNotFound(icp_id)
+
     try:
         icp = db.query(ICP).filter(ICP.id == icp_id, ICP.user_id == current_user.id).first()
         if not icp:
+            await cache_service.mark_missing("icp", current_user.id, icp_id)
             raise ICPNotFound(icp_id)
         
         # Cache the result
         await cache_service.set_icp(icp_id, icp)
+        etag = compute_etag("icp", [icp])
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        set_etag(response, etag)
         return icp
     except ICPNotFound:
         raise
@@ -89,15 +109,15 @@ async def create_icp(
     db: Session = Depends(deps.get_db),
     current_user: User = Depends(deps.get_current_user),
     icp_in: ICPCreate,
-    rate_limiter: RateLimiter = Depends(deps.get_rate_limiter),
     cache_service: CacheService = Depends(deps.get_cache_service),
-    request: Request = Depends(deps.get_request)
+    entitlement: Entitlement = Depends(deps.get_entitlement),
+    usage_meter: UsageMeter = Depends(deps.get_usage_meter)
 ):
     """Create a new ICP."""
-    # Check rate limit
-    if not await rate_limiter.check_rate_limit(request, current_user.id):
-        reset_time = rate_limiter.get_reset_time(request, current_user.id)
-        raise RateLimitExceeded(reset_time.isoformat())
+    # Count the ICP against the plan's monthly quota
+    usage = await usage_meter.consume(db, current_user.id, entitlement.quota_plan, ICP_USAGE)
+    if not usage:
+        raise QuotaExceeded(usage.resource, usage.quota, usage.reset_time.isoformat())
 
     try:
         icp = ICP(
@@ -108,14 +128,16 @@ async def create_icp(
         db.commit()
         db.refresh(icp)
         
-        # Cache the new ICP
+        # Cache the new ICP and drop any tombstone left for its id
         await cache_service.set_icp(icp.id, icp)
+        await cache_service.clear_missing("icp", current_user.id, icp.id)
         # Invalidate user's ICP list cache
         await cache_service.invalidate_user_icps(current_user.id)
         
         return icp
     except Exception as e:
         db.rollback()
+        await usage_meter.refund(current_user.id, ICP_USAGE)
         raise DatabaseError(str(e))
 
 @router.put("/icps/{icp_id}", response_model=ICPSchema)
@@ -125,16 +147,9 @@ async def update_icp(
     current_user: User = Depends(deps.get_current_user),
     icp_id: int,
     icp_in: ICPUpdate,
-    rate_limiter: RateLimiter = Depends(deps.get_rate_limiter),
-    cache_service: CacheService = Depends(deps.get_cache_service),
-    request: Request = Depends(deps.get_request)
+    cache_service: CacheService = Depends(deps.get_cache_service)
 ):
     """Update an ICP."""
-    # Check rate limit
-    if not await rate_limiter.check_rate_limit(request, current_user.id):
-        reset_time = rate_limiter.get_reset_time(request, current_user.id)
-        raise RateLimitExceeded(reset_time.isoformat())
-
     try:
         icp = db.query(ICP).filter(ICP.id == icp_id, ICP.user_id == current_user.id).first()
         if not icp:
@@ -146,10 +161,8 @@ async def update_icp(
         db.commit()
         db.refresh(icp)
         
-        # Update cache
+        # Update cache; the user's id list is unchanged
         await cache_service.set_icp(icp_id, icp)
-        # Invalidate user's ICP list cache
-        await cache_service.invalidate_user_icps(current_user.id)
         
         return icp
     except ICPNotFound:
@@ -164,16 +177,9 @@ async def delete_icp(
     db: Session = Depends(deps.get_db),
     current_user: User = Depends(deps.get_current_user),
     icp_id: int,
-    rate_limiter: RateLimiter = Depends(deps.get_rate_limiter),
-    cache_service: CacheService = Depends(deps.get_cache_service),
-    request: Request = Depends(deps.get_request)
+    cache_service: CacheService = Depends(deps.get_cache_service)
 ):
     """Delete an ICP."""
-    # Check rate limit
-    if not await rate_limiter.check_rate_limit(request, current_user.id):
-        reset_time = rate_limiter.get_reset_time(request, current_user.id)
-        raise RateLimitExceeded(reset_time.isoformat())
-
     try:
         icp = db.query(ICP).filter(ICP.id == icp_id, ICP.user_id == current_user.id).first()
         if not icp:
@@ -182,8 +188,9 @@ async def delete_icp(
         db.delete(icp)
         db.commit()
         
-        # Clear cache
+        # Clear cache; stale tabs asking for it again get the tombstone
         await cache_service.delete_icp(icp_id)
+        await cache_service.mark_missing("icp", current_user.id, icp_id)
         # Invalidate user's ICP list cache
         await cache_service.invalidate_user_icps(current_user.id)
         
@@ -200,16 +207,9 @@ async def toggle_favorite(
     db: Session = Depends(deps.get_db),
     current_user: User = Depends(deps.get_current_user),
     icp_id: int,
-    rate_limiter: RateLimiter = Depends(deps.get_rate_limiter),
-    cache_service: CacheService = Depends(deps.get_cache_service),
-    request: Request = Depends(deps.get_request)
+    cache_service: CacheService = Depends(deps.get_cache_service)
 ):
     """Toggle favorite status of an ICP."""
-    # Check rate limit
-    if not await rate_limiter.check_rate_limit(request, current_user.id):
-        reset_time = rate_limiter.get_reset_time(request, current_user.id)
-        raise RateLimitExceeded(reset_time.isoformat())
-
     try:
         icp = db.query(ICP).filter(ICP.id == icp_id, ICP.user_id == current_user.id).first()
         if not icp:
@@ -219,10 +219,8 @@ async def toggle_favorite(
         db.commit()
         db.refresh(icp)
         
-        # Update cache
+        # Update cache; the user's id list is unchanged
         await cache_service.set_icp(icp_id, icp)
-        # Invalidate user's ICP list cache
-        await cache_service.invalidate_user_icps(current_user.id)
         
         return {"is_favorite": icp.is_favorite}
     except ICPNotFound:
@@ -265,7 +263,9 @@ def list_icp_responses(
     current_user: User = Depends(deps.get_current_user),
     icp_id: int,
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    response: Response,
+    if_none_match: Optional[str] = Header(None)
 ):
     """List all responses for a specific ICP."""
     # Verify ICP exists and belongs to user
@@ -273,7 +273,13 @@ def list_icp_responses(
     if not icp:
         raise HTTPException(status_code=404, detail="ICP not found")
     
-    return db.query(ICPResponse).filter(
+    icp_responses = db.query(ICPResponse).filter(
         ICPResponse.icp_id == icp_id,
         ICPResponse.user_id == current_user.id
-    ).offset(skip).limit(limit).all() 
\ No newline at end of file
+    ).offset(skip).limit(limit).all()
+
+    etag = compute_etag(f"icp_responses:{icp_id}", icp_responses)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+    return icp_responses 
\ No newline at end of file
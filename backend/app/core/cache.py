@@ -1,36 +1,191 @@
-from redis import Redis
-from typing import Optional, Any
+from redis.asyncio import Redis
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Any, Tuple
+import asyncio
 import json
+import math
+import random
+import time
+import uuid
 from datetime import timedelta
 import os
+from app.core.config import settings
+from app.core.monitoring import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    CACHE_REFRESHES,
+    CACHE_STALE_SERVED,
+    NEGATIVE_CACHE_HITS,
+    NEGATIVE_CACHE_STORES,
+)
+from app.core.codec import CacheEntry, decode_entry, encode_icp, decode_icp, encode_ids
+from app.db.redis import get_redis_client
+
+ANALYSIS_LRU_KEY = "analysis_lru"
+
+# Delete the lock only if it still holds our token
+RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# Extends a lock only while it is still held with the same token
+REFRESH_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+INVALIDATION_CHANNEL = "cache_invalidation"
+# Identifies this worker so it can ignore its own invalidation messages
+INSTANCE_ID = uuid.uuid4().hex
+
+class LocalCache:
+    """
+    Bounded in-process LRU cache with a per-entry TTL.
+
+    Shared by every request in a worker and invalidated by other workers
+    through the Redis pub/sub channel.
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        # Never keep a local copy longer than the Redis entry it mirrors
+        ttl = min(ttl, self.ttl) if ttl else self.ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+local_cache = LocalCache(settings.LOCAL_CACHE_MAX_ENTRIES, settings.LOCAL_CACHE_TTL)
+
+async def listen_for_invalidations(redis_client: Redis) -> None:
+    """
+    Drop local copies of keys that other workers invalidate, until cancelled.
+    """
+    while True:
+        try:
+            async with redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    origin, _, key = message["data"].partition("|")
+                    if origin != INSTANCE_ID:
+                        local_cache.delete(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Invalidations may have been missed while disconnected, so start over
+            local_cache.clear()
+            await asyncio.sleep(1.0)
 
 class CacheService:
-    def __init__(self, redis_client: Redis):
+    def __init__(self, redis_client: Redis, binary_client: Optional[Redis] = None):
         self.redis = redis_client
+        # ICP payloads are stored in the binary codec format, read without decoding
+        self.binary = binary_client or get_redis_client(decode_responses=False)
         self.default_ttl = int(os.getenv("CACHE_TTL", "300"))  # 5 minutes default
+        # Keys this request was told to recompute: when it started and its recompute lock token
+        self._recomputing: Dict[str, Tuple[float, Optional[str]]] = {}
 
     async def get_icp(self, icp_id: int) -> Optional[dict]:
         """Get ICP from cache."""
         try:
             key = f"icp:{icp_id}"
-            data = self.redis.get(key)
-            if data:
-                return json.loads(data)
-            return None
+            cached = local_cache.get(key)
+            if cached is not None:
+                CACHE_HITS.labels(cache_type="local").inc()
+                return cached
+            entry = await self._read_entry(key, "icp")
+            return self._keep_local(key, entry)
         except Exception as e:
             # Log error but don't raise - cache miss is acceptable
             return None
 
-    async def set_icp(self, icp_id: int, data: dict, ttl: Optional[int] = None) -> bool:
-        """Set ICP in cache."""
+    async def get_icps(self, icp_ids: List[int]) -> Dict[int, dict]:
+        """
+        Get fresh cached ICPs by id with a single MGET; missing ids are left out.
+        """
+        found: Dict[int, dict] = {}
+        try:
+            remote_ids = []
+            for icp_id in icp_ids:
+                cached = local_cache.get(f"icp:{icp_id}")
+                if cached is not None:
+                    found[icp_id] = cached
+                else:
+                    remote_ids.append(icp_id)
+            if found:
+                CACHE_HITS.labels(cache_type="local").inc(len(found))
+            if not remote_ids:
+                return found
+
+            values = await self.binary.mget([f"icp:{icp_id}" for icp_id in remote_ids])
+            now = time.time()
+            misses = 0
+            for icp_id, data in zip(remote_ids, values):
+                entry = decode_entry(data)
+                # Expired entities are refetched along with the misses
+                if entry is not None and entry.expires_at > now:
+                    found[icp_id] = self._keep_local(f"icp:{icp_id}", entry)
+                else:
+                    misses += 1
+            CACHE_HITS.labels(cache_type="icp").inc(len(remote_ids) - misses)
+            CACHE_MISSES.labels(cache_type="icp").inc(misses)
+            return found
+        except Exception as e:
+            return found
+
+    async def set_icps(self, icps: List[Any], ttl: Optional[int] = None) -> bool:
+        """
+        Refill ICPs fetched from the database after a get_icps miss, in one pipeline.
+        """
+        try:
+            ttl = ttl or self.default_ttl
+            expires_at = time.time() + ttl
+            pipe = self.binary.pipeline(transaction=False)
+            for icp in icps:
+                icp_id = icp["id"] if isinstance(icp, dict) else icp.id
+                encoded = encode_icp(icp, expires_at=expires_at)
+                pipe.setex(f"icp:{icp_id}", ttl + settings.CACHE_STALE_TTL, encoded)
+                local_cache.set(f"icp:{icp_id}", decode_icp(encoded), ttl)
+            await pipe.execute()
+            return True
+        except Exception as e:
+            return False
+
+    async def set_icp(self, icp_id: int, data: Any, ttl: Optional[int] = None) -> bool:
+        """Set ICP in cache from a model instance or dict."""
         try:
             key = f"icp:{icp_id}"
             ttl = ttl or self.default_ttl
-            return self.redis.setex(
-                key,
-                ttl,
-                json.dumps(data)
-            )
+            encoded, stored = await self._write_entry(key, encode_icp, data, ttl)
+            local_cache.set(key, decode_icp(encoded), ttl)
+            await self._publish_invalidation(key)
+            return stored
         except Exception as e:
             # Log error but don't raise - cache miss is acceptable
             return False
@@ -39,49 +194,252 @@ class CacheService:
         """Delete ICP from cache."""
         try:
             key = f"icp:{icp_id}"
-            return bool(self.redis.delete(key))
+            local_cache.delete(key)
+            # Delete before publishing, so a peer that misses its local copy can't reload the ICP from Redis
+            deleted = await self.binary.delete(key)
+            await self._publish_invalidation(key)
+            return bool(deleted)
         except Exception as e:
             # Log error but don't raise
             return False
 
-    async def get_user_icps(self, user_id: int, skip: int = 0, limit: int = 100) -> Optional[list]:
-        """Get user's ICPs from cache."""
-        try:
-            key = f"user_icps:{user_id}:{skip}:{limit}"
-            data = self.redis.get(key)
-            if data:
-                return json.loads(data)
+    async def _read_entry(self, key: str, cache_type: str) -> Optional[CacheEntry]:
+        """
+        Read a cached entry, or None when this caller should recompute it.
+
+        Entries outlive their TTL by CACHE_STALE_TTL. Once an entry is due for
+        refresh, the caller that takes the short recompute lock gets a miss
+        while everyone else keeps serving the stale value.
+        """
+        entry = decode_entry(await self.binary.get(key))
+        if entry is None:
+            self._recomputing[key] = (time.monotonic(), None)
             return None
+        if self._should_refresh(entry):
+            expired = time.time() >= entry.expires_at
+            token = uuid.uuid4().hex
+            if await self.redis.set(f"recompute_lock:{key}", token, nx=True, ex=settings.CACHE_RECOMPUTE_LOCK_TTL):
+                CACHE_REFRESHES.labels(cache_type=cache_type, reason="expired" if expired else "early").inc()
+                self._recomputing[key] = (time.monotonic(), token)
+                return None
+            if expired:
+                CACHE_STALE_SERVED.labels(cache_type=cache_type).inc()
+        return entry
+
+    def _should_refresh(self, entry: CacheEntry) -> bool:
+        """
+        XFetch: refresh ahead of expiry with a probability that grows as expiry
+        nears and with how long the value took to compute.
+        """
+        jitter = -math.log(1.0 - random.random())
+        return time.time() + entry.delta * settings.CACHE_EARLY_REFRESH_BETA * jitter >= entry.expires_at
+
+    def _keep_local(self, key: str, entry: Optional[CacheEntry]) -> Optional[Any]:
+        """Mirror a fresh entry in the local tier for the rest of its TTL."""
+        if entry is None:
+            return None
+        remaining = entry.expires_at - time.time()
+        if remaining > 0:
+            local_cache.set(key, entry.value, remaining)
+        return entry.value
+
+    async def _write_entry(self, key: str, encode: Callable[..., bytes], data: Any, ttl: int) -> Tuple[bytes, bool]:
+        """Store an entry with its recompute time and release the recompute lock."""
+        started, token = self._recomputing.pop(key, (None, None))
+        delta = time.monotonic() - started if started is not None else 0.0
+        encoded = encode(data, expires_at=time.time() + ttl, delta=delta)
+        stored = await self.binary.setex(key, ttl + settings.CACHE_STALE_TTL, encoded)
+        if token is not None:
+            await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, f"recompute_lock:{key}", token)
+        return encoded, stored
+
+    async def _publish_invalidation(self, key: str) -> None:
+        """Tell other workers to drop their local copy of a key."""
+        await self.redis.publish(INVALIDATION_CHANNEL, f"{INSTANCE_ID}|{key}")
+
+    async def _user_icps_generation(self, user_id: int) -> int:
+        """Get the current generation of a user's ICP list cache."""
+        return int(await self.redis.get(f"user_icps_gen:{user_id}") or 0)
+
+    async def get_user_icp_ids(self, user_id: int) -> Optional[List[int]]:
+        """Get the ordered ids of a user's ICPs from cache."""
+        try:
+            local_key = f"user_icps:{user_id}"
+            cached = local_cache.get(local_key)
+            if cached is not None:
+                CACHE_HITS.labels(cache_type="local").inc()
+                return cached
+            generation = await self._user_icps_generation(user_id)
+            entry = await self._read_entry(f"user_icps:{user_id}:{generation}", "user_icps")
+            return self._keep_local(local_key, entry)
         except Exception as e:
             return None
 
-    async def set_user_icps(
-        self,
-        user_id: int,
-        data: list,
-        skip: int = 0,
-        limit: int = 100,
-        ttl: Optional[int] = None
-    ) -> bool:
-        """Set user's ICPs in cache."""
-        try:
-            key = f"user_icps:{user_id}:{skip}:{limit}"
+    async def set_user_icp_ids(self, user_id: int, icp_ids: List[int], ttl: Optional[int] = None) -> bool:
+        """Set the ordered ids of a user's ICPs in cache."""
+        try:
+            generation = await self._user_icps_generation(user_id)
             ttl = ttl or self.default_ttl
-            return self.redis.setex(
-                key,
-                ttl,
-                json.dumps(data)
-            )
+            encoded, stored = await self._write_entry(f"user_icps:{user_id}:{generation}", encode_ids, icp_ids, ttl)
+            local_cache.set(f"user_icps:{user_id}", list(icp_ids), ttl)
+            return stored
         except Exception as e:
             return False
 
     async def invalidate_user_icps(self, user_id: int) -> bool:
-        """Invalidate all cached ICPs for a user."""
+        """
+        Invalidate the cached ICP id list of a user after an ICP is added or removed.
+
+        Bumping the generation orphans the old list without racing requests
+        that are still writing it; it expires on its own TTL.
+        """
         try:
-            pattern = f"user_icps:{user_id}:*"
-            keys = self.redis.keys(pattern)
-            if keys:
-                return bool(self.redis.delete(*keys))
+            local_cache.delete(f"user_icps:{user_id}")
+            await self.redis.incr(f"user_icps_gen:{user_id}")
+            await self._publish_invalidation(f"user_icps:{user_id}")
             return True
         except Exception as e:
-            return False 
\ No newline at end of file
+            return False
+
+    async def is_missing(self, resource: str, user_id: int, resource_id: Any) -> bool:
+        """Check for a tombstone recording that a user's resource does not exist."""
+        try:
+            if await self.redis.exists(f"missing:{resource}:{user_id}:{resource_id}"):
+                NEGATIVE_CACHE_HITS.labels(resource=resource).inc()
+                return True
+            return False
+        except Exception as e:
+            return False
+
+    async def mark_missing(self, resource: str, user_id: int, resource_id: Any) -> bool:
+        """
+        Remember for NEGATIVE_CACHE_TTL that a user's resource does not exist.
+
+        Tombstones are per user, since an id that exists for its owner is
+        still not found for everyone else.
+        """
+        try:
+            stored = await self.redis.setex(f"missing:{resource}:{user_id}:{resource_id}", settings.NEGATIVE_CACHE_TTL, 1)
+            NEGATIVE_CACHE_STORES.labels(resource=resource).inc()
+            return stored
+        except Exception as e:
+            return False
+
+    async def clear_missing(self, resource: str, user_id: int, *resource_ids: Any) -> bool:
+        """Drop tombstones for resources that have just been created."""
+        try:
+            if resource_ids:
+                await self.redis.delete(*[f"missing:{resource}:{user_id}:{resource_id}" for resource_id in resource_ids])
+            return True
+        except Exception as e:
+            return False
+
+    async def get_entitlement(self, user_id: int) -> Optional[dict]:
+        """Get a user's subscription entitlement from cache."""
+        try:
+            data = await self.redis.get(f"entitlement:{user_id}")
+            return json.loads(data) if data else None
+        except Exception as e:
+            return None
+
+    async def set_entitlement(self, user_id: int, data: dict) -> bool:
+        """Set a user's subscription entitlement in cache."""
+        try:
+            return await self.redis.setex(f"entitlement:{user_id}", settings.ENTITLEMENT_CACHE_TTL, json.dumps(data))
+        except Exception as e:
+            return False
+
+    async def get_recent_analyses(self, user_id: int) -> Optional[list]:
+        """Get a user's most recent email analyses from cache."""
+        try:
+            data = await self.redis.get(f"recent_analyses:{user_id}")
+            return json.loads(data) if data else None
+        except Exception as e:
+            return None
+
+    async def set_recent_analyses(self, user_id: int, data: list) -> bool:
+        """Set a user's most recent email analyses in cache."""
+        try:
+            return await self.redis.setex(f"recent_analyses:{user_id}", self.default_ttl, json.dumps(data))
+        except Exception as e:
+            return False
+
+    async def invalidate_recent_analyses(self, user_id: int) -> bool:
+        """Invalidate a user's cached recent analyses after one is added or removed."""
+        try:
+            return bool(await self.redis.delete(f"recent_analyses:{user_id}"))
+        except Exception as e:
+            return False
+
+    async def get_analysis(self, cache_key: str) -> Optional[dict]:
+        """Get a cached email analysis result and mark it as recently used."""
+        try:
+            key = f"analysis:{cache_key}"
+            data = await self.redis.get(key)
+            if data is None:
+                CACHE_MISSES.labels(cache_type="analysis").inc()
+                return None
+            CACHE_HITS.labels(cache_type="analysis").inc()
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.expire(key, settings.ANALYSIS_CACHE_TTL)
+            pipe.zadd(ANALYSIS_LRU_KEY, {cache_key: time.time()})
+            await pipe.execute()
+            return json.loads(data)
+        except Exception as e:
+            return None
+
+    async def set_analysis(self, cache_key: str, data: dict) -> bool:
+        """Cache an email analysis result, evicting the least recently used entries."""
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.setex(f"analysis:{cache_key}", settings.ANALYSIS_CACHE_TTL, json.dumps(data))
+            pipe.zadd(ANALYSIS_LRU_KEY, {cache_key: time.time()})
+            pipe.zcard(ANALYSIS_LRU_KEY)
+            _, _, size = await pipe.execute()
+
+            overflow = size - settings.ANALYSIS_CACHE_MAX_ENTRIES
+            if overflow > 0:
+                evicted = [member for member, _ in await self.redis.zpopmin(ANALYSIS_LRU_KEY, overflow)]
+                if evicted:
+                    await self.redis.delete(*[f"analysis:{member}" for member in evicted])
+            return True
+        except Exception as e:
+            return False
+
+    async def acquire_analysis_lock(self, cache_key: str) -> Optional[str]:
+        """Try to become the only worker analyzing this key; returns a lock token or None."""
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self.redis.set(
+                f"analysis_lock:{cache_key}",
+                token,
+                nx=True,
+                ex=settings.ANALYSIS_LOCK_TTL
+            )
+            return token if acquired else None
+        except Exception as e:
+            # Without Redis we can't coordinate, so let the caller run the analysis
+            return token
+
+    async def analysis_lock_held(self, cache_key: str) -> bool:
+        """Check whether another worker is still analyzing this key."""
+        try:
+            return bool(await self.redis.exists(f"analysis_lock:{cache_key}"))
+        except Exception as e:
+            return False
+
+    async def refresh_analysis_lock(self, cache_key: str, token: str) -> bool:
+        """Extend an analysis lock still held with the given token; False once it is lost."""
+        try:
+            return bool(await self.redis.eval(
+                REFRESH_LOCK_SCRIPT, 1, f"analysis_lock:{cache_key}", token, settings.ANALYSIS_LOCK_TTL
+            ))
+        except Exception as e:
+            return False
+
+    async def release_analysis_lock(self, cache_key: str, token: str) -> bool:
+        """Release an analysis lock acquired with the given token."""
+        try:
+            return bool(await self.redis.eval(RELEASE_LOCK_SCRIPT, 1, f"analysis_lock:{cache_key}", token))
+        except Exception as e:
+            return False
\ No newline at end of file
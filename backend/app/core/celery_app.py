@@ -0,0 +1,20 @@
+from celery import Celery
+from app.core.config import settings
+
+celery_app = Celery(
+    "whispersales",
+    broker=settings.REDIS_URL,
+    backend=settings.REDIS_URL,
+    include=["app.worker"],
+)
+
+celery_app.conf.update(
+    task_serializer="json",
+    result_serializer="json",
+    accept_content=["json"],
+    result_expires=settings.CELERY_RESULT_EXPIRES,
+    task_track_started=True,
+    # LLM calls are slow, so don't let one worker hoard queued jobs
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+)
@@ -0,0 +1,66 @@
+import struct
+from dataclasses import dataclass
+from typing import Any, List, Optional
+from pydantic import TypeAdapter
+from pydantic_core import from_json
+from app.core.config import settings
+from app.schemas.icp import ICP as ICPSchema
+
+try:
+    import zstandard
+except ImportError:  # compression is optional; values are then always stored raw
+    zstandard = None
+
+# Bump whenever the stored shape changes; values with another version are treated as misses
+CODEC_VERSION = 2
+
+# Format byte: how the JSON body is stored
+RAW = b"j"
+ZSTD = b"z"
+
+# Version, format, logical expiry (unix time) and how long the value took to compute (seconds)
+HEADER = struct.Struct("!Bcdd")
+
+_icp_adapter = TypeAdapter(ICPSchema)
+_id_list_adapter = TypeAdapter(List[int])
+
+@dataclass
+class CacheEntry:
+    value: Any
+    expires_at: float = 0.0
+    delta: float = 0.0
+
+def _encode(adapter: TypeAdapter, value: Any, expires_at: float, delta: float) -> bytes:
+    """Validate through the response schema and dump compact JSON behind the header."""
+    body = adapter.dump_json(adapter.validate_python(value, from_attributes=True))
+    if zstandard is not None and len(body) >= settings.CACHE_COMPRESSION_THRESHOLD:
+        compressed = zstandard.ZstdCompressor(level=settings.CACHE_COMPRESSION_LEVEL).compress(body)
+        return HEADER.pack(CODEC_VERSION, ZSTD, expires_at, delta) + compressed
+    return HEADER.pack(CODEC_VERSION, RAW, expires_at, delta) + body
+
+def decode_entry(data: Optional[bytes]) -> Optional[CacheEntry]:
+    """Decode a cached value, or return None if it was written by another codec version."""
+    if not data or len(data) < HEADER.size or data[0] != CODEC_VERSION:
+        return None
+    _, flag, expires_at, delta = HEADER.unpack_from(data)
+    body = data[HEADER.size:]
+    if flag == ZSTD:
+        if zstandard is None:
+            return None
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif flag != RAW:
+        return None
+    return CacheEntry(from_json(body), expires_at, delta)
+
+def encode_icp(icp: Any, expires_at: float = 0.0, delta: float = 0.0) -> bytes:
+    """Encode an ICP model or dict for the cache."""
+    return _encode(_icp_adapter, icp, expires_at, delta)
+
+def decode_icp(data: Optional[bytes]) -> Optional[dict]:
+    """Decode a cached ICP into its JSON-compatible dict."""
+    entry = decode_entry(data)
+    return entry.value if entry else None
+
+def encode_ids(ids: List[int], expires_at: float = 0.0, delta: float = 0.0) -> bytes:
+    """Encode an ordered list of entity ids for the cache."""
+    return _encode(_id_list_adapter, ids, expires_at, delta)
@@ -1,7 +1,17 @@
 from typing import List, Any, Dict, Optional
-from pydantic import AnyHttpUrl, validator, PostgresDsn
+from pydantic import AnyHttpUrl, BaseModel, validator, PostgresDsn
 from pydantic_settings import BaseSettings
 
+class RateLimitPolicy(BaseModel):
+    """Rate limit the middleware applies to requests under a path prefix."""
+    path: str  # prefix below API_V1_PREFIX, e.g. "/icp/"
+    methods: List[str] = []  # empty matches every method
+    limit: Optional[int] = None  # cost units per window, defaults to RATE_LIMIT_REQUESTS
+    window: Optional[int] = None  # seconds, defaults to RATE_LIMIT_PERIOD
+    cost: int = 1
+    scope: Optional[str] = None  # policies with the same scope share counters
+    leased: bool = False  # spend tokens leased in batches instead of one Redis call per request
+
 class Settings(BaseSettings):
     # Application
     APP_NAME: str
@@ -40,11 +50,63 @@ class Settings(BaseSettings):
     REDIS_PORT: int = 6379
     REDIS_DB: int = 0
     REDIS_PASSWORD: Optional[str] = None
+    REDIS_MAX_CONNECTIONS: int = 50  # per worker, shared by cache, rate limiting and monitoring
+    REDIS_SOCKET_TIMEOUT: float = 2.0  # seconds
     CACHE_TTL: int = 300  # 5 minutes default
+    LOCAL_CACHE_MAX_ENTRIES: int = 1024  # per worker, least recently used are evicted
+    LOCAL_CACHE_TTL: int = 30  # bounds staleness if an invalidation message is missed
+    CACHE_STALE_TTL: int = 60  # seconds an expired entry is still served while one request recomputes it
+    CACHE_RECOMPUTE_LOCK_TTL: int = 5  # seconds
+    CACHE_EARLY_REFRESH_BETA: float = 1.0  # >1 refreshes earlier, 0 disables early refresh
+    NEGATIVE_CACHE_TTL: int = 30  # seconds a missing ICP or analysis is remembered as missing
+    ENTITLEMENT_CACHE_TTL: int = 60  # bounds how long a subscription change takes to apply
+    RECENT_ANALYSES_LIMIT: int = 10  # analyses cached per user for the dashboard
+    CACHE_WARM_ON_STARTUP: bool = False  # warm the most active users' data when the API starts
+    CACHE_WARM_USER_COUNT: int = 100
+    CACHE_WARM_ACTIVE_DAYS: int = 7  # activity window used to pick the users to warm
+    CACHE_TELEMETRY_INTERVAL: int = 60  # seconds between cache size samples, 0 disables
+    CACHE_TELEMETRY_PREFIXES: List[str] = ["icp:", "user_icps:", "rate_limit:"]
+    CACHE_TELEMETRY_SCAN_CALLS: int = 10  # SCAN calls per sample
+    CACHE_TELEMETRY_SCAN_COUNT: int = 1000  # keys requested per SCAN call
+    CACHE_TELEMETRY_SAMPLE_SIZE: int = 100  # keys per prefix measured with MEMORY USAGE
+    CACHE_COMPRESSION_THRESHOLD: int = 2048  # bytes; larger ICP payloads are zstd-compressed
+    CACHE_COMPRESSION_LEVEL: int = 3
+    ANALYSIS_CACHE_TTL: int = 86400  # 24 hours
+    ANALYSIS_CACHE_MAX_ENTRIES: int = 10000  # least recently used are evicted
+    ANALYSIS_LOCK_TTL: int = 60  # seconds an in-flight analysis lock lives unless its holder refreshes it
+
+    # Celery
+    CELERY_RESULT_EXPIRES: int = 86400  # analysis job results kept for 24 hours
+
+    @property
+    def REDIS_URL(self) -> str:
+        auth = f":{self.REDIS_PASSWORD}@" if self.REDIS_PASSWORD else ""
+        return f"redis://{auth}{self.REDIS_HOST}:{self.REDIS_PORT}/{self.REDIS_DB}"
 
     # OpenAI
     OPENAI_API_KEY: str
     OPENAI_MODEL: str
+    OPENAI_BASE_URL: Optional[str] = None  # e.g. the local stand-in from scripts/fake_openai.py
+    # Prompt tokens allowed per analysis by subscription plan; longer emails are truncated
+    ANALYSIS_INPUT_TOKEN_BUDGETS: Dict[str, int] = {"free": 1500, "pro": 4000, "enterprise": 6000}
+    ANALYSIS_OUTPUT_BASE_TOKENS: int = 400  # scores and feedback, before the rewrite
+    ANALYSIS_MAX_OUTPUT_TOKENS: int = 1500
+    OPENAI_CONNECT_TIMEOUT: float = 5.0  # seconds to establish a connection
+    OPENAI_READ_TIMEOUT: float = 60.0  # seconds to wait for a completion
+    OPENAI_MAX_CONNECTIONS: int = 20  # per worker
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = 10  # idle connections kept open
+    OPENAI_KEEPALIVE_EXPIRY: float = 30.0  # seconds an idle connection is kept
+    OPENAI_MAX_RETRIES: int = 3  # retries for 429s, timeouts and 5xx
+    OPENAI_RETRY_BASE_DELAY: float = 0.5  # seconds, doubled per attempt with full jitter
+    OPENAI_RETRY_MAX_DELAY: float = 20.0  # seconds
+    OPENAI_CONCURRENCY_INITIAL: int = 10  # in-flight calls per worker, adapted at runtime
+    OPENAI_CONCURRENCY_MIN: int = 1
+    OPENAI_CONCURRENCY_MAX: int = 20
+    OPENAI_LATENCY_TARGET: float = 25.0  # seconds; slower calls shrink the limit
+    OPENAI_BREAKER_FAILURE_THRESHOLD: int = 5  # consecutive failures before failing fast
+    OPENAI_BREAKER_RECOVERY_TIMEOUT: float = 30.0  # seconds before a trial call
+    ANALYSIS_BATCH_CONCURRENCY: int = 10  # concurrent OpenAI calls per batch request
+    ANALYSIS_BATCH_MAX_SIZE: int = 500  # emails per batch request
 
     # Stripe
     STRIPE_SECRET_KEY: str
@@ -63,6 +125,34 @@ class Settings(BaseSettings):
     # Rate Limiting
     RATE_LIMIT_REQUESTS: int = 100  # requests per period
     RATE_LIMIT_PERIOD: int = 60  # period in seconds
+    RATE_LIMIT_LEASE_SIZE: int = 10  # tokens a worker leases per Redis round trip on read endpoints, 0 disables leasing
+    RATE_LIMIT_LEASE_TTL: float = 2.0  # seconds a leased batch may be spent before it is dropped
+    RATE_LIMIT_MAX_OVERSHOOT: int = 20  # tokens the shared bucket may be overdrawn by for leases
+    # Budget shared by the email analysis routes; an analysis weighs far more than a read
+    ANALYSIS_RATE_LIMIT: int = 1000  # cost units per window, 0 disables (e.g. for benchmarks)
+    ANALYSIS_RATE_LIMIT_WINDOW: int = 3600  # seconds
+    ANALYSIS_RATE_LIMIT_COST: int = 20  # units per analysis
+    # Units per email in a batch; a full batch of ANALYSIS_BATCH_MAX_SIZE emails must fit ANALYSIS_RATE_LIMIT
+    ANALYSIS_BATCH_EMAIL_COST: int = 2
+    # Reading analyses and polling jobs have their own budget, so polling can't use up the analysis budget
+    ANALYSIS_READ_RATE_LIMIT: int = 300  # requests per window, 0 disables
+    ANALYSIS_READ_RATE_LIMIT_WINDOW: int = 60  # seconds
+    RATE_LIMIT_MIDDLEWARE_ENABLED: bool = True  # check RATE_LIMIT_POLICIES before routing and auth
+    # First matching policy wins; set as a JSON list in the environment
+    RATE_LIMIT_POLICIES: List[RateLimitPolicy] = [
+        RateLimitPolicy(path="/icp/", methods=["GET"], leased=True),
+        RateLimitPolicy(path="/icp/"),
+    ]
+
+    # Usage Quotas
+    # Monthly quotas by subscription plan; a resource missing from a plan is unlimited
+    PLAN_QUOTAS: Dict[str, Dict[str, int]] = {
+        "free": {"email_analysis": 20, "icp": 3},
+        "pro": {"email_analysis": 1000, "icp": 50},
+        "enterprise": {},
+    }
+    USAGE_FLUSH_INTERVAL: int = 30  # seconds between writes of usage counters to Postgres, 0 disables
+    USAGE_FLUSH_BATCH_SIZE: int = 500  # counters written per statement
 
     # Logging
     LOG_LEVEL: str
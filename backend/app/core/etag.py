@@ -0,0 +1,54 @@
+import hashlib
+import json
+from datetime import datetime
+from typing import Any, Iterable, Optional, Tuple, Union
+from fastapi import Response, status
+
+# Sent with every ETag so browsers and proxies revalidate instead of reusing stale copies
+CACHE_CONTROL = "private, no-cache"
+
+def version_of(created_at: Union[datetime, str, None], updated_at: Union[datetime, str, None]) -> float:
+    """
+    Turn a row's timestamps into a version number, whether they come from
+    the ORM as datetimes or from the cache as ISO strings.
+    """
+    value = updated_at or created_at
+    if value is None:
+        return 0.0
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.timestamp()
+
+def _field(item: Any, name: str) -> Any:
+    return item.get(name) if isinstance(item, dict) else getattr(item, name)
+
+def compute_etag(kind: str, items: Iterable[Any]) -> str:
+    """
+    Build a strong ETag from the id and version of each item, without serializing them.
+    """
+    versions: list[Tuple[Any, float]] = [
+        (_field(item, "id"), version_of(_field(item, "created_at"), _field(item, "updated_at")))
+        for item in items
+    ]
+    digest = hashlib.sha256(json.dumps([kind, versions]).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against an ETag."""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    # If-None-Match uses weak comparison, so a W/ prefix doesn't prevent a match
+    return "*" in candidates or etag in (candidate.removeprefix("W/") for candidate in candidates)
+
+def not_modified(etag: str) -> Response:
+    """Build an empty 304 response for a matching ETag."""
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={"ETag": etag, "Cache-Control": CACHE_CONTROL},
+    )
+
+def set_etag(response: Response, etag: str) -> None:
+    """Attach an ETag to a full response."""
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
@@ -17,6 +17,13 @@ class ICPNotFound(BaseAPIException):
             detail=f"ICP with ID {icp_id} not found"
         )
 
+class ResourceNotFound(BaseAPIException):
+    def __init__(self, detail: str = "Resource not found") -> None:
+        super().__init__(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=detail
+        )
+
 class ICPAccessDenied(BaseAPIException):
     def __init__(self, icp_id: int) -> None:
         super().__init__(
@@ -32,14 +39,25 @@ class ICPValidationError(BaseAPIException):
         )
 
 class RateLimitExceeded(BaseAPIException):
-    def __init__(self, reset_time: str) -> None:
+    def __init__(self, reset_time: str, headers: Optional[Dict[str, str]] = None) -> None:
         super().__init__(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             detail={
                 "message": "Rate limit exceeded",
                 "reset_time": reset_time
             },
-            headers={"X-RateLimit-Reset": reset_time}
+            headers=headers or {"X-RateLimit-Reset": reset_time}
+        )
+
+class QuotaExceeded(BaseAPIException):
+    def __init__(self, resource: str, quota: int, reset_time: str) -> None:
+        super().__init__(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail={
+                "message": f"Monthly {resource} quota of {quota} exceeded",
+                "quota": quota,
+                "reset_time": reset_time
+            }
         )
 
 class DatabaseError(BaseAPIException):
@@ -54,4 +72,14 @@ class RedisError(BaseAPIException):
         super().__init__(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Cache error: {detail}"
-        ) 
\ No newline at end of file
+        ) 
+
+class OpenAIServiceError(BaseAPIException):
+    def __init__(self, detail: str) -> None:
+        super().__init__(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"AI service error: {detail}"
+        )
+
+class AuditLogError(Exception):
+    """Raised when an audit log entry can't be written."""
\ No newline at end of file
@@ -1,7 +1,8 @@
 from prometheus_client import Counter, Histogram, Gauge
-from typing import Optional
+from typing import Dict, List, Optional
+import asyncio
 import time
-from redis import Redis
+from redis.asyncio import Redis
 from app.core.config import settings
 
 # Rate Limiting Metrics
@@ -36,12 +37,117 @@ CACHE_MISSES = Counter(
     ['cache_type']
 )
 
+CACHE_REFRESHES = Counter(
+    'cache_refreshes_total',
+    'Total number of cache entries recomputed by the request holding the recompute lock',
+    ['cache_type', 'reason']
+)
+
+CACHE_STALE_SERVED = Counter(
+    'cache_stale_served_total',
+    'Total number of expired cache entries served while another request recomputes them',
+    ['cache_type']
+)
+
+NEGATIVE_CACHE_HITS = Counter(
+    'negative_cache_hits_total',
+    'Total number of lookups answered as not found by a tombstone instead of the database',
+    ['resource']
+)
+
+NEGATIVE_CACHE_STORES = Counter(
+    'negative_cache_stores_total',
+    'Total number of tombstones written for missing resources',
+    ['resource']
+)
+
+CACHE_WARM_FAILURES = Counter(
+    'cache_warm_failures_total',
+    'Total number of cache warm-up steps that failed',
+    ['stage']
+)
+
 CACHE_SIZE = Gauge(
     'cache_size_bytes',
     'Current size of cache in bytes',
     ['cache_type']
 )
 
+CACHE_KEYS = Gauge(
+    'cache_keys',
+    'Estimated number of keys per cache key prefix',
+    ['cache_type']
+)
+
+REDIS_MEMORY_USED = Gauge(
+    'redis_memory_used_bytes',
+    'Memory used by Redis as reported by INFO memory'
+)
+
+REDIS_KEYS = Gauge(
+    'redis_keys',
+    'Number of keys in the Redis database'
+)
+
+# Email Analysis Metrics
+ANALYSIS_PARSE_FAILURES = Counter(
+    'analysis_parse_failures_total',
+    'Total number of analysis responses that failed schema validation'
+)
+
+ANALYSIS_TOKENS = Histogram(
+    'analysis_tokens',
+    'Tokens per analysis call',
+    ['kind'],
+    buckets=(100, 250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000)
+)
+
+ANALYSIS_TRUNCATIONS = Counter(
+    'analysis_truncations_total',
+    'Total number of emails truncated to fit the input token budget',
+    ['plan']
+)
+
+ANALYSIS_COALESCED = Counter(
+    'analysis_requests_coalesced_total',
+    'Total number of analysis requests that shared an in-flight OpenAI call',
+    ['scope']
+)
+
+OPENAI_CONCURRENCY_LIMIT = Gauge(
+    'openai_concurrency_limit',
+    'Current adaptive limit on concurrent OpenAI calls in this worker'
+)
+
+OPENAI_RETRIES = Counter(
+    'openai_retries_total',
+    'Total number of retried OpenAI calls',
+    ['reason']
+)
+
+OPENAI_CIRCUIT_STATE = Gauge(
+    'openai_circuit_state',
+    'OpenAI circuit breaker state (0 closed, 1 half-open, 2 open)'
+)
+
+# Usage Metrics
+USAGE_QUOTA_REJECTIONS = Counter(
+    'usage_quota_rejections_total',
+    'Total number of requests rejected by a monthly plan quota',
+    ['resource', 'plan']
+)
+
+USAGE_FLUSHED = Counter(
+    'usage_counters_flushed_total',
+    'Total number of usage counters written to Postgres'
+)
+
+USAGE_ERRORS = Counter(
+    'usage_errors_total',
+    'Total number of failed usage refunds and flushes',
+    ['operation']
+)
+
 # Performance Metrics
 CACHE_OPERATION_DURATION = Histogram(
     'cache_operation_duration_seconds',
@@ -83,19 +189,52 @@ class MonitoringService:
         CACHE_MISSES.labels(cache_type=cache_type).inc()
 
     async def update_cache_size(self):
-        """Update cache size metrics."""
+        """
+        Estimate key counts and sizes per key prefix from a bounded sample.
+
+        Uses SCAN and MEMORY USAGE instead of KEYS and GET, so a collection
+        costs a fixed number of cheap round trips whatever the keyspace size.
+        """
         try:
-            # Get all keys
-            keys = self.redis.keys('*')
-            total_size = 0
-            
-            for key in keys:
-                # Get size of key and its value
-                key_size = len(key)
-                value_size = len(self.redis.get(key) or '')
-                total_size += key_size + value_size
-            
-            CACHE_SIZE.labels(cache_type='icp').set(total_size)
+            memory = await self.redis.info("memory")
+            REDIS_MEMORY_USED.set(memory["used_memory"])
+            total_keys = await self.redis.dbsize()
+            REDIS_KEYS.set(total_keys)
+
+            prefixes = settings.CACHE_TELEMETRY_PREFIXES
+            counts: Dict[str, int] = dict.fromkeys(prefixes, 0)
+            samples: Dict[str, List[str]] = {prefix: [] for prefix in prefixes}
+            scanned = 0
+            cursor = 0
+            for _ in range(settings.CACHE_TELEMETRY_SCAN_CALLS):
+                cursor, keys = await self.redis.scan(cursor, count=settings.CACHE_TELEMETRY_SCAN_COUNT)
+                scanned += len(keys)
+                for key in keys:
+                    prefix = next((prefix for prefix in prefixes if key.startswith(prefix)), None)
+                    if prefix is None:
+                        continue
+                    counts[prefix] += 1
+                    if len(samples[prefix]) < settings.CACHE_TELEMETRY_SAMPLE_SIZE:
+                        samples[prefix].append(key)
+                if cursor == 0:
+                    break
+
+            # A finished scan counted every key; otherwise scale the sample up to DBSIZE
+            scale = total_keys / scanned if cursor != 0 and scanned else 1.0
+
+            pipe = self.redis.pipeline(transaction=False)
+            for prefix in prefixes:
+                for key in samples[prefix]:
+                    pipe.memory_usage(key)
+            usages = iter(await pipe.execute())
+
+            for prefix in prefixes:
+                sizes = [next(usages) or 0 for _ in samples[prefix]]
+                average_size = sum(sizes) / len(sizes) if sizes else 0
+                estimated_keys = counts[prefix] * scale
+                cache_type = prefix.rstrip(":")
+                CACHE_KEYS.labels(cache_type=cache_type).set(estimated_keys)
+                CACHE_SIZE.labels(cache_type=cache_type).set(average_size * estimated_keys)
         except Exception as e:
             # Log error but don't raise
             pass
@@ -144,4 +283,13 @@ class MonitoringService:
                 'hits': 0,
                 'misses': 0,
                 'current_requests': 0
-            } 
\ No newline at end of file
+            } 
+
+async def collect_cache_telemetry(redis_client: Redis) -> None:
+    """
+    Update the cache size metrics every CACHE_TELEMETRY_INTERVAL seconds, until cancelled.
+    """
+    monitoring_service = MonitoringService(redis_client)
+    while True:
+        await monitoring_service.update_cache_size()
+        await asyncio.sleep(settings.CACHE_TELEMETRY_INTERVAL)
\ No newline at end of file
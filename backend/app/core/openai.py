@@ -1,80 +1,368 @@
-from typing import Dict, Any
-import openai
+from typing import AsyncIterator, Dict, Any, List, Optional
+import asyncio
+import hashlib
+import math
+import json
+import httpx
+from openai import AsyncOpenAI
+from pydantic import TypeAdapter, ValidationError
 from app.core.config import settings
+from app.core.cache import CacheService
+from app.core.resilience import openai_guard
+from app.core.monitoring import (
+    ANALYSIS_COALESCED,
+    ANALYSIS_PARSE_FAILURES,
+    ANALYSIS_TOKENS,
+    ANALYSIS_TRUNCATIONS,
+)
 from app.models.icp import ICP
+from app.schemas.email_analysis import EmailAnalysisFeedback
 from app.core.exceptions import OpenAIServiceError
 
-openai.api_key = settings.OPENAI_API_KEY
+# Bump whenever the prompt changes so cached results from the old prompt are not served
+PROMPT_VERSION = "2"
+
+# The model is forced to answer through this tool, so its arguments follow the feedback schema
+ANALYSIS_TOOL_NAME = "submit_email_analysis"
+ANALYSIS_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": ANALYSIS_TOOL_NAME,
+            "description": "Submit the structured analysis of the cold email.",
+            "parameters": EmailAnalysisFeedback.model_json_schema(),
+        },
+    }
+]
+ANALYSIS_TOOL_CHOICE = {"type": "function", "function": {"name": ANALYSIS_TOOL_NAME}}
+
+# Built once at import instead of on every response
+_feedback_adapter = TypeAdapter(EmailAnalysisFeedback)
+
+# Rough English average; good enough to budget prompts without a tokenizer dependency
+CHARS_PER_TOKEN = 4
+# Role and framing tokens the chat format adds to every message
+MESSAGE_TOKEN_OVERHEAD = 4
+DEFAULT_PLAN = "free"
+TRUNCATION_MARKER = "\n[truncated]"
+
+# Analyses currently running in this worker, keyed by cache key
+_inflight: Dict[str, asyncio.Future] = {}
+LOCK_POLL_INTERVAL = 0.25  # seconds between checks on another worker's analysis
+
+# One client per worker process, created by the application lifespan
+_client: Optional[AsyncOpenAI] = None
+
+def init_openai_client() -> AsyncOpenAI:
+    """
+    Create the shared AsyncOpenAI client with a pooled keep-alive HTTP transport.
+    """
+    global _client
+    if _client is None:
+        timeout = httpx.Timeout(
+            settings.OPENAI_READ_TIMEOUT,
+            connect=settings.OPENAI_CONNECT_TIMEOUT,
+        )
+        http_client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL,
+            timeout=timeout,
+            # Retries are handled by openai_guard so they share its backoff and limits
+            max_retries=0,
+            http_client=http_client,
+        )
+    return _client
+
+async def close_openai_client() -> None:
+    """
+    Close the shared client and its connection pool.
+    """
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+def get_openai_client() -> AsyncOpenAI:
+    """
+    Get the shared client, creating it lazily outside of the API lifespan.
+    """
+    return _client or init_openai_client()
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a piece of text.
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def estimate_message_tokens(messages: List[Dict[str, str]]) -> int:
+    """
+    Estimate the prompt tokens of a list of chat messages.
+    """
+    return sum(estimate_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD for message in messages)
+
+def fit_email_to_budget(email_content: str, icp: ICP, plan: Optional[str] = None) -> str:
+    """
+    Truncate an email so the full prompt fits the plan's input token budget.
+    """
+    plan = plan or DEFAULT_PLAN
+    budgets = settings.ANALYSIS_INPUT_TOKEN_BUDGETS
+    budget = budgets.get(plan, budgets[DEFAULT_PLAN])
+    overhead = estimate_message_tokens(build_analysis_messages("", icp))
+    available = max(budget - overhead, 0)
+
+    if estimate_tokens(email_content) <= available:
+        return email_content
+
+    ANALYSIS_TRUNCATIONS.labels(plan=plan).inc()
+    max_chars = max(available * CHARS_PER_TOKEN - len(TRUNCATION_MARKER), 0)
+    return email_content[:max_chars] + TRUNCATION_MARKER
+
+def output_token_limit(email_content: str) -> int:
+    """
+    Size max_tokens to the structured output, whose rewrite tracks the email length.
+    """
+    return min(
+        settings.ANALYSIS_OUTPUT_BASE_TOKENS + estimate_tokens(email_content),
+        settings.ANALYSIS_MAX_OUTPUT_TOKENS
+    )
+
+def analysis_cache_key(email_content: str, icp: ICP, model: Optional[str] = None) -> str:
+    """
+    Build a content-addressed cache key from everything that shapes the analysis.
+    """
+    payload = {
+        "email_content": " ".join(email_content.split()),
+        "icp": {
+            "industry": icp.industry,
+            "company_size": icp.company_size,
+            "persona_title": icp.persona_title,
+            "persona_responsibilities": icp.persona_responsibilities,
+            "pain_points": icp.pain_points,
+            "goals": icp.goals,
+        },
+        "model": model or settings.OPENAI_MODEL,
+        "prompt_version": PROMPT_VERSION,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+async def analyze_email_cached(
+    email_content: str,
+    icp: ICP,
+    cache_service: CacheService,
+    plan: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Analyze an email, serving repeated email/ICP pairs from the result cache.
+
+    The email is first truncated to the plan's input token budget. Concurrent
+    identical requests share one OpenAI call: within a worker they await the
+    same future, across workers they wait on a Redis lock and read the result
+    the lock holder caches.
+    """
+    email_content = fit_email_to_budget(email_content, icp, plan)
+    cache_key = analysis_cache_key(email_content, icp)
+    cached_result = await cache_service.get_analysis(cache_key)
+    if cached_result is not None:
+        return cached_result
+
+    inflight = _inflight.get(cache_key)
+    if inflight is not None:
+        ANALYSIS_COALESCED.labels(scope="worker").inc()
+        return await asyncio.shield(inflight)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = future
+    try:
+        analysis_result = await _analyze_email_locked(email_content, icp, cache_service, cache_key)
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved so it isn't logged when nobody was waiting
+        future.exception()
+        raise
+    else:
+        future.set_result(analysis_result)
+        return analysis_result
+    finally:
+        _inflight.pop(cache_key, None)
+        if not future.done():
+            future.set_exception(OpenAIServiceError("Analysis was cancelled"))
+            future.exception()
+
+async def _analyze_email_locked(
+    email_content: str,
+    icp: ICP,
+    cache_service: CacheService,
+    cache_key: str,
+) -> Dict[str, Any]:
+    """
+    Run the analysis unless another worker already holds the lock for this key.
+    """
+    token = await cache_service.acquire_analysis_lock(cache_key)
+    if token is None:
+        ANALYSIS_COALESCED.labels(scope="cluster").inc()
+        loop = asyncio.get_running_loop()
+        # The holder keeps the lock alive while it runs, so wait as long as its call could take
+        deadline = loop.time() + analysis_wait_limit()
+        while loop.time() < deadline and await cache_service.analysis_lock_held(cache_key):
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        cached_result = await cache_service.get_analysis(cache_key)
+        if cached_result is not None:
+            return cached_result
+        # The lock holder failed or timed out, so run the analysis ourselves
+
+    refresher = asyncio.create_task(_refresh_analysis_lock(cache_service, cache_key, token)) if token is not None else None
+    try:
+        analysis_result = await analyze_email(email_content=email_content, icp=icp)
+        await cache_service.set_analysis(cache_key, analysis_result)
+        return analysis_result
+    finally:
+        if refresher is not None:
+            refresher.cancel()
+            await asyncio.gather(refresher, return_exceptions=True)
+            await cache_service.release_analysis_lock(cache_key, token)
+
+def analysis_wait_limit() -> float:
+    """
+    Longest a guarded analysis call should take: every attempt timing out,
+    with the longest backoff between them.
+    """
+    attempt = settings.OPENAI_CONNECT_TIMEOUT + settings.OPENAI_READ_TIMEOUT
+    return (settings.OPENAI_MAX_RETRIES + 1) * attempt + settings.OPENAI_MAX_RETRIES * settings.OPENAI_RETRY_MAX_DELAY
+
+async def _refresh_analysis_lock(cache_service: CacheService, cache_key: str, token: str) -> None:
+    """
+    Extend the analysis lock until cancelled, so a call slower than
+    ANALYSIS_LOCK_TTL doesn't release the waiters into duplicate calls.
+    """
+    while True:
+        await asyncio.sleep(settings.ANALYSIS_LOCK_TTL / 3)
+        if not await cache_service.refresh_analysis_lock(cache_key, token):
+            return
+
+def build_analysis_messages(email_content: str, icp: ICP) -> List[Dict[str, str]]:
+    """
+    Build the chat messages for analyzing an email against an ICP.
+    """
+    # Construct the prompt with ICP details
+    prompt = f"""
+    Analyze this cold email against the following Ideal Customer Profile (ICP):
+
+    ICP Details:
+    - Industry: {icp.industry}
+    - Company Size: {icp.company_size}
+    - Target Persona: {icp.persona_title}
+    - Key Responsibilities: {icp.persona_responsibilities}
+    - Pain Points: {icp.pain_points}
+    - Goals: {icp.goals}
+
+    Cold Email:
+    {email_content}
+
+    Submit your analysis with the submit_email_analysis tool, including:
+    1. Overall ICP alignment score (0-100)
+    2. Key strengths of the email
+    3. Areas for improvement
+    4. Specific suggestions for better alignment with the ICP
+    5. Pain point addressal, with a score (0-100) and which pain points were addressed or missed
+    6. Persona match score (0-100)
+    7. A suggested rewrite that better aligns with the ICP
+    """
+
+    return [
+        {"role": "system", "content": "You are an expert sales email analyzer. Provide detailed, actionable feedback."},
+        {"role": "user", "content": prompt}
+    ]
+
+def tool_call_arguments(message: Any) -> Optional[str]:
+    """
+    Return the arguments of the message's analysis tool call, or None if it made none.
+    """
+    if message is None or not message.tool_calls or message.tool_calls[0].function is None:
+        return None
+    return message.tool_calls[0].function.arguments
+
+def parse_analysis(arguments: Optional[str]) -> Dict[str, Any]:
+    """
+    Validate the model's tool-call arguments against the feedback schema.
+
+    None (a response without the tool call) fails like any other invalid output.
+    """
+    try:
+        if arguments is None:
+            raise ValidationError.from_exception_data(
+                EmailAnalysisFeedback.__name__,
+                [{"type": "missing", "loc": ("tool_calls",), "input": None}]
+            )
+        feedback = _feedback_adapter.validate_json(arguments)
+    except ValidationError:
+        ANALYSIS_PARSE_FAILURES.inc()
+        raise
+    return feedback.model_dump()
 
 async def analyze_email(email_content: str, icp: ICP) -> Dict[str, Any]:
     """
     Analyze a cold email against an ICP using OpenAI's GPT models.
     """
+    messages = build_analysis_messages(email_content, icp)
+    ANALYSIS_TOKENS.labels(kind="prompt_estimate").observe(estimate_message_tokens(messages))
     try:
-        # Construct the prompt with ICP details
-        prompt = f"""
-        Analyze this cold email against the following Ideal Customer Profile (ICP):
-
-        ICP Details:
-        - Industry: {icp.industry}
-        - Company Size: {icp.company_size}
-        - Target Persona: {icp.persona_title}
-        - Key Responsibilities: {icp.persona_responsibilities}
-        - Pain Points: {icp.pain_points}
-        - Goals: {icp.goals}
-
-        Cold Email:
-        {email_content}
-
-        Please provide a detailed analysis including:
-        1. Overall resonance score (0-100)
-        2. Key strengths of the email
-        3. Areas for improvement
-        4. Specific suggestions for better alignment with the ICP
-        5. Pain point addressal score (0-100)
-        6. Persona match score (0-100)
-        7. A suggested rewrite that better aligns with the ICP
-        """
-
         # Call OpenAI API
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are an expert sales email analyzer. Provide detailed, actionable feedback."},
-                {"role": "user", "content": prompt}
-            ],
+        response = await openai_guard.call(lambda: get_openai_client().chat.completions.create(
+            model=settings.OPENAI_MODEL,
+            messages=messages,
+            tools=ANALYSIS_TOOLS,
+            tool_choice=ANALYSIS_TOOL_CHOICE,
             temperature=0.7,
-            max_tokens=1000
-        )
+            max_tokens=output_token_limit(email_content)
+        ))
+
+        if response.usage:
+            ANALYSIS_TOKENS.labels(kind="prompt").observe(response.usage.prompt_tokens)
+            ANALYSIS_TOKENS.labels(kind="completion").observe(response.usage.completion_tokens)
 
         # Parse and structure the response
-        analysis = response.choices[0].message.content
-        
-        # Extract scores and feedback using regex or structured parsing
-        # This is a simplified example - you'd want more robust parsing
-        import re
-        
-        # Extract scores
-        resonance_score = int(re.search(r"resonance score.*?(\d+)", analysis, re.IGNORECASE).group(1))
-        pain_point_score = int(re.search(r"pain point.*?(\d+)", analysis, re.IGNORECASE).group(1))
-        persona_score = int(re.search(r"persona match.*?(\d+)", analysis, re.IGNORECASE).group(1))
-
-        # Extract feedback sections
-        strengths = re.findall(r"strengths:.*?(?=\n|$)", analysis, re.IGNORECASE | re.DOTALL)
-        weaknesses = re.findall(r"improvements:.*?(?=\n|$)", analysis, re.IGNORECASE | re.DOTALL)
-        suggestions = re.findall(r"suggestions:.*?(?=\n|$)", analysis, re.IGNORECASE | re.DOTALL)
-        rewrite = re.search(r"rewrite:.*?(?=\n|$)", analysis, re.IGNORECASE | re.DOTALL)
-
-        return {
-            "resonance_score": resonance_score,
-            "pain_point_score": pain_point_score,
-            "persona_score": persona_score,
-            "strengths": [s.strip() for s in strengths],
-            "weaknesses": [w.strip() for w in weaknesses],
-            "suggestions": [s.strip() for s in suggestions],
-            "suggested_rewrite": rewrite.group(0).strip() if rewrite else None,
-            "raw_analysis": analysis
-        }
+        message = response.choices[0].message if response.choices else None
+        return parse_analysis(tool_call_arguments(message))
+
+    except Exception as e:
+        raise OpenAIServiceError(f"Failed to analyze email: {str(e)}")
+
+async def stream_email_analysis(email_content: str, icp: ICP) -> AsyncIterator[str]:
+    """
+    Stream the model's structured analysis arguments as they are generated.
+
+    Pass the concatenated chunks to `parse_analysis` once the stream ends.
+    The email should already fit the plan's budget (see `fit_email_to_budget`).
+    """
+    messages = build_analysis_messages(email_content, icp)
+    # Streamed responses carry no usage, so only the estimate is recorded
+    ANALYSIS_TOKENS.labels(kind="prompt_estimate").observe(estimate_message_tokens(messages))
+    try:
+        # Only opening the stream is guarded; tokens already sent can't be retried
+        stream = await openai_guard.call(lambda: get_openai_client().chat.completions.create(
+            model=settings.OPENAI_MODEL,
+            messages=messages,
+            tools=ANALYSIS_TOOLS,
+            tool_choice=ANALYSIS_TOOL_CHOICE,
+            temperature=0.7,
+            max_tokens=output_token_limit(email_content),
+            stream=True
+        ))
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            arguments = tool_call_arguments(chunk.choices[0].delta)
+            if arguments:
+                yield arguments
 
     except Exception as e:
-        raise OpenAIServiceError(f"Failed to analyze email: {str(e)}") 
\ No newline at end of file
+        raise OpenAIServiceError(f"Failed to analyze email: {str(e)}")
\ No newline at end of file
@@ -1,54 +1,408 @@
-from fastapi import Request, HTTPException
-from redis import Redis
+from fastapi import Depends, Request, HTTPException, Response, status
+from fastapi.responses import JSONResponse
+from redis.asyncio import Redis
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional
+from functools import wraps
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+import inspect
+import math
 import os
+import time
+from app.core.config import RateLimitPolicy, settings
+from app.core.exceptions import RateLimitExceeded
+from app.core.security import decode_token
+from app.db.redis import get_redis_client
+
+# Sliding window counter: the previous fixed window's count, weighted by how much of
+# it still overlaps the sliding window, plus the current window's count. Checking and
+# incrementing in one script keeps concurrent requests from racing past the limit.
+# KEYS: current window counter, previous window counter
+# ARGV: limit, cost, weight of the previous window (0-1), counter TTL in seconds
+SLIDING_WINDOW_SCRIPT = """
+local current = tonumber(redis.call("GET", KEYS[1]) or "0")
+local previous = tonumber(redis.call("GET", KEYS[2]) or "0")
+local allowed = 0
+if previous * tonumber(ARGV[3]) + current + tonumber(ARGV[2]) <= tonumber(ARGV[1]) then
+    current = redis.call("INCRBY", KEYS[1], ARGV[2])
+    redis.call("EXPIRE", KEYS[1], ARGV[4])
+    allowed = 1
+end
+return {allowed, current, previous}
+"""
+
+# Refills a token bucket and grants up to ARGV[4] tokens, overdrawing it by at most
+# ARGV[5] so tokens stranded in other workers' leases don't cause spurious rejections.
+# KEYS: bucket hash
+# ARGV: capacity, refill rate per second, now (unix time), tokens wanted, max overshoot
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local granted = math.max(0, math.min(tonumber(ARGV[4]), math.floor(tokens + tonumber(ARGV[5]))))
+tokens = tokens - granted
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) * 2)
+return {granted, tostring(tokens)}
+"""
+
+# Maximum number of leases a worker keeps; the least recently used are dropped
+MAX_LEASES = 10000
+
+class _Lease:
+    """Tokens a worker has taken from a shared bucket and may spend locally."""
+    __slots__ = ("tokens", "expires_at", "bucket_tokens")
+
+    def __init__(self, tokens: int, expires_at: float, bucket_tokens: float):
+        self.tokens = tokens
+        self.expires_at = expires_at
+        self.bucket_tokens = bucket_tokens
+
+# Leases held by this worker, shared by every request it serves
+_leases: "OrderedDict[str, _Lease]" = OrderedDict()
+
+def _client_host(request: Request) -> str:
+    """Get the client address, which ASGI servers may leave unset."""
+    return request.client.host if request.client else "unknown"
+
+@dataclass
+class RateLimitResult:
+    """Outcome of a rate limit check, truthy when the request is allowed."""
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_after: float  # seconds until the current window ends
+    retry_after: float = 0.0  # seconds until a denied request would be allowed
+
+    def __bool__(self) -> bool:
+        return self.allowed
+
+    @property
+    def reset_time(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.reset_after)
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(math.ceil(self.reset_after)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(math.ceil(self.retry_after))
+        return headers
+
+    def apply(self, response: Response) -> None:
+        """Add the X-RateLimit-* headers to a response."""
+        response.headers.update(self.headers())
 
 class RateLimiter:
-    def __init__(self, redis_client: Redis):
+    def __init__(
+        self,
+        redis_client: Redis,
+        limit: Optional[int] = None,
+        window: Optional[int] = None,
+        scope: Optional[str] = None,
+    ):
+        self.redis = redis_client
+        self.rate_limit = limit or int(os.getenv("RATE_LIMIT", "100"))  # cost units per window
+        self.window = window or 60  # 1 minute window
+        # Limiters with a scope keep their own counters instead of the global ones
+        self.scope = scope
+        # Run with EVALSHA, loading the scripts on first use
+        self.script = redis_client.register_script(SLIDING_WINDOW_SCRIPT)
+        self.bucket_script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def _keys(self, request: Request, user_id: Optional[int], now: float) -> Tuple[str, str, float]:
+        """Get the current and previous window keys and the previous window's weight."""
+        key = f"rate_limit:{_client_host(request)}:{user_id if user_id else 'anonymous'}"
+        if self.scope:
+            key = f"rate_limit:{self.scope}:{_client_host(request)}:{user_id if user_id else 'anonymous'}"
+        window_index = int(now // self.window)
+        elapsed = now - window_index * self.window
+        weight = (self.window - elapsed) / self.window
+        return f"{key}:{window_index}", f"{key}:{window_index - 1}", weight
+
+    def _result(self, allowed: bool, current: int, previous: int, weight: float, cost: int = 1) -> RateLimitResult:
+        elapsed = self.window * (1 - weight)
+        used = previous * weight + current
+        retry_after = 0.0
+        if not allowed:
+            room = self.rate_limit - cost - current
+            if room >= 0 and previous > 0:
+                # Wait until enough of the previous window has slid out
+                retry_after = max(self.window * (1 - room / previous) - elapsed, 0.0)
+            else:
+                # The current window alone is full; wait for it to become the previous one
+                next_room = self.rate_limit - cost
+                decay = self.window * (1 - next_room / current) if current > max(next_room, 0) else 0.0
+                retry_after = self.window - elapsed + decay
+        return RateLimitResult(
+            allowed=allowed,
+            limit=self.rate_limit,
+            remaining=max(0, math.floor(self.rate_limit - used)),
+            reset_after=self.window - elapsed,
+            retry_after=retry_after,
+        )
+
+    async def check_rate_limit(self, request: Request, user_id: Optional[int] = None, cost: int = 1) -> RateLimitResult:
+        """Count a request against the limit in a single round trip."""
+        current_key, previous_key, weight = self._keys(request, user_id, time.time())
+        allowed, current, previous = await self.script(
+            keys=[current_key, previous_key],
+            args=[self.rate_limit, cost, weight, self.window * 2]
+        )
+        return self._result(bool(allowed), int(current), int(previous), weight, cost)
+
+    async def get_remaining_requests(self, request: Request, user_id: Optional[int] = None) -> int:
+        current_key, previous_key, weight = self._keys(request, user_id, time.time())
+        current, previous = await self.redis.mget(current_key, previous_key)
+        return self._result(True, int(current or 0), int(previous or 0), weight).remaining
+
+    async def get_reset_time(self, request: Request, user_id: Optional[int] = None) -> datetime:
+        _, _, weight = self._keys(request, user_id, time.time())
+        return datetime.utcnow() + timedelta(seconds=self.window * weight)
+
+    async def check_leased(self, request: Request, user_id: Optional[int] = None, cost: int = 1) -> RateLimitResult:
+        """
+        Count a request against a token bucket, spending tokens leased in batches.
+
+        Only goes to Redis when this worker's lease is used up or expired, so
+        most requests skip it. Across workers the bucket admits at most
+        RATE_LIMIT_MAX_OVERSHOOT requests beyond the limit.
+        """
+        if settings.RATE_LIMIT_LEASE_SIZE <= 0:
+            return await self.check_rate_limit(request, user_id, cost)
+
+        key = f"rate_limit:bucket:{_client_host(request)}:{user_id if user_id else 'anonymous'}"
+        if self.scope:
+            key = f"rate_limit:bucket:{self.scope}:{_client_host(request)}:{user_id if user_id else 'anonymous'}"
+        refill_rate = self.rate_limit / self.window
+        now = time.monotonic()
+        lease = _leases.get(key)
+        if lease is not None and lease.expires_at <= now:
+            # Unspent tokens of an expired lease are dropped rather than returned
+            lease = None
+
+        if lease is None or lease.tokens < cost:
+            granted, bucket_tokens = await self.bucket_script(
+                keys=[key],
+                args=[
+                    self.rate_limit,
+                    refill_rate,
+                    time.time(),
+                    max(settings.RATE_LIMIT_LEASE_SIZE, cost),
+                    settings.RATE_LIMIT_MAX_OVERSHOOT,
+                ]
+            )
+            tokens = (lease.tokens if lease is not None else 0) + int(granted)
+            lease = _Lease(tokens, now + settings.RATE_LIMIT_LEASE_TTL, float(bucket_tokens))
+            _leases[key] = lease
+            while len(_leases) > MAX_LEASES:
+                _leases.popitem(last=False)
+        _leases.move_to_end(key)
+
+        allowed = lease.tokens >= cost
+        if allowed:
+            lease.tokens -= cost
+        available = max(lease.bucket_tokens, 0) + lease.tokens
+        return RateLimitResult(
+            allowed=allowed,
+            limit=self.rate_limit,
+            remaining=math.floor(available),
+            reset_after=max(self.rate_limit - lease.bucket_tokens, 0) / refill_rate,
+            retry_after=max(cost - lease.tokens - lease.bucket_tokens - settings.RATE_LIMIT_MAX_OVERSHOOT, 0) / refill_rate,
+        )
+
+# Keyword-only parameter the rate_limit decorator adds to an endpoint's signature
+RATE_LIMIT_PARAM = "rate_limit_status"
+
+# A fixed cost, or a function of the request (sync or async) for costs that depend on it
+Cost = Union[int, Callable[[Request], Union[int, Awaitable[int]]]]
+
+class RouteRateLimit:
+    """
+    Declarative limit for a route, usable as a decorator or as a dependency.
+
+    Each request spends `cost` units of a budget of `max_requests` units per
+    `window_seconds`, counted per user and client IP on the same Redis
+    sliding window as RateLimiter. Routes with the same `scope` share one
+    budget, so an expensive route can weigh more than a cheap one. `cost`
+    may be a function of the request, e.g. to charge a batch per item.
+    """
+
+    def __init__(self, max_requests: int, window_seconds: int = 60, cost: Cost = 1, scope: Optional[str] = None):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.cost = cost
+        self.scope = scope
+        self._dependency: Optional[Callable] = None
+
+    @property
+    def dependency(self) -> Callable:
+        """The FastAPI dependency that checks the limit, e.g. `Depends(limit.dependency)`."""
+        if self._dependency is None:
+            # Imported here because app.api.deps imports this module
+            from app.api import deps
+            from app.models.user import User
+
+            async def check(
+                request: Request,
+                response: Response,
+                current_user: User = Depends(deps.get_current_active_user),
+                redis_client: Redis = Depends(deps.get_redis),
+            ) -> Optional[RateLimitResult]:
+                if self.max_requests <= 0:
+                    # Disabled, e.g. for benchmarks
+                    return None
+                cost = await self._cost_of(request)
+                if cost > self.max_requests:
+                    # Waiting would never help, so don't answer with a 429
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"Request costs {cost} units, more than the limit of {self.max_requests} per {self.window_seconds} seconds",
+                    )
+                limiter = RateLimiter(redis_client, self.max_requests, self.window_seconds, self._scope_of(request))
+                result = await limiter.check_rate_limit(request, current_user.id, cost)
+                if not result:
+                    raise RateLimitExceeded(result.reset_time.isoformat(), result.headers())
+                result.apply(response)
+                return result
+
+            self._dependency = check
+        return self._dependency
+
+    async def _cost_of(self, request: Request) -> int:
+        if not callable(self.cost):
+            return self.cost
+        cost = self.cost(request)
+        if inspect.isawaitable(cost):
+            cost = await cost
+        return int(cost)
+
+    def _scope_of(self, request: Request) -> str:
+        """Without an explicit scope each route gets its own budget."""
+        if self.scope:
+            return self.scope
+        endpoint = request.scope.get("endpoint")
+        return f"{endpoint.__module__}.{endpoint.__name__}" if endpoint else request.url.path
+
+    def __call__(self, func: Callable) -> Callable:
+        """Decorate an endpoint so the limit is checked before it runs."""
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            kwargs.pop(RATE_LIMIT_PARAM, None)
+            return await func(*args, **kwargs)
+
+        # Add the check as the first keyword-only dependency so it runs before
+        # the endpoint's own (and usually more expensive) dependencies
+        signature = inspect.signature(func)
+        parameters = list(signature.parameters.values())
+        position = next(
+            (i for i, p in enumerate(parameters) if p.kind in (p.KEYWORD_ONLY, p.VAR_KEYWORD)),
+            len(parameters),
+        )
+        parameters.insert(position, inspect.Parameter(
+            RATE_LIMIT_PARAM,
+            inspect.Parameter.KEYWORD_ONLY,
+            default=Depends(self.dependency),
+            annotation=Optional[RateLimitResult],
+        ))
+        wrapper.__signature__ = signature.replace(parameters=parameters)
+        return wrapper
+
+def rate_limit(max_requests: int, window_seconds: int = 60, cost: Cost = 1, scope: Optional[str] = None) -> RouteRateLimit:
+    """
+    Limit a route to `max_requests` cost units per `window_seconds`; 0 disables the limit.
+
+        @router.post("/analyze")
+        @rate_limit(max_requests=1000, window_seconds=3600, cost=20, scope="api")
+
+    `cost` may also be a function of the request returning the units to spend.
+    Routes can also be guarded without decorating them, as a dependency:
+    `dependencies=[Depends(rate_limit(...).dependency)]`.
+    """
+    return RouteRateLimit(max_requests, window_seconds, cost, scope)
+
+def token_subject(request: Request) -> Optional[str]:
+    """Get the subject of a valid bearer token without touching the database."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return decode_token(token)
+
+class RateLimitMiddleware:
+    """
+    Applies RATE_LIMIT_POLICIES before routing, so a throttled request is
+    rejected before any dependency opens a session or loads the user.
+
+    Requests are keyed by client IP and the subject of a valid bearer token;
+    anything else counts as anonymous for its IP.
+    """
+
+    def __init__(self, app: ASGIApp, redis_client: Optional[Redis] = None):
+        self.app = app
         self.redis = redis_client
-        self.rate_limit = int(os.getenv("RATE_LIMIT", "100"))  # requests per minute
-        self.window = 60  # 1 minute window
-
-    async def check_rate_limit(self, request: Request, user_id: Optional[int] = None) -> bool:
-        # Get client IP
-        client_ip = request.client.host
-        
-        # Create a unique key for the client
-        key = f"rate_limit:{client_ip}:{user_id if user_id else 'anonymous'}"
-        
-        # Get current count
-        current = self.redis.get(key)
-        
-        if current is None:
-            # First request in window
-            self.redis.setex(key, self.window, 1)
-            return True
-            
-        current_count = int(current)
-        
-        if current_count >= self.rate_limit:
-            # Rate limit exceeded
-            return False
-            
-        # Increment counter
-        self.redis.incr(key)
-        return True
-
-    def get_remaining_requests(self, request: Request, user_id: Optional[int] = None) -> int:
-        key = f"rate_limit:{request.client.host}:{user_id if user_id else 'anonymous'}"
-        current = self.redis.get(key)
-        
-        if current is None:
-            return self.rate_limit
-            
-        return max(0, self.rate_limit - int(current))
-
-    def get_reset_time(self, request: Request, user_id: Optional[int] = None) -> datetime:
-        key = f"rate_limit:{request.client.host}:{user_id if user_id else 'anonymous'}"
-        ttl = self.redis.ttl(key)
-        
-        if ttl <= 0:
-            return datetime.utcnow()
-            
-        return datetime.utcnow() + timedelta(seconds=ttl) 
\ No newline at end of file
+
+    def _policy(self, method: str, path: str) -> Optional[RateLimitPolicy]:
+        """Find the first policy matching a request."""
+        if not path.startswith(settings.API_V1_PREFIX):
+            return None
+        path = path[len(settings.API_V1_PREFIX):]
+        for policy in settings.RATE_LIMIT_POLICIES:
+            if path.startswith(policy.path) and (not policy.methods or method in policy.methods):
+                return policy
+        return None
+
+    async def _check(self, request: Request, policy: RateLimitPolicy) -> RateLimitResult:
+        limiter = RateLimiter(
+            self.redis or get_redis_client(),
+            policy.limit or settings.RATE_LIMIT_REQUESTS,
+            policy.window or settings.RATE_LIMIT_PERIOD,
+            policy.scope,
+        )
+        user_id = token_subject(request)
+        if policy.leased:
+            return await limiter.check_leased(request, user_id, policy.cost)
+        return await limiter.check_rate_limit(request, user_id, policy.cost)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not settings.RATE_LIMIT_MIDDLEWARE_ENABLED or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        policy = self._policy(scope["method"], scope["path"])
+        if policy is None:
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        try:
+            result = await self._check(request, policy)
+        except Exception:
+            # Fail open: an unreachable Redis shouldn't take the API down with it
+            await self.app(scope, receive, send)
+            return
+
+        headers = result.headers()
+        if not result:
+            response = JSONResponse(
+                status_code=429,
+                content={"detail": {"message": "Rate limit exceeded", "reset_time": result.reset_time.isoformat()}},
+                headers=headers,
+            )
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).update(headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
\ No newline at end of file
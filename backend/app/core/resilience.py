@@ -0,0 +1,204 @@
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from app.core.config import settings
+from app.core.monitoring import OPENAI_CIRCUIT_STATE, OPENAI_CONCURRENCY_LIMIT, OPENAI_RETRIES
+
+T = TypeVar("T")
+
+# Errors that indicate the upstream itself is degraded; together with 429s these are
+# retried, anything else (bad request, auth) fails immediately
+UPSTREAM_FAILURES = (APITimeoutError, APIConnectionError, InternalServerError)
+
+class CircuitOpenError(Exception):
+    """Raised when the circuit breaker is rejecting calls."""
+
+class _Slot:
+    """Outcome of a single call made under the concurrency limiter."""
+
+    def __init__(self) -> None:
+        self.throttled = False
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD concurrency limit: grows by one per limit's worth of fast successes and
+    halves on throttling or latency above the target.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        latency_target: float,
+        decrease_factor: float = 0.5,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self._condition: Optional[asyncio.Condition] = None
+        OPENAI_CONCURRENCY_LIMIT.set(self.limit)
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Created lazily so it binds to the loop that actually runs the calls
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[_Slot]:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        slot = _Slot()
+        started = time.monotonic()
+        succeeded = False
+        try:
+            yield slot
+            succeeded = not slot.throttled
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                if slot.throttled:
+                    self._decrease()
+                elif succeeded:
+                    if time.monotonic() - started > self.latency_target:
+                        self._decrease()
+                    else:
+                        self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+                OPENAI_CONCURRENCY_LIMIT.set(self.limit)
+                self.condition.notify_all()
+
+    def _decrease(self) -> None:
+        self.limit = max(self.limit * self.decrease_factor, self.min_limit)
+
+class CircuitBreaker:
+    """
+    Fails fast after consecutive upstream failures, then lets a single trial
+    call through once the recovery timeout has passed.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._set_state(self.CLOSED)
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may go through now."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                raise CircuitOpenError("OpenAI is unavailable, failing fast")
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self.trial_in_flight:
+                raise CircuitOpenError("OpenAI is recovering, failing fast")
+            self.trial_in_flight = True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def record_neutral(self) -> None:
+        """Release a half-open trial whose outcome says nothing about upstream health."""
+        if self.state == self.HALF_OPEN:
+            self.trial_in_flight = False
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        self.trial_in_flight = False
+        OPENAI_CIRCUIT_STATE.set({self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[state])
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """
+    Full-jitter exponential backoff, never shorter than the server's Retry-After.
+    """
+    delay = random.uniform(0, min(settings.OPENAI_RETRY_MAX_DELAY, settings.OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+    if isinstance(error, APIStatusError):
+        headers = error.response.headers
+        try:
+            if "retry-after-ms" in headers:
+                delay = max(delay, float(headers["retry-after-ms"]) / 1000)
+            elif "retry-after" in headers:
+                delay = max(delay, float(headers["retry-after"]))
+        except ValueError:
+            pass
+    return delay
+
+class OpenAIGuard:
+    """
+    Runs OpenAI requests under the concurrency limiter and circuit breaker,
+    retrying throttling and transient upstream errors.
+    """
+
+    def __init__(self, limiter: AdaptiveConcurrencyLimiter, breaker: CircuitBreaker, max_retries: int):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.max_retries = max_retries
+
+    async def call(self, request: Callable[[], Awaitable[T]]) -> T:
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            async with self.limiter.slot() as slot:
+                try:
+                    result = await request()
+                except RateLimitError as e:
+                    slot.throttled = True
+                    self.breaker.record_neutral()
+                    error: Exception = e
+                except UPSTREAM_FAILURES as e:
+                    self.breaker.record_failure()
+                    error = e
+                except BaseException:
+                    self.breaker.record_neutral()
+                    raise
+                else:
+                    self.breaker.record_success()
+                    return result
+
+            if attempt >= self.max_retries:
+                raise error
+            OPENAI_RETRIES.labels(reason=type(error).__name__).inc()
+            await asyncio.sleep(retry_delay(attempt, error))
+            attempt += 1
+
+# One guard per worker process, shared by every OpenAI call
+openai_guard = OpenAIGuard(
+    limiter=AdaptiveConcurrencyLimiter(
+        initial_limit=settings.OPENAI_CONCURRENCY_INITIAL,
+        min_limit=settings.OPENAI_CONCURRENCY_MIN,
+        max_limit=settings.OPENAI_CONCURRENCY_MAX,
+        latency_target=settings.OPENAI_LATENCY_TARGET,
+    ),
+    breaker=CircuitBreaker(
+        failure_threshold=settings.OPENAI_BREAKER_FAILURE_THRESHOLD,
+        recovery_timeout=settings.OPENAI_BREAKER_RECOVERY_TIMEOUT,
+    ),
+    max_retries=settings.OPENAI_MAX_RETRIES,
+)
@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from typing import Any, Union, Optional
+from fastapi import Request
 from jose import jwt
 from passlib.context import CryptContext
 from app.core.config import settings
@@ -35,4 +36,11 @@ def decode_token(token: str) -> Optional[str]:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         return payload["sub"]
     except jwt.JWTError:
-        return None 
\ No newline at end of file
+        return None
+
+def get_client_ip(request: Request) -> Optional[str]:
+    """Get the client IP, preferring the first X-Forwarded-For hop."""
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if forwarded_for:
+        return forwarded_for.split(",")[0].strip()
+    return request.client.host if request.client else None
\ No newline at end of file
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import List, Optional
+from redis.asyncio import Redis
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from app.core.config import settings
+from app.core.monitoring import USAGE_ERRORS, USAGE_FLUSHED, USAGE_QUOTA_REJECTIONS
+from app.db.session import SessionLocal
+from app.models.usage import UsageRecord
+
+logger = logging.getLogger(__name__)
+
+# Metered resources
+ANALYSIS_USAGE = "email_analysis"
+ICP_USAGE = "icp"
+
+DEFAULT_PLAN = "free"
+# Counters that changed since the last flush, as "{period}:{resource}:{user_id}"
+DIRTY_KEY = "usage:dirty"
+# Counters outlive their month so late increments are still flushed
+COUNTER_TTL = 40 * 86400
+
+# Checks the quota and increments in one step, so concurrent requests can't both
+# take the last unit. A missing counter is only created from a seed read from
+# Postgres, so an evicted counter never restarts the month at zero.
+# KEYS: counter, dirty set
+# ARGV: quota (-1 for none), amount, counter TTL, dirty set member, seed ("" for none)
+# Returns {1, count} when allowed, {0, count} when over quota, {-1, 0} when a seed is needed
+USAGE_SCRIPT = """
+local count = redis.call("GET", KEYS[1])
+if not count then
+    if ARGV[5] == "" then
+        return {-1, 0}
+    end
+    count = ARGV[5]
+    redis.call("SET", KEYS[1], count, "EX", ARGV[3])
+end
+count = tonumber(count)
+local quota = tonumber(ARGV[1])
+local amount = tonumber(ARGV[2])
+if quota >= 0 and amount > 0 and count + amount > quota then
+    return {0, count}
+end
+count = redis.call("INCRBY", KEYS[1], amount)
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+redis.call("SADD", KEYS[2], ARGV[4])
+return {1, count}
+"""
+
+def current_period(now: Optional[datetime] = None) -> str:
+    """Get the billing month of a moment, e.g. "2024-03"."""
+    return (now or datetime.utcnow()).strftime("%Y-%m")
+
+def next_period_start(now: Optional[datetime] = None) -> datetime:
+    """Get the moment the current month's quotas reset."""
+    now = now or datetime.utcnow()
+    if now.month == 12:
+        return datetime(now.year + 1, 1, 1)
+    return datetime(now.year, now.month + 1, 1)
+
+def quota_for(plan: Optional[str], resource: str) -> Optional[int]:
+    """Get a plan's monthly quota for a resource, None when unlimited."""
+    quotas = settings.PLAN_QUOTAS
+    return quotas.get(plan or DEFAULT_PLAN, quotas[DEFAULT_PLAN]).get(resource)
+
+@dataclass
+class UsageResult:
+    """Outcome of metering a request, truthy when it fits the quota."""
+    allowed: bool
+    resource: str
+    used: int
+    quota: Optional[int]
+
+    def __bool__(self) -> bool:
+        return self.allowed
+
+    @property
+    def reset_time(self) -> datetime:
+        return next_period_start()
+
+class UsageMeter:
+    """
+    Enforces monthly plan quotas with Redis counters.
+
+    Every check is one EVALSHA; Postgres is only read to seed a counter that
+    isn't in Redis, and written by `flush_usage` in the background.
+    """
+
+    def __init__(self, redis_client: Redis):
+        self.redis = redis_client
+        self.script = redis_client.register_script(USAGE_SCRIPT)
+
+    def _keys(self, user_id: int, resource: str) -> List[str]:
+        member = f"{current_period()}:{resource}:{user_id}"
+        return [f"usage:{member}", DIRTY_KEY, member]
+
+    async def consume(self, db: Session, user_id: int, plan: Optional[str], resource: str, amount: int = 1) -> UsageResult:
+        """Count `amount` units against the user's monthly quota unless it would be exceeded."""
+        quota = quota_for(plan, resource)
+        counter_key, dirty_key, member = self._keys(user_id, resource)
+        args = [-1 if quota is None else quota, amount, COUNTER_TTL, member, ""]
+        allowed, used = await self.script(keys=[counter_key, dirty_key], args=args)
+        if int(allowed) == -1:
+            # Not in Redis this month: seed from the flushed row, not a count of analyses
+            period = member.split(":")[0]
+            args[-1] = db.query(UsageRecord.count).filter(
+                UsageRecord.user_id == user_id,
+                UsageRecord.period == period,
+                UsageRecord.resource == resource
+            ).scalar() or 0
+            allowed, used = await self.script(keys=[counter_key, dirty_key], args=args)
+        if not int(allowed):
+            USAGE_QUOTA_REJECTIONS.labels(resource=resource, plan=plan or DEFAULT_PLAN).inc()
+        return UsageResult(allowed=bool(int(allowed)), resource=resource, used=int(used), quota=quota)
+
+    async def refund(self, user_id: int, resource: str, amount: int = 1) -> None:
+        """Give back units consumed by a request that failed; best effort."""
+        counter_key, dirty_key, member = self._keys(user_id, resource)
+        try:
+            # Without a seed a missing counter stays missing, as there's nothing to give back
+            await self.script(keys=[counter_key, dirty_key], args=[-1, -amount, COUNTER_TTL, member, ""])
+        except Exception:
+            USAGE_ERRORS.labels(operation="refund").inc()
+            logger.exception("Failed to refund %s %s unit(s) to user %s", amount, resource, user_id)
+
+def usage_upsert(rows: List[dict]):
+    """
+    Build the upsert of absolute counts. A row is only replaced by a count read
+    later than its own, so a slow flusher can't overwrite a newer count.
+    """
+    statement = insert(UsageRecord).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=[UsageRecord.user_id, UsageRecord.period, UsageRecord.resource],
+        set_={"count": statement.excluded.count, "counted_at": statement.excluded.counted_at, "updated_at": func.now()},
+        where=UsageRecord.counted_at < statement.excluded.counted_at
+    )
+
+def _write_usage(rows: List[dict]) -> None:
+    """Upsert absolute counts, so writing the same counter twice is harmless."""
+    db = SessionLocal()
+    try:
+        db.execute(usage_upsert(rows))
+        db.commit()
+    finally:
+        db.close()
+
+async def flush_usage(redis_client: Redis) -> int:
+    """
+    Write one batch of changed usage counters to Postgres.
+
+    SPOP hands each counter to a single worker; counters that fail to write,
+    including when the flush is cancelled, are marked dirty again for the next
+    flush. Returns how many changed counters were taken, so callers can keep
+    going while batches are full.
+    """
+    members = await redis_client.spop(DIRTY_KEY, settings.USAGE_FLUSH_BATCH_SIZE)
+    if not members:
+        return 0
+    try:
+        # Read the counts with Redis' clock in one transaction, so the time orders them
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.time()
+            pipe.mget([f"usage:{member}" for member in members])
+            (seconds, microseconds), counts = await pipe.execute()
+        counted_at = datetime.fromtimestamp(seconds + microseconds / 1e6, tz=timezone.utc)
+        rows = []
+        for member, count in zip(members, counts):
+            if count is None:
+                continue
+            period, resource, user_id = member.split(":")
+            rows.append({
+                "user_id": int(user_id),
+                "period": period,
+                "resource": resource,
+                "count": int(count),
+                "counted_at": counted_at
+            })
+        if rows:
+            # The session is synchronous, so keep it off the event loop
+            await asyncio.to_thread(_write_usage, rows)
+    except BaseException:
+        await redis_client.sadd(DIRTY_KEY, *members)
+        raise
+    USAGE_FLUSHED.inc(len(rows))
+    return len(members)
+
+async def flush_all_usage(redis_client: Redis) -> None:
+    """
+    Flush usage counters until a batch comes back partly empty. Failures are
+    logged and counted; their counters stay dirty for the next flush.
+    """
+    try:
+        while await flush_usage(redis_client) >= settings.USAGE_FLUSH_BATCH_SIZE:
+            pass
+    except Exception:
+        USAGE_ERRORS.labels(operation="flush").inc()
+        logger.exception("Failed to flush usage counters")
+
+async def flush_usage_periodically(redis_client: Redis) -> None:
+    """
+    Flush usage counters every USAGE_FLUSH_INTERVAL seconds until cancelled.
+    """
+    while True:
+        await asyncio.sleep(settings.USAGE_FLUSH_INTERVAL)
+        await flush_all_usage(redis_client)
\ No newline at end of file
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from app.core.cache import CacheService
+from app.core.config import settings
+from app.core.monitoring import CACHE_WARM_FAILURES
+from app.db.redis import get_redis_client
+from app.db.session import SessionLocal
+from app.models.email_analysis import EmailAnalysis
+from app.models.icp import ICP
+from app.models.subscription import Subscription
+from app.schemas.email_analysis import EmailAnalysisList
+from app.schemas.icp import ICP as ICPSchema
+from app.schemas.subscription import Entitlement
+
+logger = logging.getLogger(__name__)
+
+# Only one worker warms on startup; the others see the lock and skip
+WARM_LOCK_KEY = "cache_warm_lock"
+WARM_LOCK_TTL = 300  # seconds
+
+def load_entitlement(db: Session, user_id: int) -> Entitlement:
+    """Load a user's entitlement from their subscription."""
+    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
+    return Entitlement.model_validate(subscription) if subscription else Entitlement()
+
+def load_recent_analyses(db: Session, user_id: int) -> List[dict]:
+    """Load a user's most recent email analyses in their list form."""
+    analyses = db.query(EmailAnalysis).filter(
+        EmailAnalysis.user_id == user_id
+    ).order_by(EmailAnalysis.created_at.desc()).limit(settings.RECENT_ANALYSES_LIMIT).all()
+    return [EmailAnalysisList.model_validate(analysis).model_dump(mode="json") for analysis in analyses]
+
+def load_icp_ids(user_id: int) -> List[int]:
+    """Load the ordered ids of a user's ICPs in a session of its own."""
+    db = SessionLocal()
+    try:
+        return [
+            icp_id for (icp_id,) in
+            db.query(ICP.id).filter(ICP.user_id == user_id).order_by(ICP.id).all()
+        ]
+    finally:
+        db.close()
+
+def load_user_data(user_id: int, icp_ids: List[int]) -> Tuple[List[dict], dict, List[dict]]:
+    """Load the given ICPs, entitlement and recent analyses of a user in a session of its own."""
+    db = SessionLocal()
+    try:
+        icps = []
+        if icp_ids:
+            # Dumped while the session is open, as the responses load lazily
+            icps = [
+                ICPSchema.model_validate(icp).model_dump(mode="json")
+                for icp in db.query(ICP).filter(ICP.id.in_(icp_ids)).all()
+            ]
+        return icps, load_entitlement(db, user_id).model_dump(), load_recent_analyses(db, user_id)
+    finally:
+        db.close()
+
+def load_active_user_ids() -> List[int]:
+    """Load the users with the most analyses in the recent activity window."""
+    db = SessionLocal()
+    try:
+        since = datetime.utcnow() - timedelta(days=settings.CACHE_WARM_ACTIVE_DAYS)
+        return [
+            user_id for (user_id,) in
+            db.query(EmailAnalysis.user_id)
+            .filter(EmailAnalysis.created_at >= since)
+            .group_by(EmailAnalysis.user_id)
+            .order_by(func.count(EmailAnalysis.id).desc())
+            .limit(settings.CACHE_WARM_USER_COUNT)
+            .all()
+        ]
+    finally:
+        db.close()
+
+async def warm_user_cache(user_id: int) -> None:
+    """
+    Prefetch what the dashboard reads first: the user's ICPs, entitlement
+    and recent analyses. Best effort; failures leave the cache cold.
+    """
+    cache_service = CacheService(get_redis_client())
+    try:
+        # The session is synchronous, so queries run in threads and only Redis stays on the loop
+        icp_ids = await asyncio.to_thread(load_icp_ids, user_id)
+        await cache_service.set_user_icp_ids(user_id, icp_ids)
+        # The default page of the ICP list
+        page_ids = icp_ids[:100]
+        cached = await cache_service.get_icps(page_ids)
+        missing_ids = [icp_id for icp_id in page_ids if icp_id not in cached]
+        icps, entitlement, recent_analyses = await asyncio.to_thread(load_user_data, user_id, missing_ids)
+
+        if icps:
+            await cache_service.set_icps(icps)
+        await cache_service.set_entitlement(user_id, entitlement)
+        await cache_service.set_recent_analyses(user_id, recent_analyses)
+    except Exception:
+        CACHE_WARM_FAILURES.labels(stage="user").inc()
+        logger.exception("Cache warm-up failed for user %s", user_id)
+
+async def warm_active_users() -> None:
+    """
+    Warm the cache for the users with the most analyses in the recent activity window.
+    """
+    redis_client = get_redis_client()
+    try:
+        if not await redis_client.set(WARM_LOCK_KEY, 1, nx=True, ex=WARM_LOCK_TTL):
+            return
+        user_ids = await asyncio.to_thread(load_active_user_ids)
+    except Exception:
+        CACHE_WARM_FAILURES.labels(stage="active_users").inc()
+        logger.exception("Cache warm-up could not load active users")
+        return
+
+    for user_id in user_ids:
+        await warm_user_cache(user_id)
+        # Let request handling interleave with the warm-up
+        await asyncio.sleep(0)
\ No newline at end of file
@@ -0,0 +1,30 @@
+from typing import Dict
+from redis.asyncio import ConnectionPool, Redis
+from app.core.config import settings
+
+# Connection pools per worker process, created by the application lifespan and keyed by
+# whether responses are decoded; binary cache payloads need undecoded connections
+_pools: Dict[bool, ConnectionPool] = {}
+
+def init_redis_pool(decode_responses: bool = True) -> ConnectionPool:
+    """Create a shared async Redis connection pool."""
+    if decode_responses not in _pools:
+        _pools[decode_responses] = ConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            health_check_interval=30,
+            decode_responses=decode_responses,
+        )
+    return _pools[decode_responses]
+
+async def close_redis_pool() -> None:
+    """Disconnect every connection in the shared pools."""
+    while _pools:
+        _, pool = _pools.popitem()
+        await pool.disconnect()
+
+def get_redis_client(decode_responses: bool = True) -> Redis:
+    """Get a client backed by a shared pool; cheap to create per request."""
+    return Redis(connection_pool=init_redis_pool(decode_responses))
\ No newline at end of file
@@ -1,16 +1,53 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from app.core.config import settings
 from app.api.v1.api import api_router
+from app.core.openai import init_openai_client, close_openai_client
+from app.core.cache import listen_for_invalidations
+from app.core.warmup import warm_active_users
+from app.core.monitoring import collect_cache_telemetry
+from app.core.rate_limit import RateLimitMiddleware
+from app.core.usage import flush_all_usage, flush_usage_periodically
+from app.db.redis import init_redis_pool, close_redis_pool, get_redis_client
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared clients are created once per worker and closed on shutdown
+    init_openai_client()
+    init_redis_pool()
+    init_redis_pool(decode_responses=False)
+    background_tasks = [asyncio.create_task(listen_for_invalidations(get_redis_client()))]
+    if settings.CACHE_TELEMETRY_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(collect_cache_telemetry(get_redis_client())))
+    if settings.CACHE_WARM_ON_STARTUP:
+        background_tasks.append(asyncio.create_task(warm_active_users()))
+    if settings.USAGE_FLUSH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(flush_usage_periodically(get_redis_client())))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    # Let cancelled tasks finish cleaning up, e.g. re-marking an interrupted flush dirty,
+    # before the final flush and closing the pools they use
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # Write what changed since the last periodic flush
+    await flush_all_usage(get_redis_client())
+    await close_redis_pool()
+    await close_openai_client()
 
 app = FastAPI(
     title=settings.APP_NAME,
+    lifespan=lifespan,
     openapi_url=f"{settings.API_V1_PREFIX}/openapi.json",
     docs_url=f"{settings.API_V1_PREFIX}/docs",
     redoc_url=f"{settings.API_V1_PREFIX}/redoc",
 )
 
+# Reject throttled requests before routing; added first so CORS still wraps its 429s
+app.add_middleware(RateLimitMiddleware)
+
 # Set up CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -4,6 +4,7 @@ from app.models.icp import ICP, ICPResponse
 from app.models.email_analysis import EmailAnalysis
 from app.models.subscription import Subscription
 from app.models.audit_log import AuditLog
+from app.models.usage import UsageRecord
 
 # For type checking
 __all__ = [
@@ -14,4 +15,5 @@ __all__ = [
     "EmailAnalysis",
     "Subscription",
     "AuditLog",
+    "UsageRecord",
 ] 
\ No newline at end of file
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, func
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, func, JSON
 from sqlalchemy.orm import relationship
 from app.models.base import Base
 
@@ -8,8 +8,9 @@ class EmailAnalysis(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    icp_id = Column(Integer, ForeignKey("icps.id", ondelete="CASCADE"), index=True)
     email_content = Column(Text, nullable=False)
-    analysis_result = Column(Text)
+    analysis_result = Column(JSON)
     sentiment_score = Column(Integer)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
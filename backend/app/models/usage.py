@@ -0,0 +1,19 @@
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, UniqueConstraint, func
+from app.models.base import Base
+
+class UsageRecord(Base):
+    __tablename__ = "usage_records"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    period = Column(String, nullable=False)  # billing month, e.g. "2024-03"
+    resource = Column(String, nullable=False)  # email_analysis, icp
+    count = Column(Integer, nullable=False, default=0)
+    counted_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())  # Redis time the count was read
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    # Indexes
+    __table_args__ = (
+        UniqueConstraint('user_id', 'period', 'resource', name='uq_usage_user_period_resource'),
+    )
\ No newline at end of file
@@ -1,6 +1,7 @@
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Annotated
 from pydantic import BaseModel, Field
+from app.core.config import settings
 
 class EmailAnalysisBase(BaseModel):
     email_content: str = Field(..., min_length=10)
@@ -9,6 +10,10 @@ class EmailAnalysisBase(BaseModel):
 class EmailAnalysisCreate(EmailAnalysisBase):
     pass
 
+class EmailAnalysisBatchCreate(BaseModel):
+    icp_id: int
+    email_contents: List[Annotated[str, Field(min_length=10)]] = Field(..., min_length=1, max_length=settings.ANALYSIS_BATCH_MAX_SIZE)
+
 class EmailAnalysisResponse(EmailAnalysisBase):
     id: int
     user_id: int
@@ -30,10 +35,20 @@ class EmailAnalysisList(BaseModel):
     class Config:
         from_attributes = True
 
+class EmailAnalysisJob(BaseModel):
+    job_id: str
+    status: str
+    analysis: Optional[EmailAnalysisResponse] = None
+    error: Optional[str] = None
+
 class EmailAnalysisFeedback(BaseModel):
-    strengths: list[str]
-    weaknesses: list[str]
-    improvement_suggestions: list[str]
-    icp_alignment_score: float
-    persona_match_score: float
-    pain_point_addressal: Dict[str, Any] 
\ No newline at end of file
+    strengths: list[str] = Field(..., description="Key strengths of the email")
+    weaknesses: list[str] = Field(..., description="Areas for improvement")
+    improvement_suggestions: list[str] = Field(..., description="Specific suggestions for better alignment with the ICP")
+    icp_alignment_score: float = Field(..., ge=0, le=100, description="Overall resonance with the ICP (0-100)")
+    persona_match_score: float = Field(..., ge=0, le=100, description="How well the email speaks to the target persona (0-100)")
+    pain_point_addressal: Dict[str, Any] = Field(
+        ...,
+        description='Pain point coverage as {"score": 0-100, "addressed": [...], "missed": [...]}'
+    )
+    suggested_rewrite: Optional[str] = Field(None, description="A rewrite that better aligns with the ICP")
\ No newline at end of file
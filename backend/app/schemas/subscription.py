@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+
+class Entitlement(BaseModel):
+    """What a user's subscription allows, as cached for request-time checks."""
+    plan_name: str = "free"
+    is_active: bool = False
+
+    @property
+    def quota_plan(self) -> str:
+        """The plan whose quotas apply; lapsed subscriptions fall back to free."""
+        return self.plan_name if self.is_active else "free"
+
+    class Config:
+        from_attributes = True
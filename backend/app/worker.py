@@ -0,0 +1,69 @@
+import asyncio
+from typing import Optional
+from app.core.celery_app import celery_app
+from app.core.config import settings
+from app.core.cache import CacheService
+from app.core.openai import analyze_email_cached
+from app.core.usage import ANALYSIS_USAGE, UsageMeter
+from app.db.redis import get_redis_client
+from app.db.session import SessionLocal
+from app.models.email_analysis import EmailAnalysis
+from app.models.icp import ICP
+
+# A long-lived loop keeps the shared OpenAI client's connection pool usable across tasks
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def run_async(coro):
+    """Run a coroutine on the worker's persistent event loop."""
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coro)
+
+@celery_app.task(name="email_analysis.analyze")
+def analyze_email_task(user_id: int, icp_id: int, email_content: str, plan: Optional[str] = None) -> dict:
+    """
+    Analyze an email in the background and persist the EmailAnalysis record.
+
+    The analysis was counted against the user's quota when it was queued, so
+    a task that fails before saving its result gives the unit back.
+    """
+    db = SessionLocal()
+    saved = False
+    try:
+        icp = db.query(ICP).filter(
+            ICP.id == icp_id,
+            ICP.user_id == user_id
+        ).first()
+        if not icp:
+            raise ValueError(f"ICP with ID {icp_id} not found")
+
+        cache_service = CacheService(get_redis_client())
+        analysis_result = run_async(analyze_email_cached(
+            email_content=email_content,
+            icp=icp,
+            cache_service=cache_service,
+            plan=plan
+        ))
+
+        db_analysis = EmailAnalysis(
+            user_id=user_id,
+            icp_id=icp_id,
+            email_content=email_content,
+            analysis_result=analysis_result,
+            sentiment_score=analysis_result.get("sentiment_score"),
+        )
+        db.add(db_analysis)
+        db.commit()
+        db.refresh(db_analysis)
+        saved = True
+        run_async(cache_service.invalidate_recent_analyses(user_id))
+        run_async(cache_service.clear_missing("email_analysis", user_id, db_analysis.id))
+
+        return {"analysis_id": db_analysis.id}
+    except Exception:
+        if not saved:
+            run_async(UsageMeter(get_redis_client()).refund(user_id, ANALYSIS_USAGE))
+        raise
+    finally:
+        db.close()
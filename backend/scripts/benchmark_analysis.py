@@ -0,0 +1,98 @@
+"""
+Drive the email analysis endpoint at a fixed concurrency and report latency
+percentiles and throughput:
+
+    python -m scripts.benchmark_analysis --token $TOKEN --icp-id 1 --concurrency 20 --requests 500
+
+Pair it with scripts/fake_openai.py to measure capacity without real OpenAI calls.
+Pass --unique-emails to defeat the analysis result cache.
+
+The analysis routes are rate limited and metered, so start the API with
+ANALYSIS_RATE_LIMIT=0 and use a user whose plan has no analysis quota (or
+raise PLAN_QUOTAS); otherwise most requests are fast 429s or 403s. Latency
+percentiles only cover successful responses.
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+from typing import List
+import httpx
+
+SAMPLE_EMAIL = (
+    "Hi Sam, I noticed your engineering team doubled this year. "
+    "We help CTOs keep deploys fast while headcount grows. "
+    "Would a 15 minute call next week be useful?"
+)
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+async def run(args: argparse.Namespace) -> None:
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    latencies: List[float] = []  # successful responses only
+    statuses: Counter = Counter()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(
+        base_url=args.base_url,
+        headers={"Authorization": f"Bearer {args.token}"},
+        limits=limits,
+        timeout=args.timeout,
+    ) as client:
+
+        async def worker() -> None:
+            while True:
+                try:
+                    i = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                email = f"{SAMPLE_EMAIL} (variant {i})" if args.unique_emails else SAMPLE_EMAIL
+                started = time.perf_counter()
+                try:
+                    response = await client.post(args.path, json={"icp_id": args.icp_id, "email_content": email})
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                    continue
+                # Rejections (429, 403) return fast and would hide the analysis latency
+                if response.is_success:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    total = sum(statuses.values())
+    succeeded = len(latencies)
+    print(f"requests:    {total} in {elapsed:.2f}s at concurrency {args.concurrency}")
+    print(f"throughput:  {total / elapsed:.2f} req/s ({succeeded / elapsed:.2f} successful req/s)")
+    print(f"latency of {succeeded} successful responses:")
+    print(f"latency p50: {percentile(latencies, 50) * 1000:.0f} ms")
+    print(f"latency p95: {percentile(latencies, 95) * 1000:.0f} ms")
+    print(f"latency p99: {percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"statuses:    {dict(statuses)}")
+    if statuses[429] or statuses[403]:
+        print("warning:     requests were rate limited or over quota; see the module docstring")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the email analysis endpoint.")
+    parser.add_argument("--base-url", default="http://localhost:8000/api/v1")
+    parser.add_argument("--path", default="/email-analysis/analyze")
+    parser.add_argument("--token", required=True, help="bearer token of a user with an active subscription")
+    parser.add_argument("--icp-id", type=int, required=True)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--unique-emails", action="store_true", help="send a distinct email per request")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Serves canned structured analyses with configurable latency, streaming pace
+and 429 injection, so the analysis path can be exercised without real calls:
+
+    python -m scripts.fake_openai --port 8001 --latency-median 2.0 --rate-limit-ratio 0.05
+
+Then start the API with OPENAI_BASE_URL=http://localhost:8001/v1.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Optional
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CANNED_ANALYSIS: Dict[str, Any] = {
+    "strengths": ["Clear call to action", "Concise subject line"],
+    "weaknesses": ["Generic opening line", "No reference to the prospect's pain points"],
+    "improvement_suggestions": [
+        "Open with a specific scaling challenge the persona faces",
+        "Quantify the outcome customers achieved",
+    ],
+    "icp_alignment_score": 68,
+    "persona_match_score": 72,
+    "pain_point_addressal": {"score": 55, "addressed": ["Efficiency"], "missed": ["Scaling issues"]},
+    "suggested_rewrite": "Hi Sam, teams like yours often hit scaling limits around 50 engineers...",
+}
+
+@dataclass
+class FakeOpenAIConfig:
+    latency_median: float = 1.0  # seconds until the first token, log-normally distributed
+    latency_sigma: float = 0.5
+    tokens_per_second: float = 50.0  # streaming pace after the first token
+    rate_limit_ratio: float = 0.0  # share of requests answered with 429
+    retry_after: float = 1.0  # seconds, sent with injected 429s
+    analysis: Optional[Dict[str, Any]] = None  # overrides CANNED_ANALYSIS
+
+    def sample_latency(self) -> float:
+        if self.latency_median <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+
+def _estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / 4)
+
+def _tool_name(body: Dict[str, Any]) -> Optional[str]:
+    tools = body.get("tools") or []
+    return tools[0]["function"]["name"] if tools else None
+
+def create_app(config: Optional[FakeOpenAIConfig] = None) -> FastAPI:
+    """Create the stand-in app."""
+    config = config or FakeOpenAIConfig()
+    app = FastAPI(title="Fake OpenAI")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if random.random() < config.rate_limit_ratio:
+            return JSONResponse(
+                status_code=429,
+                content={"error": {"message": "Rate limit reached (injected)", "type": "requests", "code": "rate_limit_exceeded"}},
+                headers={"retry-after": str(config.retry_after)},
+            )
+
+        model = body.get("model", "gpt-4")
+        tool_name = _tool_name(body)
+        output = json.dumps(config.analysis or CANNED_ANALYSIS)
+        prompt_tokens = sum(_estimate_tokens(str(m.get("content") or "")) + 4 for m in body.get("messages", []))
+        completion_tokens = _estimate_tokens(output)
+
+        if body.get("stream"):
+            return StreamingResponse(
+                _stream_chunks(config, model, tool_name, output),
+                media_type="text/event-stream",
+            )
+
+        await asyncio.sleep(config.sample_latency() + completion_tokens / config.tokens_per_second)
+        if tool_name:
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": "call_fake",
+                    "type": "function",
+                    "function": {"name": tool_name, "arguments": output},
+                }],
+            }
+        else:
+            message = {"role": "assistant", "content": output}
+
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if tool_name else "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    return app
+
+async def _stream_chunks(
+    config: FakeOpenAIConfig,
+    model: str,
+    tool_name: Optional[str],
+    output: str,
+) -> AsyncIterator[str]:
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+        payload = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload)}\n\n"
+
+    await asyncio.sleep(config.sample_latency())
+    if tool_name:
+        yield chunk({
+            "role": "assistant",
+            "tool_calls": [{"index": 0, "id": "call_fake", "type": "function", "function": {"name": tool_name, "arguments": ""}}],
+        })
+    else:
+        yield chunk({"role": "assistant", "content": ""})
+
+    # Roughly one token per 4 characters
+    for start in range(0, len(output), 4):
+        piece = output[start:start + 4]
+        if tool_name:
+            yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": piece}}]})
+        else:
+            yield chunk({"content": piece})
+        await asyncio.sleep(1 / config.tokens_per_second)
+
+    yield chunk({}, finish_reason="tool_calls" if tool_name else "stop")
+    yield "data: [DONE]\n\n"
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the OpenAI chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-median", type=float, default=1.0, help="median seconds until the first token")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="log-normal spread of the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--analysis-file", help="JSON file with the structured analysis to return")
+    args = parser.parse_args()
+
+    analysis = None
+    if args.analysis_file:
+        with open(args.analysis_file) as f:
+            analysis = json.load(f)
+
+    config = FakeOpenAIConfig(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+        analysis=analysis,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,16 @@
+import asyncio
 import pytest
-from app.core.cache import CacheService
+from app.core.cache import CacheService, LocalCache, local_cache
+from app.core.codec import CacheEntry
 from app.core.config import settings
-import redis
+from redis.asyncio import Redis
 import json
+import time
 
 @pytest.fixture
 def redis_client():
     """Create a test Redis client."""
-    return redis.Redis(
+    return Redis(
         host=settings.REDIS_HOST,
         port=settings.REDIS_PORT,
         db=settings.REDIS_DB,
@@ -18,24 +21,30 @@ def redis_client():
 @pytest.fixture
 def cache_service(redis_client):
     """Create a cache service instance."""
-    return CacheService(redis_client)
+    binary_client = Redis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        password=settings.REDIS_PASSWORD
+    )
+    return CacheService(redis_client, binary_client)
 
 @pytest.fixture
 def sample_icp():
-    """Create a sample ICP for testing."""
+    """Create a sample ICP for testing, shaped like the ICP response schema."""
     return {
         "id": 1,
+        "user_id": 1,
         "name": "Test ICP",
+        "description": "Technology companies scaling their engineering teams",
         "industry": "Technology",
         "company_size": "1-10",
-        "persona_title": "CTO",
-        "persona_responsibilities": "Technical leadership",
-        "pain_points": "Scaling issues",
-        "goals": "Improve efficiency",
-        "challenges": "Resource constraints",
-        "is_favorite": False
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": None,
+        "icp_responses": []
     }
 
+@pytest.mark.asyncio
 async def test_set_and_get_icp(cache_service, sample_icp):
     """Test setting and getting an ICP from cache."""
     # Set ICP in cache
@@ -46,6 +55,7 @@ async def test_set_and_get_icp(cache_service, sample_icp):
     cached_icp = await cache_service.get_icp(sample_icp["id"])
     assert cached_icp == sample_icp
 
+@pytest.mark.asyncio
 async def test_delete_icp(cache_service, sample_icp):
     """Test deleting an ICP from cache."""
     # Set ICP in cache
@@ -59,37 +69,78 @@ async def test_delete_icp(cache_service, sample_icp):
     cached_icp = await cache_service.get_icp(sample_icp["id"])
     assert cached_icp is None
 
-async def test_set_and_get_user_icps(cache_service, sample_icp):
-    """Test setting and getting user's ICPs from cache."""
+@pytest.mark.asyncio
+async def test_delete_icp_publishes_after_delete(cache_service, redis_client, sample_icp, monkeypatch):
+    """Test that peers are only told to drop an ICP once it is gone from Redis."""
+    await cache_service.set_icp(sample_icp["id"], sample_icp)
+    present_when_published = []
+
+    async def publish(key):
+        present_when_published.append(await redis_client.exists(key))
+
+    monkeypatch.setattr(cache_service, "_publish_invalidation", publish)
+    await cache_service.delete_icp(sample_icp["id"])
+
+    assert present_when_published == [0]
+
+@pytest.mark.asyncio
+async def test_set_and_get_user_icp_ids(cache_service):
+    """Test caching the ordered ICP ids of a user."""
     user_id = 1
-    icps = [sample_icp]
-    
-    # Set user's ICPs in cache
-    success = await cache_service.set_user_icps(user_id, icps)
+
+    success = await cache_service.set_user_icp_ids(user_id, [3, 1, 2])
     assert success is True
-    
-    # Get user's ICPs from cache
-    cached_icps = await cache_service.get_user_icps(user_id)
-    assert cached_icps == icps
 
-async def test_invalidate_user_icps(cache_service, sample_icp):
-    """Test invalidating all cached ICPs for a user."""
+    assert await cache_service.get_user_icp_ids(user_id) == [3, 1, 2]
+
+@pytest.mark.asyncio
+async def test_invalidate_user_icps(cache_service):
+    """Test invalidating the cached ICP id list of a user."""
     user_id = 1
-    
-    # Set multiple ICPs for user with different pagination
-    await cache_service.set_user_icps(user_id, [sample_icp], skip=0, limit=10)
-    await cache_service.set_user_icps(user_id, [sample_icp], skip=10, limit=10)
-    
+    await cache_service.set_user_icp_ids(user_id, [1, 2])
+
     # Invalidate user's ICPs
     success = await cache_service.invalidate_user_icps(user_id)
     assert success is True
-    
-    # Verify all ICPs are deleted
-    cached_icps_1 = await cache_service.get_user_icps(user_id, skip=0, limit=10)
-    cached_icps_2 = await cache_service.get_user_icps(user_id, skip=10, limit=10)
-    assert cached_icps_1 is None
-    assert cached_icps_2 is None
 
+    # Verify the id list is gone
+    assert await cache_service.get_user_icp_ids(user_id) is None
+
+@pytest.mark.asyncio
+async def test_invalidate_user_icps_bumps_generation(cache_service, redis_client, monkeypatch):
+    """Test that invalidation moves readers to a new generation without scanning for keys."""
+    user_id = time.time_ns()
+    await cache_service.set_user_icp_ids(user_id, [1, 2])
+
+    async def scan(*args, **kwargs):
+        raise AssertionError("invalidation must not scan the keyspace")
+
+    monkeypatch.setattr(redis_client, "keys", scan)
+    monkeypatch.setattr(redis_client, "scan", scan)
+    assert await cache_service.invalidate_user_icps(user_id) is True
+
+    assert await redis_client.get(f"user_icps_gen:{user_id}") == "1"
+    # The old generation is orphaned and left to its TTL
+    assert await redis_client.ttl(f"user_icps:{user_id}:0") > 0
+    assert await cache_service.get_user_icp_ids(user_id) is None
+
+    await cache_service.set_user_icp_ids(user_id, [2])
+    local_cache.delete(f"user_icps:{user_id}")
+    assert await cache_service.get_user_icp_ids(user_id) == [2]
+    assert await redis_client.exists(f"user_icps:{user_id}:1") == 1
+
+@pytest.mark.asyncio
+async def test_get_icps_resolves_hits_with_one_mget(cache_service, sample_icp):
+    """Test that cached ICPs are resolved in bulk and misses are left out."""
+    second_icp = {**sample_icp, "id": 2, "name": "Second ICP"}
+    await cache_service.delete_icp(3)
+
+    success = await cache_service.set_icps([sample_icp, second_icp])
+    assert success is True
+
+    assert await cache_service.get_icps([1, 2, 3]) == {1: sample_icp, 2: second_icp}
+
+@pytest.mark.asyncio
 async def test_cache_ttl(cache_service, sample_icp):
     """Test cache TTL functionality."""
     # Set ICP with short TTL
@@ -100,9 +151,132 @@ async def test_cache_ttl(cache_service, sample_icp):
     assert cached_icp == sample_icp
     
     # Wait for TTL to expire
-    import asyncio
     await asyncio.sleep(2)
     
     # Verify ICP is no longer in cache
     cached_icp = await cache_service.get_icp(sample_icp["id"])
-    assert cached_icp is None 
\ No newline at end of file
+    assert cached_icp is None 
+
+@pytest.mark.asyncio
+async def test_expired_icp_recomputed_by_one_request(cache_service, redis_client, sample_icp):
+    """Test that one request recomputes an expired ICP while others serve it stale."""
+    await cache_service.set_icp(sample_icp["id"], sample_icp, ttl=1)
+    await redis_client.delete(f"recompute_lock:icp:{sample_icp['id']}")
+    await asyncio.sleep(2)
+
+    # The first request takes the recompute lock and gets a miss
+    assert await cache_service.get_icp(sample_icp["id"]) is None
+    # Concurrent requests keep getting the stale value
+    other_request = CacheService(redis_client, cache_service.binary)
+    assert await other_request.get_icp(sample_icp["id"]) == sample_icp
+
+    # Writing the recomputed value releases the lock
+    await cache_service.set_icp(sample_icp["id"], sample_icp)
+    assert await redis_client.exists(f"recompute_lock:icp:{sample_icp['id']}") == 0
+
+def test_early_refresh_probability(cache_service, monkeypatch):
+    """Test that entries are refreshed early only when close to expiry relative to their compute time."""
+    now = time.time()
+    monkeypatch.setattr(settings, "CACHE_EARLY_REFRESH_BETA", 1.0)
+
+    assert cache_service._should_refresh(CacheEntry(None, expires_at=now - 1, delta=0.0)) is True
+    assert cache_service._should_refresh(CacheEntry(None, expires_at=now + 300, delta=0.0)) is False
+    refreshed = sum(
+        cache_service._should_refresh(CacheEntry(None, expires_at=now + 0.1, delta=0.5))
+        for _ in range(1000)
+    )
+    assert 600 < refreshed < 1000
+
+@pytest.mark.asyncio
+async def test_tombstones(cache_service):
+    """Test that missing resources are remembered per user until created."""
+    await cache_service.clear_missing("icp", 1, 999)
+    assert await cache_service.is_missing("icp", 1, 999) is False
+
+    assert await cache_service.mark_missing("icp", 1, 999) is True
+    assert await cache_service.is_missing("icp", 1, 999) is True
+    # Another user's lookup of the same id is unaffected
+    assert await cache_service.is_missing("icp", 2, 999) is False
+
+    assert await cache_service.clear_missing("icp", 1, 999) is True
+    assert await cache_service.is_missing("icp", 1, 999) is False
+
+@pytest.mark.asyncio
+async def test_set_and_get_entitlement(cache_service):
+    """Test caching a user's subscription entitlement."""
+    entitlement = {"plan_name": "pro", "is_active": True}
+
+    assert await cache_service.set_entitlement(1, entitlement) is True
+    assert await cache_service.get_entitlement(1) == entitlement
+
+@pytest.mark.asyncio
+async def test_invalidate_recent_analyses(cache_service):
+    """Test that recent analyses are dropped once a user's analyses change."""
+    recent = [{"id": 2, "icp_id": 1, "sentiment_score": 80, "created_at": "2024-01-02T00:00:00Z", "updated_at": None}]
+    await cache_service.set_recent_analyses(1, recent)
+    assert await cache_service.get_recent_analyses(1) == recent
+
+    assert await cache_service.invalidate_recent_analyses(1) is True
+    assert await cache_service.get_recent_analyses(1) is None
+
+@pytest.mark.asyncio
+async def test_set_and_get_analysis(cache_service):
+    """Test caching an email analysis result."""
+    result = {"resonance_score": 80, "strengths": ["Clear ask"]}
+
+    success = await cache_service.set_analysis("test-analysis", result)
+    assert success is True
+
+    cached_result = await cache_service.get_analysis("test-analysis")
+    assert cached_result == result
+
+@pytest.mark.asyncio
+async def test_analysis_lru_eviction(cache_service, monkeypatch):
+    """Test that the least recently used analysis results are evicted."""
+    monkeypatch.setattr(settings, "ANALYSIS_CACHE_MAX_ENTRIES", 2)
+    await cache_service.redis.delete("analysis_lru")
+
+    await cache_service.set_analysis("lru-1", {"resonance_score": 1})
+    await cache_service.set_analysis("lru-2", {"resonance_score": 2})
+    # Touch the first entry so the second becomes least recently used
+    await cache_service.get_analysis("lru-1")
+    await cache_service.set_analysis("lru-3", {"resonance_score": 3})
+
+    assert await cache_service.get_analysis("lru-1") is not None
+    assert await cache_service.get_analysis("lru-2") is None
+    assert await cache_service.get_analysis("lru-3") is not None
+
+def test_local_cache_evicts_least_recently_used():
+    """Test that the in-process tier stays bounded."""
+    cache = LocalCache(max_entries=2, ttl=30)
+    cache.set("icp:1", {"id": 1})
+    cache.set("icp:2", {"id": 2})
+    cache.get("icp:1")
+    cache.set("icp:3", {"id": 3})
+
+    assert cache.get("icp:1") == {"id": 1}
+    assert cache.get("icp:2") is None
+    assert cache.get("icp:3") == {"id": 3}
+
+def test_local_cache_ttl(monkeypatch):
+    """Test that local entries expire and never outlive the Redis TTL."""
+    cache = LocalCache(max_entries=10, ttl=30)
+    cache.set("icp:1", {"id": 1}, ttl=5)
+    now = time.monotonic()
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 6)
+    assert cache.get("icp:1") is None
+
+@pytest.mark.asyncio
+async def test_refresh_analysis_lock(cache_service, redis_client):
+    """Test that only the lock's holder can extend it."""
+    cache_key = f"test_{time.time_ns()}"
+    token = await cache_service.acquire_analysis_lock(cache_key)
+    await redis_client.expire(f"analysis_lock:{cache_key}", 1)
+
+    assert await cache_service.refresh_analysis_lock(cache_key, "someone else") is False
+    assert await cache_service.refresh_analysis_lock(cache_key, token) is True
+    assert await redis_client.ttl(f"analysis_lock:{cache_key}") > 1
+
+    await cache_service.release_analysis_lock(cache_key, token)
+    assert await cache_service.refresh_analysis_lock(cache_key, token) is False
@@ -0,0 +1,66 @@
+import pytest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from app.core import codec
+from app.core.codec import CODEC_VERSION, RAW, decode_entry, encode_icp, decode_icp, encode_ids
+
+def make_icp(icp_id: int = 1, description: str = "Technology companies scaling their teams"):
+    """Create an object shaped like the ICP model."""
+    return SimpleNamespace(
+        id=icp_id,
+        user_id=1,
+        name=f"ICP {icp_id}",
+        description=description,
+        industry="Technology",
+        company_size="50-200",
+        created_at=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        updated_at=None,
+        icp_responses=[],
+        # Not part of the response schema, so it must not be cached
+        user=object(),
+    )
+
+def test_icp_round_trip_through_schema():
+    """Test that model instances are cached as their schema's JSON form."""
+    encoded = encode_icp(make_icp())
+
+    assert encoded[:2] == bytes([CODEC_VERSION]) + RAW
+    assert decode_icp(encoded) == {
+        "id": 1,
+        "user_id": 1,
+        "name": "ICP 1",
+        "description": "Technology companies scaling their teams",
+        "industry": "Technology",
+        "company_size": "50-200",
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": None,
+        "icp_responses": [],
+    }
+
+def test_id_list_round_trip():
+    """Test that id lists keep their order and their freshness metadata."""
+    entry = decode_entry(encode_ids([3, 1, 2], expires_at=100.0, delta=0.25))
+
+    assert entry.value == [3, 1, 2]
+    assert (entry.expires_at, entry.delta) == (100.0, 0.25)
+    assert decode_entry(encode_ids([])).value == []
+
+def test_other_versions_are_misses():
+    """Test that values written by another codec version are ignored."""
+    encoded = encode_icp(make_icp())
+
+    assert decode_icp(bytes([CODEC_VERSION + 1]) + encoded[1:]) is None
+    assert decode_icp(b'{"id": 1}') is None
+    assert decode_icp(None) is None
+
+def test_large_payloads_are_compressed(monkeypatch):
+    """Test that payloads above the threshold are zstd-compressed when available."""
+    pytest.importorskip("zstandard")
+    monkeypatch.setattr(codec.settings, "CACHE_COMPRESSION_THRESHOLD", 256)
+    icp = make_icp(description="x" * 500)
+
+    encoded = encode_icp(icp)
+
+    assert encoded[1:2] == codec.ZSTD
+    assert len(encoded) < 500
+    assert decode_icp(encoded)["description"] == "x" * 500
\ No newline at end of file
@@ -0,0 +1,435 @@
+import asyncio
+import json
+import pytest
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from redis.asyncio import Redis
+from app.api import deps
+from app.api.v1.endpoints import email_analysis
+from app.core.cache import CacheService
+from app.core.config import settings
+from app.core.usage import UsageResult
+from app.models.email_analysis import EmailAnalysis
+from app.models.icp import ICP
+from app.schemas.email_analysis import EmailAnalysisCreate
+from app.schemas.subscription import Entitlement
+from scripts.fake_openai import CANNED_ANALYSIS
+
+ANALYSIS_RESULT = {"sentiment_score": 7, "icp_alignment_score": 80}
+
+class FakeQuery:
+    def __init__(self, db, entity):
+        self.db = db
+        self.entity = entity
+
+    def filter(self, *conditions):
+        return self
+
+    def order_by(self, *columns):
+        return self
+
+    def offset(self, offset):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def all(self):
+        return [row for row in self.db.rows if isinstance(row, self.entity)]
+
+    def first(self):
+        if self.entity is ICP:
+            return self.db.icp
+        rows = self.all()
+        return rows[0] if rows else None
+
+    def scalar(self):
+        # Usage counter seeds: nothing was flushed yet
+        return None
+
+class FakeSession:
+    """Keeps added rows in memory and hands out ids the way a flush would."""
+
+    def __init__(self, icp):
+        self.icp = icp
+        self.rows = []
+        self.next_id = 1
+
+    def query(self, entity):
+        return FakeQuery(self, entity)
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def add_all(self, rows):
+        self.rows.extend(rows)
+
+    def flush(self):
+        for row in self.rows:
+            if isinstance(row, EmailAnalysis) and row.id is None:
+                row.id = self.next_id
+                row.created_at = datetime.utcnow()
+                self.next_id += 1
+
+    def commit(self):
+        self.flush()
+
+    def refresh(self, row):
+        pass
+
+    def delete(self, row):
+        self.rows.remove(row)
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def redis_client():
+    """Create a test Redis client."""
+    return Redis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        password=settings.REDIS_PASSWORD,
+        decode_responses=True
+    )
+
+@pytest.fixture
+def user():
+    """Create a user no other test run has rate limit or usage counters for."""
+    return SimpleNamespace(id=time.time_ns(), is_active=True)
+
+@pytest.fixture
+def db(user):
+    return FakeSession(SimpleNamespace(id=1, user_id=user.id, name="Test ICP"))
+
+@pytest.fixture
+def analyses(monkeypatch):
+    """Replace OpenAI with a fixed result, recording the emails analyzed."""
+    calls = []
+
+    async def analyze_email_cached(email_content, icp, cache_service, plan=None):
+        calls.append(email_content)
+        return dict(ANALYSIS_RESULT)
+
+    monkeypatch.setattr(email_analysis, "analyze_email_cached", analyze_email_cached)
+    return calls
+
+@pytest.fixture
+def client(redis_client, user, db):
+    """Serve the email analysis routes with the database, user and entitlement stubbed."""
+    binary_client = Redis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        password=settings.REDIS_PASSWORD
+    )
+    analysis_app = FastAPI()
+    analysis_app.include_router(email_analysis.router, prefix=f"{settings.API_V1_PREFIX}/email-analysis")
+    analysis_app.dependency_overrides[deps.get_db] = lambda: db
+    analysis_app.dependency_overrides[deps.get_current_user] = lambda: user
+    analysis_app.dependency_overrides[deps.get_entitlement] = lambda: Entitlement(plan_name="enterprise", is_active=True)
+    analysis_app.dependency_overrides[deps.get_redis] = lambda: redis_client
+    analysis_app.dependency_overrides[deps.get_cache_service] = lambda: CacheService(redis_client, binary_client)
+    # One client for the whole test keeps the Redis connections on one event loop
+    with TestClient(analysis_app) as analysis_client:
+        yield analysis_client
+
+def emails(count):
+    return [f"Variant {i} of the outreach email" for i in range(count)]
+
+def test_full_batch_fits_analysis_budget():
+    """Test that the largest batch the schema accepts doesn't cost more than the whole budget."""
+    assert settings.ANALYSIS_BATCH_MAX_SIZE * settings.ANALYSIS_BATCH_EMAIL_COST <= settings.ANALYSIS_RATE_LIMIT
+
+def test_batch_over_fifty_emails(client, analyses):
+    """Test that a batch of more than 50 emails is rate limited per email, not refused."""
+    response = client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze/batch",
+        json={"icp_id": 1, "email_contents": emails(60)}
+    )
+
+    assert response.status_code == 200
+    assert len(response.json()) == 60
+    assert len(analyses) == 60
+    spent = 60 * settings.ANALYSIS_BATCH_EMAIL_COST
+    assert response.headers["X-RateLimit-Remaining"] == str(settings.ANALYSIS_RATE_LIMIT - spent)
+
+def test_reads_do_not_spend_analysis_budget(client, analyses):
+    """Test that reading analyses is limited separately from analyzing them."""
+    for _ in range(3):
+        response = client.get(f"{settings.API_V1_PREFIX}/email-analysis/analyses")
+        assert response.status_code == 200
+    assert response.headers["X-RateLimit-Remaining"] == str(settings.ANALYSIS_READ_RATE_LIMIT - 3)
+
+    response = client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze",
+        json={"icp_id": 1, "email_content": emails(1)[0]}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["X-RateLimit-Remaining"] == str(settings.ANALYSIS_RATE_LIMIT - settings.ANALYSIS_RATE_LIMIT_COST)
+
+
+class RecordingMeter:
+    """Allows requests up to `quota` units and records what was consumed and refunded."""
+
+    def __init__(self, quota=None):
+        self.quota = quota
+        self.consumed = []
+        self.refunds = []
+
+    async def consume(self, db, user_id, plan, resource, amount=1):
+        allowed = self.quota is None or amount <= self.quota
+        if allowed:
+            self.consumed.append((user_id, resource, amount))
+        return UsageResult(allowed=allowed, resource=resource, used=amount if allowed else 0, quota=self.quota)
+
+    async def refund(self, user_id, resource, amount=1):
+        self.refunds.append((user_id, resource, amount))
+
+class NoCache:
+    async def get_analysis(self, key):
+        return None
+
+    async def set_analysis(self, key, value):
+        return True
+
+    async def invalidate_recent_analyses(self, user_id):
+        return True
+
+    async def clear_missing(self, resource, user_id, *resource_ids):
+        return True
+
+@pytest.fixture
+def streamed(monkeypatch):
+    """Replace the OpenAI stream with the tokens of a JSON result."""
+    arguments = json.dumps(CANNED_ANALYSIS)
+    tokens = [arguments[i:i + 40] for i in range(0, len(arguments), 40)]
+
+    async def stream_email_analysis(email_content, icp):
+        for token in tokens:
+            yield token
+            await asyncio.sleep(0)
+
+    monkeypatch.setattr(email_analysis, "stream_email_analysis", stream_email_analysis)
+    monkeypatch.setattr(email_analysis, "fit_email_to_budget", lambda email_content, icp, plan=None: email_content)
+    monkeypatch.setattr(email_analysis, "analysis_cache_key", lambda email_content, icp: "analysis:test")
+    return tokens
+
+@pytest.mark.asyncio
+async def test_stream_disconnect_refunds_quota(user, db, streamed):
+    """Test that a client leaving mid-stream gets its unit back, as nothing is saved."""
+    meter = RecordingMeter()
+    response = await email_analysis.create_email_analysis_stream(
+        db=db,
+        current_user=user,
+        entitlement=Entitlement(plan_name="pro", is_active=True),
+        cache_service=NoCache(),
+        usage_meter=meter,
+        analysis=EmailAnalysisCreate(icp_id=1, email_content=emails(1)[0]),
+    )
+    events = response.body_iterator
+
+    assert (await events.__anext__()).startswith("event: token")
+    # What Starlette does when the client disconnects
+    await events.aclose()
+
+    assert meter.refunds == [(user.id, "email_analysis", 1)]
+
+def test_failed_batch_cancels_remaining_analyses(client, user, monkeypatch):
+    """Test that one failed email stops the rest of the batch and refunds all of it."""
+    finished = []
+
+    async def analyze_email_cached(email_content, icp, cache_service, plan=None):
+        if email_content == emails(1)[0]:
+            raise RuntimeError("upstream down")
+        await asyncio.sleep(0.2)
+        finished.append(email_content)
+        return dict(ANALYSIS_RESULT)
+
+    monkeypatch.setattr(email_analysis, "analyze_email_cached", analyze_email_cached)
+    meter = RecordingMeter()
+    client.app.dependency_overrides[deps.get_usage_meter] = lambda: meter
+
+    with pytest.raises(RuntimeError):
+        client.post(
+            f"{settings.API_V1_PREFIX}/email-analysis/analyze/batch",
+            json={"icp_id": 1, "email_contents": emails(5)}
+        )
+
+    # Give calls that were left running time to finish
+    time.sleep(0.5)
+    assert finished == []
+    assert meter.refunds == [(user.id, "email_analysis", 5)]
+
+def test_batch_consumes_one_unit_per_email(client, user, analyses):
+    """Test that a batch counts every email against the quota and keeps them all once saved."""
+    meter = RecordingMeter()
+    client.app.dependency_overrides[deps.get_usage_meter] = lambda: meter
+
+    response = client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze/batch",
+        json={"icp_id": 1, "email_contents": emails(3)}
+    )
+
+    assert response.status_code == 200
+    assert [analysis["email_content"] for analysis in response.json()] == emails(3)
+    assert meter.consumed == [(user.id, "email_analysis", 3)]
+    assert meter.refunds == []
+
+def test_batch_over_quota_analyzes_nothing(client, analyses):
+    """Test that a batch larger than the quota left is refused before any email is analyzed."""
+    meter = RecordingMeter(quota=2)
+    client.app.dependency_overrides[deps.get_usage_meter] = lambda: meter
+
+    response = client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze/batch",
+        json={"icp_id": 1, "email_contents": emails(3)}
+    )
+
+    assert response.status_code == 403
+    assert response.json()["detail"]["quota"] == 2
+    assert analyses == []
+
+@pytest.fixture
+def queued(monkeypatch):
+    """Replace the Celery task with one that records what was queued."""
+    jobs = []
+
+    def delay(*args):
+        jobs.append(args)
+        return SimpleNamespace(id=f"job-{time.time_ns()}", status="PENDING")
+
+    monkeypatch.setattr(email_analysis, "analyze_email_task", SimpleNamespace(delay=delay))
+    return jobs
+
+def test_async_analysis_is_queued(client, user, analyses, queued):
+    """Test that run_async queues the analysis and answers 202 with its job id."""
+    response = client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze?run_async=true",
+        json={"icp_id": 1, "email_content": emails(1)[0]}
+    )
+
+    assert response.status_code == 202
+    assert response.json()["status"] == "PENDING"
+    assert queued == [(user.id, 1, emails(1)[0], "enterprise")]
+    # The worker does the analysis, not the request
+    assert analyses == []
+
+def test_failed_enqueue_refunds_quota(client, user, monkeypatch):
+    """Test that an analysis the broker refused gives its unit back."""
+    def delay(*args):
+        raise ConnectionError("broker down")
+
+    monkeypatch.setattr(email_analysis, "analyze_email_task", SimpleNamespace(delay=delay))
+    meter = RecordingMeter()
+    client.app.dependency_overrides[deps.get_usage_meter] = lambda: meter
+
+    with pytest.raises(ConnectionError):
+        client.post(
+            f"{settings.API_V1_PREFIX}/email-analysis/analyze?run_async=true",
+            json={"icp_id": 1, "email_content": emails(1)[0]}
+        )
+
+    assert meter.refunds == [(user.id, "email_analysis", 1)]
+
+def test_jobs_are_only_visible_to_their_owner(client, user, queued):
+    """Test that polling someone else's job, or an unknown one, is a 404."""
+    response = client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze?run_async=true",
+        json={"icp_id": 1, "email_content": emails(1)[0]}
+    )
+    job_id = response.json()["job_id"]
+
+    client.app.dependency_overrides[deps.get_current_user] = lambda: SimpleNamespace(id=user.id + 1, is_active=True)
+    response = client.get(f"{settings.API_V1_PREFIX}/email-analysis/jobs/{job_id}")
+    assert response.status_code == 404
+
+    response = client.get(f"{settings.API_V1_PREFIX}/email-analysis/jobs/job-unknown")
+    assert response.status_code == 404
+
+def test_finished_job_returns_its_analysis(client, user, db, queued, monkeypatch):
+    """Test that a successful job is answered with the analysis the worker saved."""
+    response = client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze?run_async=true",
+        json={"icp_id": 1, "email_content": emails(1)[0]}
+    )
+    job_id = response.json()["job_id"]
+    # What the worker would have written
+    db.add(EmailAnalysis(user_id=user.id, icp_id=1, email_content=emails(1)[0], analysis_result=ANALYSIS_RESULT, sentiment_score=7))
+    db.flush()
+
+    class FinishedResult:
+        status = "SUCCESS"
+        result = {"analysis_id": 1}
+
+        def __init__(self, job_id, app=None):
+            pass
+
+        def successful(self):
+            return True
+
+        def failed(self):
+            return False
+
+    monkeypatch.setattr(email_analysis, "AsyncResult", FinishedResult)
+    response = client.get(f"{settings.API_V1_PREFIX}/email-analysis/jobs/{job_id}")
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "SUCCESS"
+    assert response.json()["analysis"]["id"] == 1
+    assert response.json()["analysis"]["analysis_result"] == ANALYSIS_RESULT
+
+def read_events(response):
+    """Split a server-sent event stream into (event, data) pairs."""
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+@pytest.fixture
+def stream_client(client, db, monkeypatch):
+    """Stream against the in-memory session, without a shared analysis cache."""
+    meter = RecordingMeter()
+    monkeypatch.setattr(email_analysis, "SessionLocal", lambda: db)
+    client.app.dependency_overrides[deps.get_cache_service] = NoCache
+    client.app.dependency_overrides[deps.get_usage_meter] = lambda: meter
+    client.meter = meter
+    return client
+
+def test_stream_sends_tokens_then_saved_result(stream_client, user, db, streamed):
+    """Test that tokens are forwarded as they arrive and the saved analysis follows."""
+    response = stream_client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze/stream",
+        json={"icp_id": 1, "email_content": emails(1)[0]}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = read_events(response)
+    assert events[:-1] == [("token", {"content": token}) for token in streamed]
+    event, result = events[-1]
+    assert event == "result"
+    assert result["analysis_result"]["icp_alignment_score"] == CANNED_ANALYSIS["icp_alignment_score"]
+    assert [row.id for row in db.rows] == [result["id"]]
+    assert stream_client.meter.refunds == []
+
+def test_stream_error_refunds_quota(stream_client, user, db, streamed, monkeypatch):
+    """Test that output that fails to parse ends in an error event, saving nothing and refunding."""
+    async def stream_email_analysis(email_content, icp):
+        yield '{"strengths": '
+
+    monkeypatch.setattr(email_analysis, "stream_email_analysis", stream_email_analysis)
+    response = stream_client.post(
+        f"{settings.API_V1_PREFIX}/email-analysis/analyze/stream",
+        json={"icp_id": 1, "email_content": emails(1)[0]}
+    )
+
+    assert [event for event, data in read_events(response)] == ["token", "error"]
+    assert db.rows == []
+    assert stream_client.meter.refunds == [(user.id, "email_analysis", 1)]
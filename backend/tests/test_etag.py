@@ -0,0 +1,58 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from app.core.codec import decode_icp, encode_icp
+from app.core.etag import compute_etag, etag_matches, not_modified
+
+def test_etag_is_stable_across_orm_and_cached_forms():
+    """Test that a row and its cached JSON form get the same ETag."""
+    row = SimpleNamespace(id=1, created_at=datetime(2024, 1, 1, tzinfo=timezone.utc), updated_at=None)
+    cached = {"id": 1, "created_at": "2024-01-01T00:00:00Z", "updated_at": None}
+
+    assert compute_etag("icp", [row]) == compute_etag("icp", [cached])
+    assert compute_etag("icp", [row]).startswith('"')
+
+def test_etag_survives_the_cache_codec():
+    """Test that an ICP read back from the cache gets the ETag of the row it was written from."""
+    row = SimpleNamespace(
+        id=1,
+        user_id=1,
+        name="Test ICP",
+        description=None,
+        industry="Technology",
+        company_size="1-10",
+        created_at=datetime(2024, 1, 1, 12, 30, 15, 123456, tzinfo=timezone.utc),
+        updated_at=datetime(2024, 2, 1, tzinfo=timezone.utc),
+        icp_responses=[],
+    )
+
+    assert compute_etag("icp", [decode_icp(encode_icp(row))]) == compute_etag("icp", [row])
+
+def test_etag_changes_with_updates_and_membership():
+    """Test that updates, reordering and other resources change the ETag."""
+    first = {"id": 1, "created_at": "2024-01-01T00:00:00Z", "updated_at": None}
+    second = {"id": 2, "created_at": "2024-01-02T00:00:00Z", "updated_at": None}
+    updated = {**first, "updated_at": "2024-01-03T00:00:00Z"}
+
+    etag = compute_etag("icps", [first, second])
+    assert compute_etag("icps", [updated, second]) != etag
+    assert compute_etag("icps", [second, first]) != etag
+    assert compute_etag("icps", [first]) != etag
+    assert compute_etag("icp_responses:1", [first, second]) != etag
+
+def test_etag_matches_if_none_match():
+    """Test If-None-Match parsing."""
+    etag = '"abc"'
+
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('"xyz", W/"abc"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"xyz"', etag)
+    assert not etag_matches(None, etag)
+
+def test_not_modified_response():
+    """Test that 304 responses carry the ETag and no body."""
+    response = not_modified('"abc"')
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == '"abc"'
+    assert response.body == b""
@@ -0,0 +1,70 @@
+import pytest
+from app.core import monitoring
+from app.core.monitoring import CACHE_KEYS, CACHE_SIZE, REDIS_KEYS, REDIS_MEMORY_USED, MonitoringService
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.keys = []
+
+    def memory_usage(self, key):
+        self.keys.append(key)
+
+    async def execute(self):
+        return [self.redis.sizes[key] for key in self.keys]
+
+class FakeRedis:
+    """Serves INFO, DBSIZE, paged SCAN and MEMORY USAGE from a dict of key sizes."""
+
+    def __init__(self, sizes, page_size=2):
+        self.sizes = sizes
+        self.page_size = page_size
+        self.scan_calls = 0
+
+    async def info(self, section):
+        return {"used_memory": 4096}
+
+    async def dbsize(self):
+        return len(self.sizes)
+
+    async def scan(self, cursor, count=None):
+        self.scan_calls += 1
+        keys = list(self.sizes)[cursor:cursor + self.page_size]
+        next_cursor = cursor + self.page_size
+        return (next_cursor if next_cursor < len(self.sizes) else 0), keys
+
+    def keys(self, pattern):
+        raise AssertionError("KEYS must not be used")
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+def gauge(metric, **labels):
+    return (metric.labels(**labels) if labels else metric)._value.get()
+
+@pytest.mark.asyncio
+async def test_cache_size_from_complete_scan():
+    """Test that a finished scan reports exact per-prefix counts and sizes."""
+    redis = FakeRedis({"icp:1": 100, "icp:2": 300, "user_icps:1:0": 50, "rate_limit:a": 10, "other": 999})
+
+    await MonitoringService(redis).update_cache_size()
+
+    assert gauge(REDIS_MEMORY_USED) == 4096
+    assert gauge(REDIS_KEYS) == 5
+    assert gauge(CACHE_KEYS, cache_type="icp") == 2
+    assert gauge(CACHE_SIZE, cache_type="icp") == 400
+    assert gauge(CACHE_SIZE, cache_type="user_icps") == 50
+    assert gauge(CACHE_SIZE, cache_type="rate_limit") == 10
+
+@pytest.mark.asyncio
+async def test_cache_size_scales_a_partial_scan(monkeypatch):
+    """Test that a bounded scan is scaled up to the database size."""
+    monkeypatch.setattr(monitoring.settings, "CACHE_TELEMETRY_SCAN_CALLS", 2)
+    monkeypatch.setattr(monitoring.settings, "CACHE_TELEMETRY_SAMPLE_SIZE", 1)
+    redis = FakeRedis({f"icp:{i}": 100 for i in range(8)}, page_size=2)
+
+    await MonitoringService(redis).update_cache_size()
+
+    assert redis.scan_calls == 2
+    assert gauge(CACHE_KEYS, cache_type="icp") == 8
+    assert gauge(CACHE_SIZE, cache_type="icp") == 800
@@ -0,0 +1,278 @@
+import asyncio
+import json
+import httpx
+import pytest
+from types import SimpleNamespace
+from openai import AsyncOpenAI
+from pydantic import ValidationError
+from app.core import openai as openai_service
+from app.core import resilience
+from app.core.exceptions import OpenAIServiceError
+from app.core.monitoring import ANALYSIS_PARSE_FAILURES
+from app.core.config import settings
+from app.core.openai import (
+    analyze_email_cached,
+    build_analysis_messages,
+    estimate_message_tokens,
+    fit_email_to_budget,
+    analyze_email,
+    output_token_limit,
+    parse_analysis,
+    stream_email_analysis,
+)
+from scripts.fake_openai import CANNED_ANALYSIS, FakeOpenAIConfig, create_app
+
+class InMemoryAnalysisCache:
+    """Analysis cache with the CacheService interface, held in memory."""
+
+    def __init__(self):
+        self.results = {}
+        self.locks = {}
+        self.refreshes = 0
+
+    async def get_analysis(self, cache_key):
+        return self.results.get(cache_key)
+
+    async def set_analysis(self, cache_key, data):
+        self.results[cache_key] = data
+        return True
+
+    async def acquire_analysis_lock(self, cache_key):
+        if cache_key in self.locks:
+            return None
+        self.locks[cache_key] = "token"
+        return "token"
+
+    async def analysis_lock_held(self, cache_key):
+        return cache_key in self.locks
+
+    async def refresh_analysis_lock(self, cache_key, token):
+        self.refreshes += 1
+        return self.locks.get(cache_key) == token
+
+    async def release_analysis_lock(self, cache_key, token):
+        return self.locks.pop(cache_key, None) == token
+
+@pytest.fixture
+def sample_feedback():
+    """Create sample tool-call arguments returned by the model."""
+    return {
+        "strengths": ["Clear call to action"],
+        "weaknesses": ["Generic opening line"],
+        "improvement_suggestions": ["Reference a scaling pain point"],
+        "icp_alignment_score": 72,
+        "persona_match_score": 65,
+        "pain_point_addressal": {"score": 50, "addressed": ["Scaling"], "missed": ["Cost"]},
+        "suggested_rewrite": "Hi Sam, ..."
+    }
+
+@pytest.fixture
+def sample_icp():
+    """Create a sample ICP with the fields used in the prompt."""
+    return SimpleNamespace(
+        industry="Technology",
+        company_size="1-10",
+        persona_title="CTO",
+        persona_responsibilities="Technical leadership",
+        pain_points="Scaling issues",
+        goals="Improve efficiency"
+    )
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    """Point the shared OpenAI client at the in-process stand-in server."""
+    config = FakeOpenAIConfig(latency_median=0, tokens_per_second=100000)
+    client = AsyncOpenAI(
+        api_key="test",
+        base_url="http://fake-openai/v1",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app(config))),
+    )
+    monkeypatch.setattr(openai_service, "_client", client)
+    return config
+
+def test_parse_analysis(sample_feedback):
+    """Test parsing valid structured analysis output."""
+    result = parse_analysis(json.dumps(sample_feedback))
+
+    assert result["icp_alignment_score"] == 72
+    assert result["strengths"] == ["Clear call to action"]
+    assert result["pain_point_addressal"]["missed"] == ["Cost"]
+
+def test_parse_analysis_missing_field(sample_feedback):
+    """Test that invalid output is rejected and counted."""
+    del sample_feedback["persona_match_score"]
+    failures = ANALYSIS_PARSE_FAILURES._value.get()
+
+    with pytest.raises(ValidationError):
+        parse_analysis(json.dumps(sample_feedback))
+
+    assert ANALYSIS_PARSE_FAILURES._value.get() == failures + 1
+
+def test_parse_analysis_without_tool_call():
+    """Test that a response without the tool call is rejected and counted like invalid output."""
+    failures = ANALYSIS_PARSE_FAILURES._value.get()
+
+    with pytest.raises(ValidationError):
+        parse_analysis(None)
+
+    assert ANALYSIS_PARSE_FAILURES._value.get() == failures + 1
+
+def test_parse_analysis_out_of_range_score(sample_feedback):
+    """Test that scores outside 0-100 are rejected."""
+    sample_feedback["icp_alignment_score"] = 140
+
+    with pytest.raises(ValidationError):
+        parse_analysis(json.dumps(sample_feedback))
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_analyses_share_one_call(monkeypatch, sample_icp, sample_feedback):
+    """Test that identical in-flight analyses are coalesced into one OpenAI call."""
+    calls = []
+
+    async def fake_analyze_email(email_content, icp):
+        calls.append(email_content)
+        await asyncio.sleep(0.05)
+        return sample_feedback
+
+    monkeypatch.setattr(openai_service, "analyze_email", fake_analyze_email)
+    cache = InMemoryAnalysisCache()
+
+    results = await asyncio.gather(*(
+        analyze_email_cached("Hi Sam, quick question about scaling", sample_icp, cache)
+        for _ in range(5)
+    ))
+
+    assert len(calls) == 1
+    assert all(result == sample_feedback for result in results)
+    assert cache.locks == {}
+
+@pytest.mark.asyncio
+async def test_coalesced_analyses_share_failure(monkeypatch, sample_icp):
+    """Test that waiters receive the leader's error instead of hanging."""
+    async def failing_analyze_email(email_content, icp):
+        await asyncio.sleep(0.05)
+        raise RuntimeError("upstream down")
+
+    monkeypatch.setattr(openai_service, "analyze_email", failing_analyze_email)
+    cache = InMemoryAnalysisCache()
+
+    results = await asyncio.gather(*(
+        analyze_email_cached("Hi Sam, quick question about scaling", sample_icp, cache)
+        for _ in range(3)
+    ), return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert openai_service._inflight == {}
+
+@pytest.mark.asyncio
+async def test_slow_analysis_keeps_its_lock(monkeypatch, sample_icp, sample_feedback):
+    """Test that a call outliving ANALYSIS_LOCK_TTL keeps other workers waiting instead of duplicating it."""
+    monkeypatch.setattr(settings, "ANALYSIS_LOCK_TTL", 0.03)
+    cache = InMemoryAnalysisCache()
+
+    async def slow_analyze_email(email_content, icp):
+        await asyncio.sleep(0.1)
+        return sample_feedback
+
+    monkeypatch.setattr(openai_service, "analyze_email", slow_analyze_email)
+
+    assert await analyze_email_cached("Hi Sam, quick question about scaling", sample_icp, cache) == sample_feedback
+    assert cache.refreshes >= 2
+    assert cache.locks == {}
+
+def test_analysis_wait_limit_covers_retries(monkeypatch):
+    """Test that waiters allow for every attempt timing out plus the backoff between them."""
+    monkeypatch.setattr(settings, "OPENAI_MAX_RETRIES", 3)
+    monkeypatch.setattr(settings, "OPENAI_CONNECT_TIMEOUT", 5.0)
+    monkeypatch.setattr(settings, "OPENAI_READ_TIMEOUT", 60.0)
+    monkeypatch.setattr(settings, "OPENAI_RETRY_MAX_DELAY", 20.0)
+
+    assert openai_service.analysis_wait_limit() == 4 * 65.0 + 3 * 20.0
+
+def test_fit_email_to_budget_keeps_short_email(sample_icp):
+    """Test that emails within budget are left untouched."""
+    email = "Hi Sam, quick question about scaling your team."
+    assert fit_email_to_budget(email, sample_icp, "free") == email
+
+def test_fit_email_to_budget_truncates_long_email(sample_icp):
+    """Test that oversized emails are cut to the plan's input budget."""
+    email = "word " * 20000
+
+    truncated = fit_email_to_budget(email, sample_icp, "free")
+
+    assert truncated.endswith("[truncated]")
+    messages = build_analysis_messages(truncated, sample_icp)
+    assert estimate_message_tokens(messages) <= settings.ANALYSIS_INPUT_TOKEN_BUDGETS["free"]
+    # Larger plans keep more of the email
+    assert len(fit_email_to_budget(email, sample_icp, "enterprise")) > len(truncated)
+
+def test_output_token_limit():
+    """Test that max_tokens grows with the email and is capped."""
+    short_limit = output_token_limit("Hi Sam")
+    assert short_limit < output_token_limit("word " * 500)
+    assert output_token_limit("word " * 20000) == settings.ANALYSIS_MAX_OUTPUT_TOKENS
+
+
+@pytest.mark.asyncio
+async def test_analyze_email_against_fake_openai(fake_openai, sample_icp):
+    """Test the full analysis call against the stand-in server."""
+    result = await analyze_email("Hi Sam, quick question about scaling", sample_icp)
+
+    assert result["icp_alignment_score"] == CANNED_ANALYSIS["icp_alignment_score"]
+    assert result["strengths"] == CANNED_ANALYSIS["strengths"]
+
+@pytest.mark.asyncio
+async def test_stream_email_analysis_against_fake_openai(fake_openai, sample_icp):
+    """Test that streamed chunks reassemble into a valid analysis."""
+    chunks = [chunk async for chunk in stream_email_analysis("Hi Sam, quick question about scaling", sample_icp)]
+
+    assert len(chunks) > 1
+    assert parse_analysis("".join(chunks))["persona_match_score"] == CANNED_ANALYSIS["persona_match_score"]
+
+@pytest.mark.asyncio
+async def test_analyze_email_gives_up_after_rate_limits(fake_openai, sample_icp, monkeypatch):
+    """Test that persistent 429s surface as OpenAIServiceError after retries."""
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(resilience.asyncio, "sleep", no_sleep)
+    fake_openai.rate_limit_ratio = 1.0
+
+    with pytest.raises(OpenAIServiceError):
+        await analyze_email("Hi Sam, quick question about scaling", sample_icp)
+
+@pytest.mark.asyncio
+async def test_analyze_email_without_tool_call(fake_openai, sample_icp, monkeypatch):
+    """Test that a plain-text answer fails cleanly and is counted as a parse failure."""
+    # The stand-in answers with plain content when no tool is offered
+    monkeypatch.setattr(openai_service, "ANALYSIS_TOOLS", [])
+    failures = ANALYSIS_PARSE_FAILURES._value.get()
+
+    with pytest.raises(OpenAIServiceError):
+        await analyze_email("Hi Sam, quick question about scaling", sample_icp)
+
+    assert ANALYSIS_PARSE_FAILURES._value.get() == failures + 1
+
+@pytest.mark.asyncio
+async def test_openai_client_is_shared(monkeypatch):
+    """Test that every call gets the one pooled client until it is closed."""
+    monkeypatch.setattr(openai_service, "_client", None)
+
+    client = openai_service.init_openai_client()
+
+    assert openai_service.init_openai_client() is client
+    assert openai_service.get_openai_client() is client
+    assert client.max_retries == 0
+    assert client.timeout.connect == settings.OPENAI_CONNECT_TIMEOUT
+    assert client.timeout.read == settings.OPENAI_READ_TIMEOUT
+
+    await openai_service.close_openai_client()
+
+    assert client.is_closed()
+    assert openai_service._client is None
+    # Used outside the API lifespan, a new client is created lazily
+    replacement = openai_service.get_openai_client()
+    assert replacement is not client
+    await openai_service.close_openai_client()
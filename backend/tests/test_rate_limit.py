@@ -1,17 +1,25 @@
 import pytest
+from fastapi import Depends, FastAPI, HTTPException
 from fastapi.testclient import TestClient
 from datetime import datetime, timedelta
-from app.core.rate_limit import RateLimiter
+from types import SimpleNamespace
+import math
+import time
+from app.core import rate_limit as rate_limit_module
+from app.api import deps
+from app.core.config import RateLimitPolicy
+from app.core.rate_limit import RateLimiter, RateLimitMiddleware, rate_limit
+from app.core.security import create_access_token
 from app.main import app
 from app.core.config import settings
-import redis
+from redis.asyncio import Redis
 
 client = TestClient(app)
 
 @pytest.fixture
 def redis_client():
     """Create a test Redis client."""
-    return redis.Redis(
+    return Redis(
         host=settings.REDIS_HOST,
         port=settings.REDIS_PORT,
         db=settings.REDIS_DB,
@@ -24,63 +32,232 @@ def rate_limiter(redis_client):
     """Create a rate limiter instance."""
     return RateLimiter(redis_client)
 
-def test_rate_limit_check(rate_limiter, redis_client):
+@pytest.fixture
+def request_stub():
+    """Create a stand-in for a request from 127.0.0.1."""
+    return SimpleNamespace(client=SimpleNamespace(host="127.0.0.1"))
+
+async def clear_rate_limit(rate_limiter, redis_client, request_stub):
+    """Clear the window counters of the test user."""
+    current_key, previous_key, _ = rate_limiter._keys(request_stub, "test_user", time.time())
+    await redis_client.delete(current_key, previous_key)
+
+@pytest.mark.asyncio
+async def test_rate_limit_check(rate_limiter, redis_client, request_stub):
     """Test rate limit checking."""
     # Clear any existing rate limit keys
-    redis_client.delete("rate_limit:127.0.0.1:test_user")
+    await clear_rate_limit(rate_limiter, redis_client, request_stub)
     
     # Test first request (should pass)
-    assert rate_limiter.check_rate_limit(None, "test_user") is True
+    assert (await rate_limiter.check_rate_limit(request_stub, "test_user")).allowed is True
     
     # Test requests up to limit (should pass)
-    for _ in range(settings.RATE_LIMIT - 1):
-        assert rate_limiter.check_rate_limit(None, "test_user") is True
+    for _ in range(rate_limiter.rate_limit - 1):
+        assert (await rate_limiter.check_rate_limit(request_stub, "test_user")).allowed is True
     
     # Test request exceeding limit (should fail)
-    assert rate_limiter.check_rate_limit(None, "test_user") is False
+    assert (await rate_limiter.check_rate_limit(request_stub, "test_user")).allowed is False
 
-def test_get_remaining_requests(rate_limiter, redis_client):
+@pytest.mark.asyncio
+async def test_get_remaining_requests(rate_limiter, redis_client, request_stub):
     """Test getting remaining requests."""
     # Clear any existing rate limit keys
-    redis_client.delete("rate_limit:127.0.0.1:test_user")
+    await clear_rate_limit(rate_limiter, redis_client, request_stub)
     
     # Test initial state
-    assert rate_limiter.get_remaining_requests(None, "test_user") == settings.RATE_LIMIT
+    assert await rate_limiter.get_remaining_requests(request_stub, "test_user") == rate_limiter.rate_limit
     
     # Make some requests
     for _ in range(5):
-        rate_limiter.check_rate_limit(None, "test_user")
+        await rate_limiter.check_rate_limit(request_stub, "test_user")
     
     # Check remaining requests
-    assert rate_limiter.get_remaining_requests(None, "test_user") == settings.RATE_LIMIT - 5
+    assert await rate_limiter.get_remaining_requests(request_stub, "test_user") == rate_limiter.rate_limit - 5
 
-def test_get_reset_time(rate_limiter, redis_client):
+@pytest.mark.asyncio
+async def test_get_reset_time(rate_limiter, redis_client, request_stub):
     """Test getting reset time."""
     # Clear any existing rate limit keys
-    redis_client.delete("rate_limit:127.0.0.1:test_user")
+    await clear_rate_limit(rate_limiter, redis_client, request_stub)
     
     # Set up a rate limit
-    rate_limiter.check_rate_limit(None, "test_user")
+    await rate_limiter.check_rate_limit(request_stub, "test_user")
     
     # Get reset time
-    reset_time = rate_limiter.get_reset_time(None, "test_user")
+    reset_time = await rate_limiter.get_reset_time(request_stub, "test_user")
     
     # Verify reset time is in the future
     assert reset_time > datetime.utcnow()
     # Verify reset time is within the window
     assert reset_time <= datetime.utcnow() + timedelta(seconds=60)
 
-def test_rate_limit_api_endpoint():
-    """Test rate limiting on API endpoints."""
-    # Clear any existing rate limit keys
-    redis_client.delete("rate_limit:127.0.0.1:test_user")
-    
-    # Make requests up to limit
-    for _ in range(settings.RATE_LIMIT):
-        response = client.get("/api/v1/icp/icps", headers={"Authorization": "Bearer test_token"})
-        assert response.status_code in [200, 401]  # 401 is expected if token is invalid
-    
-    # Next request should be rate limited
-    response = client.get("/api/v1/icp/icps", headers={"Authorization": "Bearer test_token"})
-    assert response.status_code == 429
-    assert "X-RateLimit-Reset" in response.headers 
\ No newline at end of file
+@pytest.mark.asyncio
+async def test_rate_limit_result_headers(rate_limiter, redis_client, request_stub):
+    """Test that one check returns everything the X-RateLimit-* headers need."""
+    await clear_rate_limit(rate_limiter, redis_client, request_stub)
+
+    result = await rate_limiter.check_rate_limit(request_stub, "test_user", cost=3)
+
+    assert result.allowed is True
+    headers = result.headers()
+    assert headers["X-RateLimit-Limit"] == str(rate_limiter.rate_limit)
+    assert int(headers["X-RateLimit-Remaining"]) <= rate_limiter.rate_limit - 3
+    assert 0 < int(headers["X-RateLimit-Reset"]) <= rate_limiter.window
+    assert "Retry-After" not in headers
+
+def test_sliding_window_retry_after(rate_limiter):
+    """Test when a denied request may retry as the previous window slides out."""
+    rate_limiter.rate_limit = 10
+
+    # Halfway through the window, 10 * 0.5 + 5 leaves no room for one more request
+    result = rate_limiter._result(False, current=5, previous=10, weight=0.5)
+    assert result.remaining == 0
+    # Room of 4 needs the previous window's weight down to 0.4, 6 seconds from now
+    assert result.retry_after == pytest.approx(6.0)
+
+    # A full current window has to become the previous one first
+    result = rate_limiter._result(False, current=10, previous=0, weight=0.5)
+    assert result.retry_after == pytest.approx(30.0 + 6.0)
+    assert result.headers()["Retry-After"] == "36"
+
+@pytest.mark.asyncio
+async def test_leased_tokens_skip_redis(rate_limiter, request_stub, monkeypatch):
+    """Test that a worker spends a leased batch locally before going back to Redis."""
+    monkeypatch.setattr(settings, "RATE_LIMIT_LEASE_SIZE", 5)
+    monkeypatch.setattr(settings, "RATE_LIMIT_MAX_OVERSHOOT", 0)
+    monkeypatch.setattr(rate_limit_module, "_leases", rate_limit_module.OrderedDict())
+    bucket = {"tokens": 7}
+    calls = []
+
+    async def bucket_script(keys, args):
+        calls.append(args[3])
+        granted = min(args[3], bucket["tokens"])
+        bucket["tokens"] -= granted
+        return [granted, str(bucket["tokens"])]
+
+    monkeypatch.setattr(rate_limiter, "bucket_script", bucket_script)
+
+    results = [await rate_limiter.check_leased(request_stub, "test_user") for _ in range(8)]
+
+    # One lease of 5, then a partial lease of the 2 tokens left
+    assert [result.allowed for result in results] == [True] * 7 + [False]
+    assert calls == [5, 5, 5]
+    assert results[0].remaining == 4 + 2
+    assert results[-1].headers()["Retry-After"] == str(math.ceil(1 / (rate_limiter.rate_limit / rate_limiter.window)))
+
+def test_rate_limit_decorator_weighs_cost(redis_client):
+    """Test that decorated routes spend their cost from a shared scope budget."""
+    limited_app = FastAPI()
+    scope = f"test_{time.time_ns()}"
+
+    @limited_app.get("/expensive")
+    @rate_limit(max_requests=45, window_seconds=3600, cost=20, scope=scope)
+    async def expensive():
+        return {"ok": True}
+
+    @limited_app.get("/cheap")
+    @rate_limit(max_requests=45, window_seconds=3600, scope=scope)
+    async def cheap():
+        return {"ok": True}
+
+    limited_app.dependency_overrides[deps.get_current_active_user] = lambda: SimpleNamespace(id="test_user")
+    limited_app.dependency_overrides[deps.get_redis] = lambda: redis_client
+    # One portal for all requests, so the async Redis client stays on one loop
+    with TestClient(limited_app) as limited_client:
+        response = limited_client.get("/expensive")
+        assert response.status_code == 200
+        assert response.headers["X-RateLimit-Remaining"] == "25"
+        assert limited_client.get("/expensive").status_code == 200
+
+        # 5 units are left: enough for cheap reads, not for another analysis
+        response = limited_client.get("/expensive")
+        assert response.status_code == 429
+        assert "Retry-After" in response.headers
+        assert limited_client.get("/cheap").status_code == 200
+
+def test_rate_limit_decorator_request_cost(redis_client):
+    """Test that a cost computed from the request is spent, and oversized requests are refused."""
+    limited_app = FastAPI()
+    scope = f"test_{time.time_ns()}"
+
+    async def items_cost(request):
+        return len((await request.json())["items"])
+
+    @limited_app.post("/batch")
+    @rate_limit(max_requests=10, window_seconds=3600, cost=items_cost, scope=scope)
+    async def batch(payload: dict):
+        return {"ok": True}
+
+    limited_app.dependency_overrides[deps.get_current_active_user] = lambda: SimpleNamespace(id="test_user")
+    limited_app.dependency_overrides[deps.get_redis] = lambda: redis_client
+
+    with TestClient(limited_app) as limited_client:
+        response = limited_client.post("/batch", json={"items": list(range(6))})
+        assert response.status_code == 200
+        assert response.headers["X-RateLimit-Remaining"] == "4"
+        assert limited_client.post("/batch", json={"items": list(range(6))}).status_code == 429
+        # More than the whole budget can never succeed, so it isn't a 429
+        assert limited_client.post("/batch", json={"items": list(range(11))}).status_code == 413
+
+def test_middleware_rejects_before_dependencies(redis_client, monkeypatch):
+    """Test that throttled requests never reach the route's dependencies."""
+    scope = f"test_{time.time_ns()}"
+    monkeypatch.setattr(settings, "RATE_LIMIT_POLICIES", [RateLimitPolicy(path="/limited", limit=2, scope=scope)])
+    calls = []
+
+    def expensive_dependency():
+        calls.append(1)
+
+    limited_app = FastAPI()
+    limited_app.add_middleware(RateLimitMiddleware, redis_client=redis_client)
+
+    @limited_app.get(f"{settings.API_V1_PREFIX}/limited")
+    async def limited(_=Depends(expensive_dependency)):
+        return {"ok": True}
+
+    alice = {"Authorization": f"Bearer {create_access_token(1)}"}
+    bob = {"Authorization": f"Bearer {create_access_token(2)}"}
+    with TestClient(limited_app) as limited_client:
+        response = limited_client.get(f"{settings.API_V1_PREFIX}/limited", headers=alice)
+        assert response.status_code == 200
+        assert response.headers["X-RateLimit-Remaining"] == "1"
+        assert limited_client.get(f"{settings.API_V1_PREFIX}/limited", headers=alice).status_code == 200
+
+        response = limited_client.get(f"{settings.API_V1_PREFIX}/limited", headers=alice)
+        assert response.status_code == 429
+        assert "Retry-After" in response.headers
+        assert len(calls) == 2
+
+        # Another token subject has its own budget
+        assert limited_client.get(f"{settings.API_V1_PREFIX}/limited", headers=bob).status_code == 200
+
+def test_rate_limit_api_endpoint(monkeypatch):
+    """Test that the app's ICP routes are throttled before authentication."""
+    scope = f"test_{time.time_ns()}"
+    monkeypatch.setattr(settings, "RATE_LIMIT_POLICIES", [RateLimitPolicy(path="/icp/", limit=3, scope=scope)])
+    # Each TestClient request runs on its own event loop, so give each one its own client
+    monkeypatch.setattr(rate_limit_module, "get_redis_client", lambda: Redis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        password=settings.REDIS_PASSWORD,
+        decode_responses=True
+    ))
+
+    def reject_token():
+        raise HTTPException(status_code=401, detail="Could not validate credentials")
+
+    app.dependency_overrides[deps.get_db] = lambda: None
+    app.dependency_overrides[deps.get_current_user] = reject_token
+    try:
+        # Make requests up to limit
+        for _ in range(3):
+            response = client.get(f"{settings.API_V1_PREFIX}/icp/icps", headers={"Authorization": "Bearer test_token"})
+            assert response.status_code == 401
+
+        # Next request should be rate limited
+        response = client.get(f"{settings.API_V1_PREFIX}/icp/icps", headers={"Authorization": "Bearer test_token"})
+        assert response.status_code == 429
+        assert "X-RateLimit-Reset" in response.headers
+    finally:
+        app.dependency_overrides.clear() 
\ No newline at end of file
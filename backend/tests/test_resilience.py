@@ -0,0 +1,131 @@
+import asyncio
+import httpx
+import pytest
+from openai import APITimeoutError, BadRequestError, RateLimitError
+from app.core import resilience
+from app.core.resilience import (
+    AdaptiveConcurrencyLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    OpenAIGuard,
+    retry_delay,
+)
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+def rate_limit_error(retry_after: str = None) -> RateLimitError:
+    headers = {"retry-after": retry_after} if retry_after else {}
+    return RateLimitError("Rate limited", response=httpx.Response(429, headers=headers, request=REQUEST), body=None)
+
+@pytest.fixture
+def limiter():
+    return AdaptiveConcurrencyLimiter(initial_limit=4, min_limit=1, max_limit=8, latency_target=10.0)
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker(failure_threshold=2, recovery_timeout=30.0)
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Record retry sleeps instead of waiting."""
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(resilience.asyncio, "sleep", fake_sleep)
+    return delays
+
+@pytest.mark.asyncio
+async def test_limiter_increases_on_success(limiter):
+    """Test additive increase after fast successful calls."""
+    async with limiter.slot():
+        pass
+    assert limiter.limit == pytest.approx(4.25)
+
+@pytest.mark.asyncio
+async def test_limiter_halves_on_throttle(limiter):
+    """Test multiplicative decrease when a call is throttled."""
+    async with limiter.slot() as slot:
+        slot.throttled = True
+    assert limiter.limit == 2
+
+    for _ in range(3):
+        async with limiter.slot() as slot:
+            slot.throttled = True
+    assert limiter.limit == 1
+
+@pytest.mark.asyncio
+async def test_limiter_bounds_in_flight_calls():
+    """Test that no more than the limit run at once."""
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2, min_limit=1, max_limit=2, latency_target=10.0)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter.slot():
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*(call() for _ in range(6)))
+    assert peak == 2
+
+def test_breaker_opens_after_threshold(breaker):
+    """Test that consecutive failures open the circuit."""
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+def test_breaker_half_open_allows_single_trial(breaker, monkeypatch):
+    """Test that one trial call is let through after the recovery timeout."""
+    breaker.record_failure()
+    breaker.record_failure()
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: breaker.opened_at + 31)
+
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_retry_delay_respects_retry_after():
+    """Test that Retry-After sets a floor on the backoff."""
+    assert retry_delay(0, rate_limit_error("7")) >= 7
+
+@pytest.mark.asyncio
+async def test_guard_retries_transient_errors(limiter, breaker, no_sleep):
+    """Test that throttling and timeouts are retried until success."""
+    errors = [rate_limit_error("2"), APITimeoutError(request=REQUEST)]
+
+    async def request():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    guard = OpenAIGuard(limiter, breaker, max_retries=3)
+    assert await guard.call(request) == "ok"
+    assert len(no_sleep) == 2
+    assert no_sleep[0] >= 2
+
+@pytest.mark.asyncio
+async def test_guard_does_not_retry_bad_requests(limiter, breaker, no_sleep):
+    """Test that non-transient errors fail immediately."""
+    calls = 0
+
+    async def request():
+        nonlocal calls
+        calls += 1
+        raise BadRequestError("Bad request", response=httpx.Response(400, request=REQUEST), body=None)
+
+    guard = OpenAIGuard(limiter, breaker, max_retries=3)
+    with pytest.raises(BadRequestError):
+        await guard.call(request)
+    assert calls == 1
+    assert breaker.state == CircuitBreaker.CLOSED
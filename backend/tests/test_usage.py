@@ -0,0 +1,250 @@
+import asyncio
+import pytest
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from redis import Redis as SyncRedis
+from redis.asyncio import Redis
+from sqlalchemy.dialects import postgresql
+from app.core import usage
+from app.core.config import settings
+from app.core.usage import ANALYSIS_USAGE, COUNTER_TTL, UsageMeter, current_period, flush_usage, next_period_start, quota_for
+
+@pytest.fixture
+def redis_client():
+    """Create a test Redis client."""
+    return Redis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        password=settings.REDIS_PASSWORD,
+        decode_responses=True
+    )
+
+@pytest.fixture
+def user_id():
+    """Create a user id no other test run has counters for."""
+    return time.time_ns()
+
+@pytest.fixture
+def dirty_key(user_id, monkeypatch):
+    """Track changed counters in a set of the test's own, and clean up its keys after it."""
+    key = f"usage:dirty:test:{user_id}"
+    monkeypatch.setattr(usage, "DIRTY_KEY", key)
+    yield key
+    cleanup = SyncRedis(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        db=settings.REDIS_DB,
+        password=settings.REDIS_PASSWORD
+    )
+    cleanup.delete(key, counter_key(user_id), counter_key(user_id + 1))
+    cleanup.close()
+
+@pytest.fixture
+def quotas(monkeypatch):
+    monkeypatch.setattr(settings, "PLAN_QUOTAS", {"free": {ANALYSIS_USAGE: 3}, "pro": {ANALYSIS_USAGE: 100}, "enterprise": {}})
+
+class FakeQuery:
+    def __init__(self, seed):
+        self.seed = seed
+
+    def filter(self, *conditions):
+        return self
+
+    def scalar(self):
+        return self.seed
+
+class FakeSession:
+    """Answers the seed lookup with a fixed count."""
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.queries = 0
+
+    def query(self, *entities):
+        self.queries += 1
+        return FakeQuery(self.seed)
+
+def counter_key(user_id):
+    return f"usage:{current_period()}:{ANALYSIS_USAGE}:{user_id}"
+
+def test_quota_for_plans(quotas):
+    """Test quota lookup, falling back to the free plan."""
+    assert quota_for("pro", ANALYSIS_USAGE) == 100
+    assert quota_for("unknown", ANALYSIS_USAGE) == 3
+    assert quota_for(None, ANALYSIS_USAGE) == 3
+    assert quota_for("enterprise", ANALYSIS_USAGE) is None
+
+def test_next_period_start():
+    """Test that quotas reset on the first of the next month."""
+    assert next_period_start(datetime(2024, 3, 15, 12)) == datetime(2024, 4, 1)
+    assert next_period_start(datetime(2024, 12, 31, 23)) == datetime(2025, 1, 1)
+
+@pytest.mark.asyncio
+async def test_consume_enforces_quota(quotas, redis_client, dirty_key, user_id):
+    """Test that units are counted until the plan's quota is reached."""
+    meter = UsageMeter(redis_client)
+    db = FakeSession()
+
+    results = [await meter.consume(db, user_id, "free", ANALYSIS_USAGE) for _ in range(4)]
+
+    assert [bool(result) for result in results] == [True, True, True, False]
+    assert results[-1].used == 3
+    assert results[-1].quota == 3
+    # Only the first check had to seed the counter from Postgres
+    assert db.queries == 1
+    assert await redis_client.get(counter_key(user_id)) == "3"
+    assert 0 < await redis_client.ttl(counter_key(user_id)) <= COUNTER_TTL
+    assert await redis_client.smembers(dirty_key) == {f"{current_period()}:{ANALYSIS_USAGE}:{user_id}"}
+
+@pytest.mark.asyncio
+async def test_missing_counter_seeds_from_usage_row(quotas, redis_client, dirty_key, user_id):
+    """Test that a counter missing from Redis continues from the flushed count."""
+    meter = UsageMeter(redis_client)
+
+    assert await meter.consume(FakeSession(seed=2), user_id, "free", ANALYSIS_USAGE)
+    assert not await meter.consume(FakeSession(seed=2), user_id, "free", ANALYSIS_USAGE)
+
+@pytest.mark.asyncio
+async def test_batch_consumes_all_or_nothing(quotas, redis_client, dirty_key, user_id):
+    """Test that a batch larger than what's left is rejected without using any of it."""
+    meter = UsageMeter(redis_client)
+    db = FakeSession()
+
+    assert not await meter.consume(db, user_id, "free", ANALYSIS_USAGE, 4)
+    result = await meter.consume(db, user_id, "free", ANALYSIS_USAGE, 3)
+    assert result and result.used == 3
+
+@pytest.mark.asyncio
+async def test_refund(quotas, redis_client, dirty_key, user_id):
+    """Test that refunded units can be used again."""
+    meter = UsageMeter(redis_client)
+    db = FakeSession()
+    for _ in range(3):
+        await meter.consume(db, user_id, "free", ANALYSIS_USAGE)
+
+    await meter.refund(user_id, ANALYSIS_USAGE)
+
+    assert await meter.consume(db, user_id, "free", ANALYSIS_USAGE)
+
+@pytest.mark.asyncio
+async def test_refund_without_counter_is_ignored(redis_client, dirty_key, user_id):
+    """Test that a refund doesn't create a counter that would skip the seed."""
+    await UsageMeter(redis_client).refund(user_id, ANALYSIS_USAGE)
+
+    assert await redis_client.exists(counter_key(user_id)) == 0
+
+@pytest.mark.asyncio
+async def test_flush_usage_writes_absolute_counts(quotas, redis_client, dirty_key, user_id, monkeypatch):
+    """Test that changed counters are written once with their current count and read time."""
+    meter = UsageMeter(redis_client)
+    db = FakeSession()
+    for user in (user_id, user_id, user_id + 1):
+        await meter.consume(db, user, "free", ANALYSIS_USAGE)
+    written = []
+    monkeypatch.setattr(usage, "_write_usage", written.extend)
+
+    assert await flush_usage(redis_client) == 2
+    assert sorted((row["user_id"], row["count"]) for row in written) == [(user_id, 2), (user_id + 1, 1)]
+    assert all(row["resource"] == ANALYSIS_USAGE for row in written)
+    # Stamped with Redis' clock, once for the whole batch
+    assert len({row["counted_at"] for row in written}) == 1
+    assert abs(written[0]["counted_at"] - datetime.now(timezone.utc)) < timedelta(minutes=5)
+    # Nothing changed since, so there's nothing left to flush
+    assert await flush_usage(redis_client) == 0
+
+@pytest.mark.asyncio
+async def test_flush_usage_keeps_counters_dirty_on_failure(quotas, redis_client, dirty_key, user_id, monkeypatch):
+    """Test that counters that failed to write are flushed again later."""
+    await UsageMeter(redis_client).consume(FakeSession(), user_id, "free", ANALYSIS_USAGE)
+
+    def fail(rows):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(usage, "_write_usage", fail)
+    with pytest.raises(RuntimeError):
+        await flush_usage(redis_client)
+
+    assert await redis_client.scard(dirty_key) == 1
+
+@pytest.mark.asyncio
+async def test_flush_failures_are_counted(quotas, redis_client, dirty_key, user_id, monkeypatch):
+    """Test that a failed flush is reported instead of raised, and retried later."""
+    await UsageMeter(redis_client).consume(FakeSession(), user_id, "free", ANALYSIS_USAGE)
+
+    def fail(rows):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(usage, "_write_usage", fail)
+    errors = usage.USAGE_ERRORS.labels(operation="flush")
+    before = errors._value.get()
+
+    await usage.flush_all_usage(redis_client)
+
+    assert errors._value.get() == before + 1
+    assert await redis_client.scard(dirty_key) == 1
+
+@pytest.mark.asyncio
+async def test_cancelled_flush_keeps_counters_dirty(quotas, redis_client, dirty_key, user_id, monkeypatch):
+    """Test that counters taken by a flush cancelled mid-write are flushed again later."""
+    await UsageMeter(redis_client).consume(FakeSession(), user_id, "free", ANALYSIS_USAGE)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_write(rows):
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(usage, "_write_usage", slow_write)
+    task = asyncio.create_task(flush_usage(redis_client))
+    await asyncio.to_thread(started.wait, 5)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    release.set()
+
+    assert await redis_client.scard(dirty_key) == 1
+
+def test_usage_upsert_only_replaces_older_counts():
+    """Test that a stored count is only replaced by one read later."""
+    row = {"user_id": 1, "period": "2024-03", "resource": ANALYSIS_USAGE, "count": 5, "counted_at": datetime.now(timezone.utc)}
+    sql = str(usage.usage_upsert([row]).compile(dialect=postgresql.dialect()))
+
+    assert "ON CONFLICT (user_id, period, resource) DO UPDATE" in sql
+    assert "WHERE usage_records.counted_at < excluded.counted_at" in sql
+
+def test_failed_task_refunds_quota(monkeypatch):
+    """Test that a queued analysis that fails gives its unit back."""
+    from app import worker
+
+    class MissingICPSession(FakeSession):
+        def query(self, *entities):
+            return self
+
+        def filter(self, *conditions):
+            return self
+
+        def first(self):
+            return None
+
+        def close(self):
+            pass
+
+    refunds = []
+
+    class RecordingMeter:
+        def __init__(self, redis_client):
+            pass
+
+        async def refund(self, user_id, resource, amount=1):
+            refunds.append((user_id, resource, amount))
+
+    monkeypatch.setattr(worker, "SessionLocal", MissingICPSession)
+    monkeypatch.setattr(worker, "UsageMeter", RecordingMeter)
+    monkeypatch.setattr(worker, "get_redis_client", lambda: None)
+
+    with pytest.raises(ValueError):
+        worker.analyze_email_task(1, 2, "Hello")
+
+    assert refunds == [(1, ANALYSIS_USAGE, 1)]
\ No newline at end of file